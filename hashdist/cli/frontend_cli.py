@@ -15,9 +15,13 @@ def add_build_args(ap):
     ap.add_argument('-k', metavar='KEEP_BUILD', default="error", type=str,
             help='keep build directory: always, never, error (default: error)')
     ap.add_argument('--debug', action='store_true', help='enter interactive debug mode')
+    ap.add_argument('--fetch-jobs', metavar='N', default=4, type=int,
+            help='number of sources to download in parallel while building (default: 4)')
 
 def add_profile_args(ap):
     ap.add_argument('profile', nargs='?', default='default.yaml', help='yaml file describing profile to build (default: default.yaml)')
+    ap.add_argument('--load-jobs', metavar='N', default=1, type=int,
+            help='number of processes to load the package specs with (default: 1)')
 
 def add_package_args(ap):
     ap.add_argument('--package', default=None, help='package to build (default: build all)')
@@ -34,17 +38,65 @@ def add_target_args(ap):
     ap.add_argument('-f', '--force', action='store_true', help='overwrite output directory')
 
 class ProfileFrontendBase(object):
+    # Set by commands that can make do with the cached build specs, when
+    # they are up to date (see hashdist.spec.fingerprint)
+    use_spec_cache = False
+
     def __init__(self, ctx, args):
-        from ..spec import Profile, ProfileBuilder, load_profile, TemporarySourceCheckouts
+        from ..spec import TemporarySourceCheckouts
+        from ..spec.fingerprint import ProfileSpecCache
         from ..core import BuildStore, SourceCache
         self.ctx = ctx
         self.args = args
         self.source_cache = SourceCache.create_from_config(ctx.get_config(), ctx.logger)
-        self.build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        self.build_store = BuildStore.create_from_config(ctx.get_config(), ctx.logger, async_cleanup=True)
         self.checkouts = TemporarySourceCheckouts(self.source_cache)
-        parameters = dict(args.parameters) if hasattr(args, 'parameters') else None
-        self.profile = load_profile(self.ctx.logger, self.checkouts, args.profile, parameters)
-        self.builder = ProfileBuilder(self.ctx.logger, self.source_cache, self.build_store, self.profile)
+        self.parameters = dict(args.parameters) if hasattr(args, 'parameters') else None
+        self.spec_cache = ProfileSpecCache.create_from_config(ctx.get_config(), args.profile,
+                                                              self.parameters)
+        self.cached_build_specs = self.cached_profile_build_spec = None
+        if self.use_spec_cache and getattr(args, 'from_lock', None) is None:
+            self.cached_build_specs, self.cached_profile_build_spec = self.spec_cache.get()
+        self._profile = self._builder = None
+
+    def _load(self):
+        from ..spec import ProfileBuilder, load_profile
+        from ..core.cache import DiskCache
+        if getattr(self.args, 'from_lock', None) is not None:
+            from ..spec.lock import LockedProfileBuilder
+            self._builder = LockedProfileBuilder.load(self.ctx.logger, self.source_cache,
+                                                      self.build_store, self.args.from_lock)
+            return
+        self._profile = load_profile(self.ctx.logger, self.checkouts, self.args.profile, self.parameters,
+                                     DiskCache(self.ctx.get_config()['cache']))
+        self._builder = ProfileBuilder(self.ctx.logger, self.source_cache, self.build_store, self._profile,
+                                       jobs=self.args.load_jobs)
+        if self.use_spec_cache:
+            self.spec_cache.put(self._profile, self._builder)
+
+    @property
+    def profile(self):
+        if self._profile is None:
+            self._load()
+        return self._profile
+
+    @property
+    def builder(self):
+        if self._builder is None:
+            self._load()
+        return self._builder
+
+    def is_up_to_date_from_cache(self):
+        """
+        Whether the cached build specs are up to date with the inputs and
+        all of the packages and the profile itself are built. If so, the
+        profile does not have to be loaded.
+        """
+        if self.cached_build_specs is None:
+            return False
+        return (all(self.build_store.is_present(build_spec)
+                    for build_spec in self.cached_build_specs.values()) and
+                self.build_store.is_present(self.cached_profile_build_spec))
 
     @classmethod
     def run(cls, ctx, args):
@@ -59,6 +111,7 @@ class ProfileFrontendBase(object):
         if len(ready) == 0:
             sys.stdout.write('[Profile dependencies are up to date]\n')
         else:
+            self.builder.prefetch_sources(self.args.fetch_jobs)
             while len(ready) != 0:
                 self.builder.build(ready[0], self.ctx.get_config(),
                         self.args.j, self.args.k)
@@ -83,8 +136,16 @@ class Build(ProfileFrontendBase):
 
     If you provide the package argument to build a single package, the
     profile symlink will NOT be updated.
+
+    With ``--from-lock``, the profile is built from a lock file written
+    by ``hit lock`` instead (the profile argument is then ignored), and
+    the symlink is named after the lock file without ``.lock.json``.
+
+    With ``--dedup``, identical files in the build store are hard-linked
+    afterwards, as by ``hit store-dedup``.
     """
     command = 'build'
+    use_spec_cache = True
 
     @classmethod
     def setup(cls, ap):
@@ -92,19 +153,33 @@ class Build(ProfileFrontendBase):
         add_build_args(ap)
         add_package_args(ap)
         add_parameter_args(ap)
+        ap.add_argument('--from-lock', metavar='LOCKFILE', default=None,
+                        help='build from a lock file written by "hit lock"')
+        ap.add_argument('--dedup', action='store_true',
+                        help='hard-link identical files in the build store after building')
 
     def profile_builder_action(self):
-
-        if not self.args.profile.endswith('.yaml'):
+        if self.args.from_lock is not None:
+            profile_symlink = os.path.basename(self.args.from_lock)
+            for suffix in ['.json', '.lock']:
+                if profile_symlink.endswith(suffix):
+                    profile_symlink = profile_symlink[:-len(suffix)]
+        elif not self.args.profile.endswith('.yaml'):
             self.ctx.error('profile filename must end with yaml')
-
-        profile_symlink = os.path.basename(self.args.profile)[:-len('.yaml')]
-        if self.args.package is not None:
+        else:
+            profile_symlink = os.path.basename(self.args.profile)[:-len('.yaml')]
+        if self.args.package is None and self.is_up_to_date_from_cache():
+            self.build_store.create_symlink_to_artifact(self.cached_profile_build_spec.artifact_id,
+                                                        profile_symlink)
+            sys.stdout.write('Up to date, link at: %s\n' % profile_symlink)
+        elif self.args.package is not None:
             self.builder.build(self.args.package, self.ctx.get_config(), self.args.j,
                                self.args.k, self.args.debug)
         else:
             ready = self.builder.get_ready_list()
             was_done = len(ready) == 0
+            if not was_done:
+                self.builder.prefetch_sources(self.args.fetch_jobs)
             while len(ready) != 0:
                 self.builder.build(ready[0], self.ctx.get_config(), self.args.j,
                                    self.args.k, self.args.debug)
@@ -119,6 +194,10 @@ class Build(ProfileFrontendBase):
                             self.args.j, self.args.k)
                     ready = self.builder.get_ready_list()
                 sys.stdout.write('Profile build successful, link at: %s\n' % profile_symlink)
+        if self.args.dedup:
+            from ..core.cache import DiskCache
+            from ..core.dedup import dedup_store
+            dedup_store(self.ctx.logger, self.build_store, DiskCache(self.ctx.get_config()['cache']))
 
 @register_subcommand
 class Develop(ProfileFrontendBase):
@@ -172,6 +251,7 @@ class Status(ProfileFrontendBase):
     without the .yaml suffix.
     """
     command = 'status'
+    use_spec_cache = True
 
     @classmethod
     def setup(cls, ap):
@@ -179,12 +259,56 @@ class Status(ProfileFrontendBase):
         add_parameter_args(ap)
 
     def profile_builder_action(self):
-        report = self.builder.get_status_report()
+        if self.cached_build_specs is not None:
+            report = dict((pkgname, (build_spec, self.build_store.is_present(build_spec)))
+                          for pkgname, build_spec in self.cached_build_specs.iteritems())
+        else:
+            report = self.builder.get_status_report()
         report = sorted(report.values(), key=lambda tup: tup[0].short_artifact_id.lower())
         for build_spec, is_built in report:
             status = 'OK' if is_built else 'needs build'
             sys.stdout.write('%-50s [%s]\n' % (build_spec.short_artifact_id, status))
 
+@register_subcommand
+class Lock(ProfileFrontendBase):
+    """
+    Writes a lock file for a profile.
+
+    The lock file contains the resolved build specs of the profile and
+    all its packages, together with source keys, URLs and build scripts,
+    so that ``hit build --from-lock`` can build the profile without the
+    profile and package repositories. Example::
+
+        $ hit lock profile.yaml -o profile.lock.json
+        $ hit build --from-lock profile.lock.json
+
+    Without ``-o`` the lock file is written to standard output. Log
+    messages go to standard error, so that
+    ``hit lock profile.yaml > profile.lock.json`` works as well.
+
+    """
+    command = 'lock'
+    log_to_stderr = True
+
+    @classmethod
+    def setup(cls, ap):
+        add_profile_args(ap)
+        add_parameter_args(ap)
+        ap.add_argument('-o', '--output', metavar='LOCKFILE', default=None,
+                        help='file to write the lock file to (default: standard output)')
+
+    def profile_builder_action(self):
+        from ..spec.lock import make_lock_document, write_lock_document
+        doc = make_lock_document(self.builder, self.source_cache)
+        if self.args.output is None:
+            write_lock_document(doc, sys.stdout)
+        else:
+            # write to a temporary name, so that a failure leaves no partial lock file
+            temp_filename = self.args.output + '.part'
+            with open(temp_filename, 'w') as f:
+                write_lock_document(doc, f)
+            os.rename(temp_filename, self.args.output)
+
 @register_subcommand
 class Show(ProfileFrontendBase):
     """
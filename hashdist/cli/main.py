@@ -151,7 +151,8 @@ def command_line_entry_point(unparsed_argv, env, default_config_filename=None, s
 
 
         subcmd_parser.set_defaults(subcommand_handler=cls.run, parser=parser,
-                                   subcommand=name)
+                                   subcommand=name,
+                                   log_to_stderr=getattr(cls, 'log_to_stderr', False))
         # Can't find an API to access subparsers through parser? Pass along explicitly in ctx
         # (needed by Help)
         subcmd_parsers[name] = subcmd_parser
@@ -163,7 +164,8 @@ def command_line_entry_point(unparsed_argv, env, default_config_filename=None, s
     args = parser.parse_args(unparsed_argv[1:])
 
     if not secondary:
-        configure_logging(args.log)
+        # commands that write their result to stdout keep it free of log messages
+        configure_logging(args.log, stream=sys.stderr if args.log_to_stderr else None)
         if args.verbose:
             set_log_level('INFO')
             if args.log is not None:
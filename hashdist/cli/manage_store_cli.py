@@ -114,3 +114,208 @@ class Purge(object):
                 sys.stderr.write('Artifact %s not found\n' % args.artifact_id)
             else:
                 sys.stderr.write('Removed directory: %s\n' % path)
+
+@register_subcommand
+class StoreDedup(object):
+    """
+    Replaces identical files in the build store by hard links to a
+    single copy, and reports the disk space saved::
+
+        $ hit store-dedup
+
+    Only write-protected regular files with the same mode and owner in
+    complete artifacts are linked. The digests of the files are cached,
+    so that later runs only need to hash new artifacts. It is safe to
+    interrupt. ``hit build --dedup`` does the same after building.
+    """
+    command = 'store-dedup'
+
+    @staticmethod
+    def setup(ap):
+        pass
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore, DiskCache
+        from ..core.dedup import dedup_store
+        config = ctx.get_config()
+        store = BuildStore.create_from_config(config, ctx.logger)
+        dedup_store(ctx.logger, store, DiskCache(config['cache']))
+
+@register_subcommand
+class StoreArchive(object):
+    """
+    Compresses the artifacts in the build store that have not been used
+    for a given time, e.g., 90 days::
+
+        $ hit store-archive --older-than 90d
+
+    Each such artifact is packed into an ``archive.tar.gz`` file within
+    its directory, next to its ``id`` file. Artifacts that are needed
+    by an artifact that has been used recently are kept. An archived
+    artifact is unpacked again as soon as a ``hit`` command needs it;
+    note that software in a profile which uses it does not trigger that.
+    If ``pigz`` is found on the PATH it is used to compress with several
+    threads.
+    """
+    command = 'store-archive'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('--older-than', required=True, metavar='AGE',
+                        help='minimum time since last use, e.g. 90d, 12h or 2w')
+        ap.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of compression threads (with pigz; default: 4)')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.archive import archive_store, parse_age
+        try:
+            max_age = parse_age(args.older_than)
+        except ValueError as e:
+            ctx.logger.error(str(e))
+            return 1
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        archive_store(ctx.logger, store, max_age, args.jobs)
+
+@register_subcommand
+class ExportProfile(object):
+    """
+    Writes a profile artifact together with all the artifacts it depends
+    on to a single gzip-compressed tar bundle, e.g.::
+
+        $ hit export-profile default profile.tar.gz
+
+    The bundle can be unpacked into another build store with
+    ``hit import-bundle``. If ``pigz`` is found on the PATH it is used
+    to compress with several threads.
+    """
+    command = 'export-profile'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('profile', help='symlink to the profile artifact, or an artifact ID')
+        ap.add_argument('output', help='bundle file to write, or "-" for standard output')
+        ap.add_argument('-j', '--jobs', type=int, default=4,
+                        help='number of compression threads (with pigz; default: 4)')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.bundle import get_artifact_closure, export_bundle
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        id_file = pjoin(args.profile, 'id')
+        if pexists(id_file):
+            with open(id_file) as f:
+                artifact_id = f.read().strip()
+        else:
+            artifact_id = args.profile
+        if '/' not in artifact_id or store.resolve(artifact_id) is None:
+            ctx.logger.error('Not a HashDist artifact: %s' % args.profile)
+            return 1
+        artifact_ids = get_artifact_closure(store, artifact_id)
+        if args.output == '-':
+            export_bundle(ctx.logger, store, artifact_ids, sys.stdout, args.jobs)
+        else:
+            with open(args.output, 'wb') as f:
+                export_bundle(ctx.logger, store, artifact_ids, f, args.jobs)
+        ctx.logger.info('Exported %d artifacts' % len(artifact_ids))
+
+@register_subcommand
+class ImportBundle(object):
+    """
+    Unpacks a bundle created by ``hit export-profile`` into the build
+    store. Artifacts that are already present are skipped::
+
+        $ hit import-bundle profile.tar.gz
+
+    Note that this does not create a profile symlink or a GC root; use
+    ``hit cp`` on the imported profile artifact directory for that.
+    """
+    command = 'import-bundle'
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('input', help='bundle file to read, or "-" for standard input')
+
+    @staticmethod
+    def run(ctx, args):
+        from ..core import BuildStore
+        from ..core.bundle import import_bundle
+        store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+        if args.input == '-':
+            imported, skipped = import_bundle(ctx.logger, store, sys.stdin)
+        else:
+            with open(args.input, 'rb') as f:
+                imported, skipped = import_bundle(ctx.logger, store, f)
+        ctx.logger.info('Imported %d artifacts, %d already present' % (len(imported), len(skipped)))
+
+@register_subcommand
+class Stats(object):
+    """
+    Summarizes the resource usage of the commands that built an artifact,
+    as recorded in its ``job_stats.json``, e.g.::
+
+        $ hit stats default/zlib
+
+    For each ``cmd`` and ``hit`` node the wall time, user and system CPU
+    time, the achieved parallelism (CPU time over wall time), the peak
+    resident set size, the data read from and written to storage, and
+    the exit code are listed. Artifacts built by older versions of
+    HashDist have no such file.
+    """
+
+    @staticmethod
+    def setup(ap):
+        ap.add_argument('artifact', help='artifact directory or symlink to it, or an artifact ID')
+
+    @staticmethod
+    def run(ctx, args):
+        import json
+        from ..core import BuildStore
+        from ..core.build_store import JOB_STATS_FILENAME
+        if pexists(pjoin(args.artifact, 'id')):
+            artifact_dir = args.artifact
+        else:
+            store = BuildStore.create_from_config(ctx.get_config(), ctx.logger)
+            is_id = args.artifact.count('/') == 1
+            artifact_dir = store.resolve(args.artifact) if is_id else None
+            if artifact_dir is None:
+                ctx.logger.error('Not a HashDist artifact: %s' % args.artifact)
+                return 1
+        stats_filename = pjoin(artifact_dir, JOB_STATS_FILENAME)
+        if not pexists(stats_filename):
+            ctx.logger.error('No resource usage recorded for %s' % args.artifact)
+            return 1
+        with open(stats_filename) as f:
+            stats = json.load(f)['commands']
+
+        MB = 1024 * 1024
+        row_fmt = '%-8s %-4s %9s %9s %9s %6s %8s %8s %8s %5s  %s'
+        def write_line(*fields):
+            sys.stdout.write((row_fmt % fields).rstrip() + '\n')
+        write_line('node', 'type', 'wall', 'user', 'sys', 'cpu/w',
+                   'rss MB', 'read MB', 'write MB', 'exit', 'command')
+        def write_row(node, type, s, exit_code, command):
+            cpu_time = s['user_time'] + s['sys_time']
+            parallelism = '%.2f' % (cpu_time / s['wall_time']) if s['wall_time'] else '-'
+            write_line(node, type, '%.2fs' % s['wall_time'], '%.2fs' % s['user_time'],
+                       '%.2fs' % s['sys_time'], parallelism, '%.1f' % (s['max_rss_kb'] / 1024.),
+                       '%.1f' % (s['read_bytes'] / float(MB)), '%.1f' % (s['write_bytes'] / float(MB)),
+                       exit_code, command)
+
+        keys = ['wall_time', 'user_time', 'sys_time', 'read_bytes', 'write_bytes']
+        total = dict((key, 0) for key in keys)
+        total['max_rss_kb'] = 0
+        for node in sorted(stats, key=lambda node: tuple(int(i) for i in node.split('.'))):
+            s = stats[node]
+            for key in keys:
+                total[key] += s[key]
+            total['max_rss_kb'] = max(total['max_rss_kb'], s['max_rss_kb'])
+            command = ' '.join(s['args'])
+            if len(command) > 40:
+                command = command[:37] + '...'
+            exit_code = '-' if s['exit_code'] is None else str(s['exit_code'])
+            write_row(node, s['type'], s, exit_code, command)
+        write_row('total', '', total, '', '')
@@ -6,4 +6,4 @@ from .hit_recipe import hit_cli_build_spec, HIT_CLI_ARTIFACT_NAME, HIT_CLI_ARTIF
 from .cache import DiskCache, null_cache, cached_method
 from .run_job import InvalidJobSpecError, JobFailedError
 from .fileutils import atomic_symlink
-from .hasher import hash_document
+from .hasher import hash_document, freeze_document
@@ -0,0 +1,290 @@
+"""
+:mod:`hashdist.core.archive` --- Compressing cold artifacts in the build store
+==============================================================================
+
+A build store tends to accumulate artifacts that are still reachable
+from some old profile, so that garbage collection keeps them, but that
+nobody has used in months. :func:`archive_store` packs each such
+artifact into a single compressed tar file, ``archive.tar.gz``, inside
+the artifact directory, and removes everything else from it except the
+``id`` and ``artifact.json`` files. The artifact thus stays present,
+and its dependencies can still be looked up without unpacking it.
+
+:meth:`BuildStore.resolve` transparently restores an archived artifact
+the first time it is asked for it; :meth:`BuildStore.is_present` does
+not, so checking whether a profile is up to date leaves its artifacts
+archived, while linking a profile restores all of its artifacts.
+Restoring is streaming: the archive
+is decompressed by ``pigz`` when it is available (which reads, inflates,
+and checksums in separate threads), or by the :mod:`gzip` module
+otherwise, and unpacked one entry at a time.
+
+Which artifacts are archived is recorded in an index file,
+``.archived``, in the artifact root, with one artifact ID per line, so
+that resolving an artifact only costs a ``stat`` of the (single) index
+file, which is reread when it has been replaced. The index is only
+written while holding an exclusive lock on ``.archived.lock``, and
+always through a rename. Archiving and restoring both happen under
+that lock, and are ordered so that an interrupted run is simply
+redone on the next access:
+
+1. The archive is written to a temporary name and renamed into place.
+2. The artifact is added to the index.
+3. The archived files are removed.
+
+Restoring first removes whatever is left of the archived files, then
+unpacks the archive, removes it, and finally removes the artifact from
+the index.
+
+An artifact is considered cold when no file in it has been accessed or
+modified within the given age (so this relies on access times being
+updated, as they are with the usual ``relatime`` mount option), and it
+is not a dependency of any artifact that is not cold. Note that only
+``hit`` restores artifacts: software in a profile that refers to
+archived artifacts will not work until they are restored.
+"""
+
+import os
+from os.path import join as pjoin
+import re
+import stat
+import time
+import errno
+import fcntl
+import tempfile
+from contextlib import contextmanager
+
+from .bundle import CompressedWriter, CompressedReader, extract_member
+from .common import IllegalBuildStoreError
+from .fileutils import allow_writes, rmtree_write_protected
+
+ARCHIVE_FILENAME = 'archive.tar.gz'
+INDEX_FILENAME = '.archived'
+LOCK_FILENAME = '.archived.lock'
+
+# files that are left in the artifact directory when it is archived
+KEPT_FILENAMES = ('id', 'artifact.json', ARCHIVE_FILENAME)
+
+_AGE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 24 * 3600, 'w': 7 * 24 * 3600}
+_AGE_RE = re.compile(r'^([0-9]+)([smhdw])$')
+
+def parse_age(s):
+    """
+    Parses an age such as ``90d`` into seconds. The units are ``s``,
+    ``m``, ``h``, ``d`` and ``w``.
+    """
+    m = _AGE_RE.match(s)
+    if not m:
+        raise ValueError('Not an age (e.g., 90d or 12h): %s' % s)
+    return int(m.group(1)) * _AGE_UNITS[m.group(2)]
+
+
+class ArchiveIndex(object):
+    """
+    The set of archived artifacts in an artifact root; see module docstring.
+    """
+    def __init__(self, artifact_root):
+        self.artifact_root = artifact_root
+        self.filename = pjoin(artifact_root, INDEX_FILENAME)
+        self._stamp = None
+        self._artifact_ids = frozenset()
+
+    def _reload(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self._stamp = None
+            self._artifact_ids = frozenset()
+            return
+        # the file is only ever replaced, so a new inode means new contents
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        if stamp != self._stamp:
+            with open(self.filename) as f:
+                self._artifact_ids = frozenset(line.strip() for line in f if line.strip())
+            self._stamp = stamp
+
+    def __contains__(self, artifact_id):
+        self._reload()
+        return artifact_id in self._artifact_ids
+
+    def __iter__(self):
+        self._reload()
+        return iter(sorted(self._artifact_ids))
+
+    @contextmanager
+    def locked(self):
+        """Holds the (inter-process, non-reentrant) lock of the index"""
+        fd = os.open(pjoin(self.artifact_root, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def update(self, added=(), removed=()):
+        """Adds and removes artifact IDs; the lock must be held"""
+        self._reload()
+        artifact_ids = (self._artifact_ids | frozenset(added)) - frozenset(removed)
+        if artifact_ids == self._artifact_ids:
+            return
+        fd, temp_filename = tempfile.mkstemp(prefix=INDEX_FILENAME + '-', dir=self.artifact_root)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                for artifact_id in sorted(artifact_ids):
+                    f.write(artifact_id + '\n')
+            os.chmod(temp_filename, 0o644)
+            os.rename(temp_filename, self.filename)
+        except:
+            os.unlink(temp_filename)
+            raise
+        self._reload()
+
+    def forget(self, artifact_ids):
+        """Removes artifacts that were deleted from the store from the index"""
+        artifact_ids = [x for x in artifact_ids if x in self]
+        if artifact_ids:
+            with self.locked():
+                self.update(removed=artifact_ids)
+
+
+def _remove_unkept(artifact_dir):
+    for fname in os.listdir(artifact_dir):
+        if fname in KEPT_FILENAMES:
+            continue
+        path = pjoin(artifact_dir, fname)
+        if os.path.isdir(path) and not os.path.islink(path):
+            rmtree_write_protected(path)
+        else:
+            os.unlink(path)
+
+def archive_artifact(logger, index, artifact_id, artifact_dir, jobs=1):
+    """
+    Archives a single artifact of the local store. Returns False if it
+    was already archived.
+    """
+    arc_root = os.path.relpath(artifact_dir, index.artifact_root)
+    archive_filename = pjoin(artifact_dir, ARCHIVE_FILENAME)
+    temp_filename = archive_filename + '.part'
+    with index.locked():
+        if artifact_id in index:
+            return False
+        logger.info('Archiving %s' % artifact_id)
+        with allow_writes(artifact_dir):
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+            with open(temp_filename, 'wb') as f:
+                writer = CompressedWriter(f, jobs)
+                tar = writer.tar
+                try:
+                    for dirpath, dirnames, filenames in os.walk(artifact_dir):
+                        dirnames.sort()
+                        rel_dirpath = os.path.relpath(dirpath, artifact_dir)
+                        arc_dirpath = os.path.normpath(pjoin(arc_root, rel_dirpath))
+                        if dirpath != artifact_dir:
+                            tar.add(dirpath, arc_dirpath, recursive=False)
+                        for fname in sorted(filenames):
+                            if dirpath == artifact_dir and (fname in KEPT_FILENAMES or
+                                                            fname == os.path.basename(temp_filename)):
+                                continue
+                            tar.add(pjoin(dirpath, fname), pjoin(arc_dirpath, fname),
+                                    recursive=False)
+                        tar.members = []
+                finally:
+                    writer.close()
+            os.chmod(temp_filename, 0o444)
+            os.rename(temp_filename, archive_filename)
+            index.update(added=[artifact_id])
+            _remove_unkept(artifact_dir)
+    return True
+
+def restore_artifact(logger, index, artifact_id, artifact_dir):
+    """
+    Unpacks an archived artifact of the local store in place. Does
+    nothing if another process restored it first.
+    """
+    archive_filename = pjoin(artifact_dir, ARCHIVE_FILENAME)
+    with index.locked():
+        if artifact_id not in index:
+            return
+        with allow_writes(artifact_dir):
+            if os.path.exists(archive_filename):
+                logger.info('Restoring archived artifact %s' % artifact_id)
+                _remove_unkept(artifact_dir)
+                dir_modes = []
+                with open(archive_filename, 'rb') as f:
+                    reader = CompressedReader(f)
+                    tar = reader.tar
+                    try:
+                        for member in tar:
+                            parts = member.name.split('/')
+                            if len(parts) < 3 or '..' in parts or os.path.isabs(member.name):
+                                raise IllegalBuildStoreError('Illegal path in archive of %s: %s' %
+                                                             (artifact_id, member.name))
+                            extract_member(tar, member, artifact_dir, parts[2:], dir_modes)
+                            tar.members = []
+                    finally:
+                        reader.close()
+                # bottom-up, since directories may be write-protected
+                for path, mode in sorted(dir_modes, reverse=True):
+                    os.chmod(path, mode)
+                os.unlink(archive_filename)
+            else:
+                logger.warning('Archive of %s is missing, assuming it is restored' % artifact_id)
+            index.update(removed=[artifact_id])
+
+
+def _last_use(artifact_dir):
+    # Only the access times of regular files count, except those that
+    # hashdist reads itself (also while finding cold artifacts); those of
+    # directories and symlinks are updated by merely walking the tree
+    last = 0
+    for dirpath, dirnames, filenames in os.walk(artifact_dir):
+        last = max(last, os.lstat(dirpath).st_mtime)
+        for fname in filenames:
+            st = os.lstat(pjoin(dirpath, fname))
+            if (not stat.S_ISREG(st.st_mode) or
+                dirpath == artifact_dir and fname in KEPT_FILENAMES):
+                last = max(last, st.st_mtime)
+            else:
+                last = max(last, st.st_atime, st.st_mtime)
+    return last
+
+def find_cold_artifacts(build_store, max_age, now=None):
+    """
+    Returns a list of (artifact_id, artifact_dir) of the complete,
+    unarchived artifacts of the local store of `build_store` that
+    are cold, i.e., that have not been used for `max_age` seconds
+    and are not a dependency of an artifact that has.
+    """
+    if now is None:
+        now = time.time()
+    index = build_store.archive_index
+    candidates = []
+    warm = set()
+    for artifact_id, artifact_dir in build_store.iter_artifacts():
+        if artifact_id in index:
+            continue
+        if _last_use(artifact_dir) >= now - max_age:
+            warm.add(artifact_id)
+        else:
+            candidates.append((artifact_id, artifact_dir))
+    needed = set()
+    for artifact_id in warm:
+        needed.update(build_store.get_dependency_closure(artifact_id))
+    return [(artifact_id, artifact_dir) for artifact_id, artifact_dir in candidates
+            if artifact_id not in needed]
+
+def archive_store(logger, build_store, max_age, jobs=1):
+    """
+    Archives all cold artifacts (see :func:`find_cold_artifacts`) in
+    the local store of `build_store`, compressing with `jobs` threads
+    if ``pigz`` is available. Returns the list of archived artifact IDs.
+    """
+    archived = []
+    for artifact_id, artifact_dir in find_cold_artifacts(build_store, max_age):
+        if archive_artifact(logger, build_store.archive_index, artifact_id, artifact_dir, jobs):
+            archived.append(artifact_id)
+    logger.info('Archived %d artifacts' % len(archived))
+    return archived
@@ -112,7 +112,10 @@ are set:
 
 The build specification is available under ``$BUILD/build.json``, and
 stdout and stderr are redirected to ``$BUILD/_hashdist/build.log``. These two
-files will also be present in ``$ARTIFACT`` after the build.
+files will also be present in ``$ARTIFACT`` after the build. The resource
+usage of each build command (see :mod:`hashdist.core.run_job`) is written to
+``$BUILD/_hashdist/job_stats.json``, and copied to
+``$ARTIFACT/job_stats.json``.
 
 Build artifact storage format
 -----------------------------
@@ -140,20 +143,28 @@ import re
 import errno
 import json
 import base64
+import tempfile
+import threading
+import Queue
 
 from .source_cache import SourceCache
-from .hasher import hash_document, prune_nohash
+from .hasher import hash_document
 from .common import (InvalidBuildSpecError, BuildFailedError,
                      IllegalBuildStoreError,
                      json_formatting_options, SHORT_ARTIFACT_ID_LEN,
                      working_directory)
 from .fileutils import silent_unlink, robust_rmtree, silent_makedirs, gzip_compress, write_protect
 from .fileutils import rmtree_write_protected, atomic_symlink, realpath_to_symlink, allow_writes
+from .fileutils import find_executable
 from . import run_job
+from . import spawn
+from .archive import ArchiveIndex, restore_artifact
 
 from hashdist.util.logger_setup import log_to_file, getLogger
 
 
+JOB_STATS_FILENAME = 'job_stats.json'
+
 class BuildSpec(object):
     """Wraps the document corresponding to a build.json
 
@@ -165,7 +176,7 @@ class BuildSpec(object):
     def __init__(self, build_spec):
         self.doc = canonicalize_build_spec(build_spec)
         self.name = self.doc['name']
-        digest = hash_document('build-spec', prune_nohash(self.doc))
+        digest = hash_document('build-spec', self.doc, skip_nohash=True)
         self.digest = digest
         self.artifact_id = '%s/%s' % (self.name, digest)
         self.short_artifact_id = '%s/%s' % (self.name, digest[:SHORT_ARTIFACT_ID_LEN])
@@ -254,17 +265,40 @@ class BuildStore(object):
         through these will not be collected in garbage collection.
 
     logger : Logger
+
+    read_only_roots : list of str (optional)
+        Artifact roots of read-only stores (e.g., on a shared filesystem)
+        that are searched, in order, after `artifact_root` when resolving
+        artifacts. New builds, deletion and garbage collection only ever
+        touch `artifact_root`.
+
+    async_cleanup : bool (optional)
+        If set, finished build directories are moved to a ``trash``
+        directory under `temp_build_dir` and removed in the background
+        (see :class:`TrashCan`), rather than removed before returning.
     """
 
 
-    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, create_dirs=False):
+    def __init__(self, temp_build_dir, artifact_root, gc_roots_dir, logger, create_dirs=False,
+                 read_only_roots=(), async_cleanup=False):
         self.temp_build_dir = os.path.realpath(temp_build_dir)
         self.artifact_root = os.path.realpath(artifact_root)
+        self.read_only_roots = [os.path.realpath(d) for d in read_only_roots]
         self.gc_roots_dir = gc_roots_dir
         self.logger = logger
+        # artifact IDs known not to be in the read-only stores; these are not
+        # written to by us, so a negative lookup stays valid
+        self._read_only_misses = set()
+        self._closures = {}
+        self.archive_index = ArchiveIndex(self.artifact_root)
         if create_dirs:
             for d in [self.temp_build_dir, self.artifact_root]:
                 silent_makedirs(d)
+        if async_cleanup:
+            self.trash = TrashCan(pjoin(self.temp_build_dir, 'trash'), logger)
+            self.trash.reclaim()
+        else:
+            self.trash = None
 
     def _log_artifact_collision(self, path, artifact_id):
         d = dict(path=path, artifact_id=artifact_id)
@@ -280,27 +314,34 @@ class BuildStore(object):
 
     @staticmethod
     def create_from_config(config, logger, **kw):
-        """Creates a SourceCache from the settings in the configuration
-        """
-        if len(config['build_stores']) != 1:
-            logger.error("Only a single build store currently supported")
-            raise NotImplementedError()
+        """Creates a BuildStore from the settings in the configuration
 
+        The first entry of ``build_stores`` is the local store which
+        builds are written to; any further entries are searched as
+        read-only stores, in order.
+        """
         return BuildStore(config['build_temp'],
                           config['build_stores'][0]['dir'],
                           config['gc_roots'],
                           logger,
+                          read_only_roots=[entry['dir'] for entry in config['build_stores'][1:]],
                           **kw)
 
     def get_build_dir(self):
         return self.temp_build_dir
 
     def is_path_in_build_store(self, d):
-        return os.path.realpath(d).startswith(self.artifact_root)
+        d = os.path.realpath(d)
+        return any(d.startswith(root) for root in [self.artifact_root] + self.read_only_roots)
 
     def delete_all(self):
         for x in os.listdir(self.artifact_root):
-            rmtree_write_protected(pjoin(self.artifact_root, x))
+            path = pjoin(self.artifact_root, x)
+            if os.path.isdir(path):
+                rmtree_write_protected(path)
+            else:
+                # the archive index and its lock file
+                os.unlink(path)
 
     def delete(self, artifact_id):
         """Deletes an artifact ID from the store. This is simply an
@@ -316,19 +357,45 @@ class BuildStore(object):
         path = self._get_artifact_path(name, digest)
         if os.path.exists(path):
             rmtree_write_protected(path)
+            self.archive_index.forget([artifact_id])
             return path
         else:
             return None
 
-    def _get_artifact_path(self, name, digest):
-        return pjoin(self.artifact_root, name, digest[:SHORT_ARTIFACT_ID_LEN])
+    def _get_artifact_path(self, name, digest, artifact_root=None):
+        if artifact_root is None:
+            artifact_root = self.artifact_root
+        return pjoin(artifact_root, name, digest[:SHORT_ARTIFACT_ID_LEN])
 
-    def resolve(self, artifact_id):
+    def resolve(self, artifact_id, restore=True):
         """Given an artifact_id, resolve the short path for it, or return
         None if the artifact isn't built.
+
+        The local store is searched first, then the read-only stores.
+        An artifact of the local store that has been archived (see
+        :mod:`hashdist.core.archive`) is restored first, unless `restore`
+        is False, in which case only its ``id`` and ``artifact.json``
+        files may be used.
         """
+        path = self._resolve_in(self.artifact_root, artifact_id)
+        if path is not None:
+            if restore and artifact_id in self.archive_index:
+                restore_artifact(self.logger, self.archive_index, artifact_id, path)
+            return path
+        if not self.read_only_roots:
+            return None
+        if artifact_id in self._read_only_misses:
+            return None
+        for artifact_root in self.read_only_roots:
+            path = self._resolve_in(artifact_root, artifact_id)
+            if path is not None:
+                return path
+        self._read_only_misses.add(artifact_id)
+        return None
+
+    def _resolve_in(self, artifact_root, artifact_id):
         name, digest = artifact_id.split('/')
-        path = self._get_artifact_path(name, digest)
+        path = self._get_artifact_path(name, digest, artifact_root)
         if not os.path.exists(path):
             return None
         else:
@@ -352,9 +419,60 @@ class BuildStore(object):
                     raise IllegalBuildStoreError('Hashes collide in first 12 chars: %s and %s' % (present_id, artifact_id))
             return path
 
+    def get_dependency_closure(self, artifact_id):
+        """Return the set of all artifacts `artifact_id` depends on
+
+        The result is computed from the (direct) dependencies listed in
+        the artifact.json of each artifact, and memoized, as the
+        dependencies of an artifact never change. Virtual dependencies,
+        and dependencies that have been removed from the store, are
+        included but not searched for further dependencies. The
+        artifact itself is not included.
+        """
+        try:
+            return self._closures[artifact_id]
+        except KeyError:
+            pass
+        artifact_dir = self.resolve(artifact_id, restore=False)
+        if artifact_dir is None:
+            raise IllegalBuildStoreError('Artifact not present: %s' % artifact_id)
+        with open(pjoin(artifact_dir, 'artifact.json')) as f:
+            doc = json.load(f)
+        closure = set()
+        for dep_id in doc.get('dependencies', []):
+            if dep_id in closure:
+                # artifact.json of older builds list the complete dependencies
+                continue
+            closure.add(dep_id)
+            if not dep_id.startswith('virtual:') and self.resolve(dep_id, restore=False) is not None:
+                closure.update(self.get_dependency_closure(dep_id))
+        closure = frozenset(closure)
+        self._closures[artifact_id] = closure
+        return closure
+
     def is_present(self, build_spec):
+        # an archived artifact is present, no need to restore it
         build_spec = as_build_spec(build_spec)
-        return self.resolve(build_spec.artifact_id) is not None
+        return self.resolve(build_spec.artifact_id, restore=False) is not None
+
+    def iter_artifacts(self):
+        """
+        Yields (artifact_id, artifact_dir) of the complete artifacts in the
+        local store (including archived ones), sorted by path.
+        """
+        for name in sorted(os.listdir(self.artifact_root)):
+            name_dir = pjoin(self.artifact_root, name)
+            if name.startswith('.') or not os.path.isdir(name_dir):
+                continue
+            for short_digest in sorted(os.listdir(name_dir)):
+                artifact_dir = pjoin(name_dir, short_digest)
+                try:
+                    with open(pjoin(artifact_dir, 'id')) as f:
+                        artifact_id = f.read().strip()
+                except IOError:
+                    # being built, or an aborted build
+                    continue
+                yield artifact_id, artifact_dir
 
     def ensure_present(self, build_spec, config, extra_env=None, virtuals=None, keep_build='never',
                        debug=False):
@@ -424,7 +542,10 @@ class BuildStore(object):
 
     def remove_build_dir(self, build_dir):
         self.logger.debug('Removing build dir: %s' % build_dir)
-        robust_rmtree(build_dir, self.logger)
+        if self.trash is not None:
+            self.trash.discard(build_dir)
+        else:
+            robust_rmtree(build_dir, self.logger)
 
     def prepare_build_dir(self, config, logger, build_spec, target_dir):
         source_cache = SourceCache.create_from_config(config, logger)
@@ -450,11 +571,16 @@ class BuildStore(object):
         to the symlink being created, it is listed in gc_roots.
 
         The symlink will be created atomically, any target
-        file/symlink will be overwritten.
+        file/symlink will be overwritten. The artifact and its
+        dependencies are restored if they were archived, since a
+        profile links to them.
         """
         # We use base64-encoding of realpath_to_symlink(symlink_target) as the name of the link within gc_roots
         symlink_target = realpath_to_symlink(symlink_target)
         artifact_dir = self.resolve(artifact_id)
+        for dep_id in self.get_dependency_closure(artifact_id):
+            if not dep_id.startswith('virtual:'):
+                self.resolve(dep_id)
         atomic_symlink(artifact_dir, symlink_target)
         root_name = self._encode_symlink(symlink_target)
         atomic_symlink(symlink_target, pjoin(self.gc_roots_dir, root_name))
@@ -470,7 +596,8 @@ class BuildStore(object):
 
         For now, this doesn't care about virtual dependencies. They're not
         used at the moment of writing this; it would have to be revisited
-        in the future.
+        in the future. Only the local store is swept; read-only stores
+        are left alone.
         """
         # mark phase
         marked = set()
@@ -487,13 +614,17 @@ class BuildStore(object):
                 with f:
                     doc = json.load(f)
                 marked.add(doc['id'])
-                marked.update(doc['dependencies'])
+                marked.update(self.get_dependency_closure(doc['id']))
         # Less confusing output if we first output all keep, then the removals
         for artifact_id in marked:
             if not artifact_id.startswith('virtual:'):
                 self.logger.info('Keeping %s' % shorten_artifact_id(artifact_id))
         # sweep phase
+        removed = []
         for artifact_name in os.listdir(self.artifact_root):
+            if artifact_name.startswith('.'):
+                # the archive index and its lock file
+                continue
             for short_digest in os.listdir(pjoin(self.artifact_root, artifact_name)):
                 artifact_dir = pjoin(self.artifact_root, artifact_name, short_digest)
                 artifact_id_file = pjoin(artifact_dir, 'id')
@@ -506,6 +637,70 @@ class BuildStore(object):
                     os.chmod(artifact_dir, 0o777)
                     os.unlink(artifact_id_file)
                     rmtree_write_protected(artifact_dir)
+                    removed.append(artifact_id)
+        self.archive_index.forget(removed)
+
+
+class TrashCan(object):
+    """Removes directories in a background thread
+
+    A directory is discarded by atomically renaming it into a fresh
+    subdirectory ``<pid>-XXXXXX`` of `trash_dir`, after which it is
+    removed by ``rm -rf`` (run under ``ionice -c 3`` when available,
+    so that it only gets idle I/O bandwidth). The thread is a daemon
+    thread, so whatever is not removed when the process exits stays in
+    the trash until :meth:`reclaim` is called by a later process.
+    """
+    def __init__(self, trash_dir, logger):
+        self.trash_dir = trash_dir
+        self.logger = logger
+        self._queue = Queue.Queue()
+        self._thread = None
+        silent_makedirs(trash_dir)
+
+    def discard(self, path):
+        entry = tempfile.mkdtemp(prefix='%d-' % os.getpid(), dir=self.trash_dir)
+        os.rename(path, pjoin(entry, os.path.basename(path)))
+        self._put(entry)
+
+    def reclaim(self):
+        """Schedules removal of leftovers of processes that are no longer running"""
+        for name in os.listdir(self.trash_dir):
+            pid = name.split('-', 1)[0]
+            if not pid.isdigit() or not _is_process_alive(int(pid)):
+                self._put(pjoin(self.trash_dir, name))
+
+    def wait(self):
+        """Waits until everything discarded so far has been removed"""
+        self._queue.join()
+
+    def _put(self, entry):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._worker)
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(entry)
+
+    def _worker(self):
+        cmd = ['rm', '-rf']
+        ionice = find_executable('ionice')
+        if ionice is not None:
+            cmd = [ionice, '-c', '3'] + cmd
+        while True:
+            entry = self._queue.get()
+            try:
+                if spawn.call(cmd + [entry]) != 0:
+                    self.logger.warning('Unable to remove path: %s' % entry)
+            finally:
+                self._queue.task_done()
+
+
+def _is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
 
 
 class ArtifactBuilder(object):
@@ -518,32 +713,26 @@ class ArtifactBuilder(object):
         self.extra_env = extra_env
         self.debug = debug
 
-    def find_complete_dependencies(self):
-        """Return set of complete dependencies of the build spec
+    def find_direct_dependencies(self):
+        """Return set of direct dependencies of the build spec
 
-        The purpose of this list is for garbage collection (currently we
-        just include everything, we could be more nuanced in the future).
+        These are the build imports, which are stored in artifact.json
+        for this build artifact. The complete (transitive) dependencies
+        are computed on demand by :meth:`BuildStore.get_dependency_closure`;
+        storing only the direct ones keeps artifact.json small for deep
+        stacks.
 
-        We simply iterate through all the build imports, load their artifact.json,
-        and return the combined result. This will in turn be stored in artifact.json
-        for this build artifact.
-
-        virtual dependencies are not searched for further child dependencies,
-        but just included directly
+        All non-virtual imports must already be present in the store.
         """
         build_imports = [entry['id'] for entry in self.build_spec.doc.get('build', {}).get('import', [])]
         deps = set()
         for artifact_id in build_imports:
             deps.add(artifact_id)
             if not artifact_id.startswith('virtual:'):
-                artifact_dir = self.build_store.resolve(artifact_id)
-                if artifact_dir is None:
+                if self.build_store.resolve(artifact_id) is None:
                     msg = 'Required artifact not already present: %s' % artifact_id
                     self.logger.error(msg)
                     raise BuildFailedError(msg, None, None)
-                with open(pjoin(artifact_dir, 'artifact.json')) as f:
-                    doc = json.load(f)
-                deps.update(doc.get('dependencies', []))
         return deps
 
     def build(self, config, keep_build):
@@ -603,7 +792,7 @@ class ArtifactBuilder(object):
 
 
     def make_artifact_json(self, artifact_dir):
-        deps = self.find_complete_dependencies()
+        deps = self.find_direct_dependencies()
         fname = pjoin(artifact_dir, 'artifact.json')
         doc = self.build_spec.doc
         artifact_doc = {'name': doc['name'], 'dependencies': sorted(list(deps)),
@@ -620,6 +809,7 @@ class ArtifactBuilder(object):
 
         os.mkdir(pjoin(build_dir, '_hashdist'))
         log_filename = pjoin(build_dir, '_hashdist', 'build.log')
+        stats_filename = pjoin(build_dir, '_hashdist', JOB_STATS_FILENAME)
         self.logger.warning('Building %s, follow log with:' % self.build_spec.short_artifact_id)
         self.logger.warning('  tail -f %s' % log_filename)
         self.logger.debug('Start log output to file %s', log_filename)
@@ -629,7 +819,8 @@ class ArtifactBuilder(object):
             try:
                 run_job.run_job(self.logger, self.build_store, job_spec,
                                 env, artifact_dir, self.virtuals, cwd=build_dir, config=config,
-                                temp_dir=job_tmp_dir, debug=self.debug)
+                                temp_dir=job_tmp_dir, debug=self.debug,
+                                stats_filename=stats_filename)
             except:
                 exc_type, exc_value, exc_tb = sys.exc_info()
                 # Python 2 'wrapped exception': We raise an exception with the same traceback
@@ -642,6 +833,14 @@ class ArtifactBuilder(object):
         log_gz_filename = pjoin(artifact_dir, 'build.log.gz')
         with allow_writes(artifact_dir):
             gzip_compress(log_filename, log_gz_filename)
+            if os.path.exists(stats_filename):
+                # next to build.log.gz, out of the way of the usual '*/**/*'
+                # profile link rule; but a profile may still have linked in
+                # the one of another artifact
+                artifact_stats_filename = pjoin(artifact_dir, JOB_STATS_FILENAME)
+                silent_unlink(artifact_stats_filename)
+                shutil.copy(stats_filename, artifact_stats_filename)
+                write_protect(artifact_stats_filename)
         write_protect(log_gz_filename)
 
 def unpack_sources(logger, source_cache, doc, target_dir):
@@ -20,6 +20,7 @@ import subprocess
 from .common import json_formatting_options
 from .build_store import BuildStore
 from .fileutils import rmdir_empty_up_to, write_protect, silent_unlink
+from . import spawn
 
 def execute_files_dsl(files, env):
     """
@@ -184,7 +185,7 @@ def _check_call(logger, cmd):
     """
     Like subprocess.check_call but additionally captures stdout/stderr, and returns stdout.
     """
-    p = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+    p = spawn.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
     out, err = p.communicate()
     if p.wait() != 0:
         logger.error('%r failed: %d' % (cmd, p.wait()))
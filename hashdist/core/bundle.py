@@ -0,0 +1,244 @@
+"""
+:mod:`hashdist.core.bundle` --- Exporting artifact closures as bundles
+======================================================================
+
+A bundle is a single (compressed) tar stream containing a set of
+artifacts, typically a profile artifact together with every artifact
+it (transitively) depends on. It is used to deploy a profile into
+another build store (e.g., on compute nodes) without copying a
+symlink-heavy tree with rsync.
+
+Each artifact is stored beneath its path relative to the artifact root
+of the build store (``name/shorthash/...``), so that the relative
+symlinks of a profile remain valid after import. Within each artifact
+the ``id`` file is written last; since an artifact is only considered
+present once its ``id`` file exists, a partial import never leaves a
+valid-looking artifact behind.
+
+Both export and import are streaming: directories are walked and the
+tar stream is read one entry at a time, so memory use does not grow
+with the number of files in an artifact. Compression is done by
+``pigz`` when it is available (using several cores), and by the
+:mod:`gzip` module otherwise.
+"""
+
+import os
+from os.path import join as pjoin
+import shutil
+import subprocess
+import tarfile
+from contextlib import closing
+
+from .common import IllegalBuildStoreError
+from .fileutils import rmtree_write_protected, silent_makedirs, find_executable
+from . import spawn
+
+PIGZ = 'pigz'
+
+def get_artifact_closure(build_store, artifact_id):
+    """
+    Returns the artifact IDs that `artifact_id` depends on, including
+    `artifact_id` itself. Virtual dependencies are left out.
+    """
+    deps = [dep for dep in build_store.get_dependency_closure(artifact_id)
+            if not dep.startswith('virtual:')]
+    return [artifact_id] + sorted(deps)
+
+
+class CompressedWriter(object):
+    """Writes a tar stream, compressing with pigz if available"""
+    def __init__(self, stream, jobs):
+        pigz = find_executable(PIGZ)
+        if pigz is not None:
+            self.proc = spawn.Popen([pigz, '-c', '-p', str(jobs)],
+                                    stdin=subprocess.PIPE, stdout=stream)
+            self.tar = tarfile.open(fileobj=self.proc.stdin, mode='w|')
+        else:
+            self.proc = None
+            self.tar = tarfile.open(fileobj=stream, mode='w|gz')
+
+    def close(self):
+        self.tar.close()
+        if self.proc is not None:
+            self.proc.stdin.close()
+            if self.proc.wait() != 0:
+                raise IOError('%s failed with code %d' % (PIGZ, self.proc.returncode))
+
+
+class CompressedReader(object):
+    """Reads a tar stream, decompressing with pigz if available"""
+    def __init__(self, stream):
+        pigz = find_executable(PIGZ)
+        if pigz is not None:
+            self.proc = spawn.Popen([pigz, '-d', '-c'], stdin=stream,
+                                    stdout=subprocess.PIPE)
+            self.tar = tarfile.open(fileobj=self.proc.stdout, mode='r|')
+        else:
+            self.proc = None
+            self.tar = tarfile.open(fileobj=stream, mode='r|gz')
+
+    def close(self):
+        self.tar.close()
+        if self.proc is not None:
+            self.proc.stdout.close()
+            if self.proc.wait() != 0:
+                raise IOError('%s failed with code %d' % (PIGZ, self.proc.returncode))
+
+
+def export_bundle(logger, build_store, artifact_ids, stream, jobs=1):
+    """
+    Writes the artifacts `artifact_ids` as a bundle to `stream`.
+
+    Parameters
+    ----------
+
+    logger : Logger
+
+    build_store : BuildStore
+        The store the artifacts are read from.
+
+    artifact_ids : list of str
+        The artifacts to export; normally the result of
+        :func:`get_artifact_closure`.
+
+    stream : file-like
+        Where to write the compressed tar stream.
+
+    jobs : int
+        Number of compression threads (only used with pigz).
+    """
+    writer = CompressedWriter(stream, jobs)
+    tar = writer.tar
+    try:
+        for artifact_id in artifact_ids:
+            artifact_dir = build_store.resolve(artifact_id)
+            if artifact_dir is None:
+                raise IllegalBuildStoreError('Artifact not present: %s' % artifact_id)
+            logger.info('Exporting %s' % artifact_id)
+            arc_root = os.path.relpath(artifact_dir, build_store.artifact_root)
+            for dirpath, dirnames, filenames in os.walk(artifact_dir):
+                dirnames.sort()
+                rel_dirpath = os.path.relpath(dirpath, artifact_dir)
+                arc_dirpath = os.path.normpath(pjoin(arc_root, rel_dirpath))
+                tar.add(dirpath, arc_dirpath, recursive=False)
+                for fname in sorted(filenames):
+                    if dirpath == artifact_dir and fname == 'id':
+                        continue
+                    tar.add(pjoin(dirpath, fname), pjoin(arc_dirpath, fname), recursive=False)
+            tar.add(pjoin(artifact_dir, 'id'), pjoin(arc_root, 'id'))
+            # Hard links are only recorded within a single artifact, as the
+            # importing store may already have the artifact they point into.
+            # Also drop the member list, which tarfile keeps for the whole stream.
+            tar.inodes.clear()
+            tar.members = []
+    finally:
+        writer.close()
+
+
+def import_bundle(logger, build_store, stream):
+    """
+    Unpacks a bundle written by :func:`export_bundle` into `build_store`.
+
+    Artifacts already present in the store are skipped. An artifact
+    directory without an ``id`` file, left behind by an interrupted build
+    or import, is removed and imported again. The ``id`` file of each imported artifact is written last,
+    through a rename, just like when building.
+
+    Returns
+    -------
+
+    (imported, skipped) : lists of artifact directories relative to the
+    artifact root
+    """
+    reader = CompressedReader(stream)
+    imported = []
+    skipped = []
+    state = dict(arc_root=None, artifact_dir=None, dir_modes=[])
+
+    def finish_artifact():
+        artifact_dir = state['artifact_dir']
+        if artifact_dir is None:
+            return
+        if not os.path.exists(pjoin(artifact_dir, '_id')):
+            raise IllegalBuildStoreError('Bundle entry for %s is incomplete' % state['arc_root'])
+        # Set directory modes bottom-up, since they may be write-protected;
+        # the artifact directory itself must stay writable until 'id' is in place
+        dir_modes = dict(state['dir_modes'])
+        for path in sorted(dir_modes.keys(), reverse=True):
+            if path != artifact_dir:
+                os.chmod(path, dir_modes[path])
+        os.rename(pjoin(artifact_dir, '_id'), pjoin(artifact_dir, 'id'))
+        if artifact_dir in dir_modes:
+            os.chmod(artifact_dir, dir_modes[artifact_dir])
+        imported.append(state['arc_root'])
+        state['artifact_dir'] = None
+
+    def start_artifact(arc_root):
+        finish_artifact()
+        state.update(arc_root=arc_root, artifact_dir=None, dir_modes=[])
+        artifact_dir = pjoin(build_store.artifact_root, arc_root)
+        if os.path.exists(pjoin(artifact_dir, 'id')):
+            logger.info('Already present, skipping: %s' % arc_root)
+            skipped.append(arc_root)
+            return
+        if os.path.lexists(artifact_dir):
+            logger.warning('Removing incomplete artifact: %s' % arc_root)
+            rmtree_write_protected(artifact_dir)
+        logger.info('Importing %s' % arc_root)
+        os.makedirs(artifact_dir)
+        state['artifact_dir'] = artifact_dir
+
+    tar = reader.tar
+    try:
+        try:
+            for member in tar:
+                parts = member.name.split('/')
+                if len(parts) < 2 or '..' in parts or os.path.isabs(member.name):
+                    raise IllegalBuildStoreError('Illegal path in bundle: %s' % member.name)
+                arc_root = '/'.join(parts[:2])
+                if arc_root != state['arc_root']:
+                    start_artifact(arc_root)
+                if state['artifact_dir'] is not None:
+                    if parts[2:] == ['id']:
+                        parts[2] = '_id'
+                    extract_member(tar, member, state['artifact_dir'], parts[2:],
+                                    state['dir_modes'])
+                tar.members = []
+            finish_artifact()
+        except:
+            if state['artifact_dir'] is not None:
+                rmtree_write_protected(state['artifact_dir'])
+            raise
+    finally:
+        reader.close()
+    return imported, skipped
+
+
+def extract_member(tar, member, artifact_dir, rel_parts, dir_modes):
+    """
+    Extracts `member` of the tar stream `tar` to the path `rel_parts`
+    within `artifact_dir`. Hard links are resolved within `artifact_dir`.
+    Directories are created writable; their modes are appended to
+    `dir_modes` as (path, mode), to be applied once all entries are
+    extracted.
+    """
+    path = pjoin(artifact_dir, *rel_parts)
+    mode = member.mode & 0o7777
+    if member.isdir():
+        silent_makedirs(path)
+        dir_modes.append((path, mode))
+    elif member.issym():
+        os.symlink(member.linkname, path)
+    elif member.islnk():
+        link_parts = member.linkname.split('/')[2:]
+        os.link(pjoin(artifact_dir, *link_parts), path)
+    elif member.isfile():
+        src = tar.extractfile(member)
+        fd = os.open(path, os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0o600)
+        with closing(src):
+            with os.fdopen(fd, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.chmod(path, mode)
+        os.utime(path, (member.mtime, member.mtime))
+    else:
+        raise IllegalBuildStoreError('Unsupported entry type in bundle: %s' % member.name)
@@ -0,0 +1,176 @@
+"""
+:mod:`hashdist.core.dedup` --- Hard-linking identical files in the build store
+==============================================================================
+
+Many artifacts contain identical files: headers vendored into several
+packages, documentation, license files, the same Python sources built
+with different parameters, and so on. Since artifacts are
+write-protected once built and never modified afterwards, identical
+files can share a single inode.
+
+:func:`dedup_store` walks the complete artifacts (those with an ``id``
+file) of the local build store and replaces every regular file by a
+hard link to the first file found with the same contents, device,
+mode and owner. Only write-protected files are considered, and empty
+files are left alone.
+
+The SHA-256 digests of the files are kept in a :class:`DiskCache`, in
+one table per artifact, keyed by the relative path and checked
+against the size and modification time of the file; so after the
+first run only the ``stat`` calls of the walk remain.
+
+A file is replaced by first linking the canonical file to a temporary
+name (starting with ``.hashdist-dedup-``) in the same directory, and
+then renaming that over the file. An interrupted run thus leaves every
+file with either its old or its new inode; at worst, if the process is
+killed in between the two steps, a temporary link is left behind,
+which is removed on the next run.
+"""
+
+import os
+from os.path import join as pjoin
+import errno
+import stat
+import hashlib
+
+from .hasher import format_digest
+
+_CACHE_DOMAIN = 'hashdist.core.dedup'
+
+TEMP_PREFIX = '.hashdist-dedup-'
+
+def _file_digest(filename, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return format_digest(h)
+
+def _allow_dir_writes(dirpath):
+    """Makes `dirpath` writable by the owner, returns the old mode"""
+    mode = os.stat(dirpath).st_mode
+    os.chmod(dirpath, mode | stat.S_IWUSR)
+    return mode
+
+def _remove_temp_link(filename):
+    dirpath = os.path.dirname(filename)
+    old_mode = _allow_dir_writes(dirpath)
+    try:
+        os.unlink(filename)
+    finally:
+        os.chmod(dirpath, old_mode)
+
+def _replace_with_link(source, target):
+    """Atomically replaces `target` with a hard link to `source`"""
+    dirpath, basename = os.path.split(target)
+    temp_name = pjoin(dirpath, TEMP_PREFIX + basename)
+    old_mode = _allow_dir_writes(dirpath)
+    try:
+        if os.path.lexists(temp_name):
+            os.unlink(temp_name)
+        os.link(source, temp_name)
+        try:
+            os.rename(temp_name, target)
+        except:
+            os.unlink(temp_name)
+            raise
+    finally:
+        os.chmod(dirpath, old_mode)
+
+
+class _ArtifactTable(object):
+    """The cached digests of the files in one artifact"""
+    def __init__(self, cache, artifact_id):
+        self.cache = cache
+        self.artifact_id = artifact_id
+        self.entries = dict(cache.get(_CACHE_DOMAIN, artifact_id, {}))
+        self.modified = False
+
+    def get_digest(self, relpath, filename, st):
+        entry = self.entries.get(relpath)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime):
+            return entry[2]
+        digest = _file_digest(filename)
+        self.set_digest(relpath, st, digest)
+        return digest
+
+    def set_digest(self, relpath, st, digest):
+        self.entries[relpath] = (st.st_size, st.st_mtime, digest)
+        self.modified = True
+
+    def save(self):
+        if self.modified:
+            self.cache.put(_CACHE_DOMAIN, self.artifact_id, self.entries)
+            self.modified = False
+
+
+def dedup_store(logger, build_store, cache):
+    """
+    Hard-links identical files in the local store of `build_store`
+    (read-only stores are left alone). See module docstring.
+
+    Returns
+    -------
+
+    (linked, bytes_saved) : the number of files replaced by a hard
+    link, and the disk space that was freed by it
+    """
+    # group the candidate files by what must be equal for them to share an inode
+    groups = {}
+    tables = {}
+    for artifact_id, artifact_dir in build_store.iter_artifacts():
+        tables[artifact_id] = _ArtifactTable(cache, artifact_id)
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            dirnames.sort()
+            for fname in sorted(filenames):
+                filename = pjoin(dirpath, fname)
+                if fname.startswith(TEMP_PREFIX):
+                    logger.info('Removing leftover %s' % filename)
+                    _remove_temp_link(filename)
+                    continue
+                st = os.lstat(filename)
+                if (not stat.S_ISREG(st.st_mode) or st.st_size == 0
+                    or st.st_mode & 0o222):
+                    continue
+                group_key = (st.st_dev, st.st_size, st.st_mode, st.st_uid, st.st_gid)
+                relpath = filename[len(artifact_dir) + 1:]
+                groups.setdefault(group_key, []).append((artifact_id, relpath, filename, st))
+
+    linked = bytes_saved = 0
+    try:
+        for group_key in sorted(groups):
+            members = groups[group_key]
+            if len(set(st.st_ino for _, _, _, st in members)) < 2:
+                continue
+            canonical = {}  # digest -> (filename, st)
+            for artifact_id, relpath, filename, st in members:
+                table = tables[artifact_id]
+                digest = table.get_digest(relpath, filename, st)
+                if digest not in canonical:
+                    canonical[digest] = (filename, st)
+                    continue
+                source, source_st = canonical[digest]
+                if source_st.st_ino == st.st_ino:
+                    continue
+                # only the last link of an inode frees its space
+                freed = os.lstat(filename).st_nlink == 1
+                try:
+                    _replace_with_link(source, filename)
+                except OSError as e:
+                    if e.errno != errno.EMLINK:
+                        raise
+                    # too many links to source; link the next ones to this file
+                    canonical[digest] = (filename, st)
+                    continue
+                table.set_digest(relpath, source_st, digest)
+                linked += 1
+                if freed:
+                    bytes_saved += st.st_size
+    finally:
+        for table in tables.itervalues():
+            table.save()
+    logger.info('Linked %d files, saving %d bytes' % (linked, bytes_saved))
+    return linked, bytes_saved
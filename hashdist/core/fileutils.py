@@ -66,6 +66,15 @@ def silent_unlink(path):
             raise
 
 
+def find_executable(name):
+    """Returns the full path of executable `name` found on PATH, or None"""
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = pjoin(d, name)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
 def robust_rmtree(path, logger=None, max_retries=6):
     """Robustly tries to delete paths.
 
@@ -175,14 +184,15 @@ def write_allow(path):
 def rmtree_write_protected(rootpath):
     """
     Like shutil.rmtree, but removes files/directories that are write-protected.
+
+    Only the directories are made writable; the mode of files is left
+    alone, since they may be hard-linked from elsewhere (see
+    :mod:`hashdist.core.dedup`).
     """
     for dirpath, dirnames, filenames in os.walk(rootpath, followlinks=False, topdown=False):
         os.chmod(dirpath, 0o777)
         for fname in filenames:
-            qname = pjoin(dirpath, fname)
-            if not os.path.islink(qname):
-                os.chmod(qname, 0o777)
-            os.unlink(qname)
+            os.unlink(pjoin(dirpath, fname))
         for fname in dirnames:
             qname = pjoin(dirpath, fname)
             if os.path.islink(qname):
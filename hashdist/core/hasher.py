@@ -4,7 +4,7 @@
 
 """
 
-import json
+from json.encoder import encode_basestring_ascii
 import hashlib
 import base64
 import struct
@@ -26,7 +26,148 @@ def check_no_floating_point(doc):
     elif isinstance(doc, (int, bool, basestring)) or doc is None:
         pass
 
-def hash_document(doctype, doc):
+def _frozen_error(self, *args, **kw):
+    raise TypeError('frozen document cannot be modified')
+
+class frozen_dict(dict):
+    """
+    A dict that cannot be modified, created by :func:`freeze_document`.
+    Its contribution to :func:`hash_document` and :class:`DocumentSerializer`
+    streams is computed once and cached.
+    """
+    __slots__ = ('_stream_cache',)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _frozen_error
+
+    def __reduce__(self):
+        return (frozen_dict, (dict(self),))
+
+class frozen_list(list):
+    """
+    A list that cannot be modified, created by :func:`freeze_document`.
+    See :class:`frozen_dict`.
+    """
+    __slots__ = ('_stream_cache',)
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = __imul__ = _frozen_error
+    append = extend = insert = pop = remove = reverse = sort = _frozen_error
+
+    def __reduce__(self):
+        return (frozen_list, (list(self),))
+
+_frozen_types = (frozen_dict, frozen_list)
+
+def freeze_document(doc):
+    """
+    Returns `doc` with every dict and list (or tuple) replaced by a
+    :class:`frozen_dict` or :class:`frozen_list`, which hash identically.
+    Use this for fragments that are shared between many documents, so
+    that they are only serialized once.
+    """
+    if type(doc) in _frozen_types:
+        return doc
+    elif isinstance(doc, dict):
+        return frozen_dict((key, freeze_document(value)) for key, value in doc.iteritems())
+    elif isinstance(doc, (list, tuple)):
+        return frozen_list(freeze_document(child) for child in doc)
+    else:
+        return doc
+
+def _cached_stream(frozen, key, write):
+    """
+    Returns what ``write(frozen, update)`` feeds to `update`, cached on
+    `frozen` under `key`.
+    """
+    try:
+        cache = frozen._stream_cache
+    except AttributeError:
+        cache = frozen._stream_cache = {}
+    try:
+        return cache[key]
+    except KeyError:
+        parts = []
+        write(frozen, parts.append)
+        result = cache[key] = ''.join(parts)
+        return result
+
+def _encode_canonical_json(doc, skip_nohash, update):
+    """
+    Feeds the compact, sorted-key JSON encoding of `doc` to `update`, exactly
+    as ``json.dumps(doc, sort_keys=True, separators=(',', ':'))`` would
+    produce it, in a single traversal. The output is passed on in chunks of a few kilobytes.
+    """
+    parts = []
+    append = parts.append
+
+    def key_to_json(key):
+        if isinstance(key, basestring):
+            return encode_basestring_ascii(key)
+        elif skip_nohash:
+            raise TypeError('document contains illegal key type %r' % type(key))
+        elif key is True:
+            return '"true"'
+        elif key is False:
+            return '"false"'
+        elif key is None:
+            return '"null"'
+        elif isinstance(key, float):
+            raise TypeError("floating-point number not allowed in document")
+        elif isinstance(key, (int, long)):
+            return '"%s"' % str(key)
+        else:
+            raise TypeError("key %r is not a string" % (key,))
+
+    def encode(x):
+        if isinstance(x, basestring):
+            append(encode_basestring_ascii(x))
+        elif type(x) in _frozen_types and x is not doc:
+            append(_cached_stream(x, ('json', skip_nohash), encode_frozen))
+        elif x is None:
+            append('null')
+        elif x is True:
+            append('true')
+        elif x is False:
+            append('false')
+        elif isinstance(x, (int, long)):
+            append(str(x))
+        elif isinstance(x, dict):
+            keys = sorted(x)
+            if skip_nohash:
+                keys = [key for key in keys
+                        if not (isinstance(key, basestring) and key.startswith('nohash_'))]
+            sep = '{'
+            for key in keys:
+                append(sep)
+                append(key_to_json(key))
+                append(':')
+                encode(x[key])
+                sep = ','
+            append('}' if keys else '{}')
+            if len(parts) > 4096:
+                update(''.join(parts))
+                del parts[:]
+        elif isinstance(x, (list, tuple)):
+            sep = '['
+            for child in x:
+                append(sep)
+                encode(child)
+                sep = ','
+            append(']' if x else '[]')
+            if len(parts) > 4096:
+                update(''.join(parts))
+                del parts[:]
+        elif isinstance(x, float):
+            raise TypeError("floating-point number not allowed in document")
+        else:
+            raise TypeError('document contains illegal type %r' % type(x))
+
+    def encode_frozen(frozen, update):
+        _encode_canonical_json(frozen, skip_nohash, update)
+
+    encode(doc)
+    update(''.join(parts))
+
+def hash_document(doctype, doc, skip_nohash=False):
     """
     Computes a hash from a document. This is done by serializing to as
     compact JSON as possible with sorted keys, then perform sha256
@@ -44,12 +185,12 @@ def hash_document(doctype, doc):
     Floating-point numbers are not supported (these have multiple
     representations).
 
+    If `skip_nohash` is set, the document is hashed as if
+    :func:`prune_nohash` had been applied to it first, without
+    making the copy.
     """
-    check_no_floating_point(doc)
-    serialized = json.dumps(doc, indent=None, sort_keys=True, separators=(',', ':'), encoding='utf-8',
-                            ensure_ascii=True, allow_nan=False)
     h = hashlib.sha256(doctype + '|')
-    h.update(serialized)
+    _encode_canonical_json(doc, skip_nohash, h.update)
     return format_digest(h)
 
 def prune_nohash(doc):
@@ -162,19 +303,10 @@ class DocumentSerializer(object):
             s = str(x)
             w.update('I%d:' % len(s))
             w.update(s)
-        elif isinstance(x, (list, tuple)):
-            w.update('L%d:' % len(x))
-            for child in x:
-                self.update(child)
-        elif isinstance(x, dict):
-            w.update('D%d:' % len(x))
-            keys = x.keys()
-            indices = argsort(keys)
-            for i in indices:
-                if not isinstance(keys[i], (str, unicode)):
-                    raise NotImplementedError('hashing of dict with non-string key')
-                self.update(keys[i])
-                self.update(x[keys[i]])
+        elif type(x) in _frozen_types:
+            w.update(_cached_stream(x, 'serialized', _serialize_frozen))
+        elif isinstance(x, (list, tuple, dict)):
+            self._update_container(x)
         elif x is True:
             w.update('T')
         elif x is False:
@@ -197,6 +329,29 @@ class DocumentSerializer(object):
             w.update('B%d:' % len(buf))
             w.update(buf)
 
+    def _update_container(self, x):
+        w = self._wrapped
+        if isinstance(x, (list, tuple)):
+            w.update('L%d:' % len(x))
+            for child in x:
+                self.update(child)
+        else:
+            w.update('D%d:' % len(x))
+            keys = x.keys()
+            indices = argsort(keys)
+            for i in indices:
+                if not isinstance(keys[i], (str, unicode)):
+                    raise NotImplementedError('hashing of dict with non-string key')
+                self.update(keys[i])
+                self.update(x[keys[i]])
+
+class _UpdateSink(object):
+    def __init__(self, update):
+        self.update = update
+
+def _serialize_frozen(frozen, update):
+    DocumentSerializer(_UpdateSink(update))._update_container(frozen)
+
 class Hasher(DocumentSerializer):
     """
     Cryptographically hashes buffers or nested objects ("JSON-like" object structures).
@@ -159,6 +159,39 @@ with the job runner:
 
 
 
+Resource usage
+--------------
+
+For every `cmd` and `hit` node, the job runner records the wall time,
+user and system CPU time, peak resident set size, bytes read from and
+written to storage, and exit code, keyed by the position of the node
+(e.g. ``"2.0"`` for the first command in the second command node, as
+:func:`run_job` inserts a node setting ``$ARTIFACT`` first). For
+`cmd` the figures are those of the process (and the processes it
+waited for), as reported by ``wait4()``; for `hit`, which runs in the
+job runner itself, they are the difference in ``getrusage()`` of the
+job runner and its children, except that the peak resident set size
+is that of the job runner so far. Bytes read and written are counted
+by the kernel in blocks of 512 bytes, and exclude what was served from
+or left in the page cache. An example of the resulting document,
+which can be written to a file by :func:`run_job`:
+
+.. code-block:: python
+
+    {
+        "commands": {
+            "1": {"type": "hit", "args": ["build-write-files", ...],
+                  "wall_time": 0.004, "user_time": 0.003, "sys_time": 0.001,
+                  "max_rss_kb": 24016, "read_bytes": 0, "write_bytes": 4096,
+                  "exit_code": 0},
+            "2": {"type": "cmd", "args": ["/bin/bash", "_hashdist/build.sh"],
+                  ...}
+        }
+    }
+
+If a command could not be started, its exit code is ``null``.
+
+
 Virtual imports
 ---------------
 
@@ -197,16 +230,21 @@ from pprint import pformat
 import tempfile
 import errno
 import select
+import signal
+import time
+import resource
+from contextlib import contextmanager
 from StringIO import StringIO
 import json
 from pprint import pprint
 
 from logging import CRITICAL, ERROR, WARNING, INFO, DEBUG
-from hashdist.util.logger_setup import suppress_log_info, sublevel_added
+from hashdist.util.logger_setup import suppress_log_info, log_lines
 
-from .common import working_directory
+from .common import working_directory, json_formatting_options
+from . import spawn
 
-LOG_PIPE_BUFSIZE = 4096
+LOG_PIPE_BUFSIZE = 65536
 
 
 class InvalidJobSpecError(ValueError):
@@ -275,7 +313,7 @@ def handle_imports(logger, build_store, artifact_dir, virtuals, job_spec):
     return env, result
 
 def run_job(logger, build_store, job_spec, override_env, artifact_dir, virtuals, cwd, config,
-            temp_dir=None, debug=False):
+            temp_dir=None, debug=False, stats_filename=None):
     """Runs a job in a controlled environment, according to rules documented above.
 
     Parameters
@@ -316,6 +354,10 @@ def run_job(logger, build_store, job_spec, override_env, artifact_dir, virtuals,
     debug : bool
         Whether to run in debug mode.
 
+    stats_filename : str (optional)
+        If given, the resource usage of the commands (see above) is
+        written to this file as JSON, also if the job fails.
+
     Returns
     -------
 
@@ -342,6 +384,10 @@ def run_job(logger, build_store, job_spec, override_env, artifact_dir, virtuals,
         executor.run_command_list(assembled_commands, env, ())
     finally:
         executor.close()
+        if stats_filename is not None:
+            with open(stats_filename, 'w') as f:
+                json.dump({'commands': executor.job_stats}, f, **json_formatting_options)
+                f.write('\n')
     return executor.last_env
 
 def canonicalize_job_spec(job_spec):
@@ -417,6 +463,8 @@ class CommandTreeExecution(object):
             self.rm_temp_dir = False
         self.temp_dir = temp_dir
         self.last_env = None
+        self.job_stats = {} # { node_pos string : resource usage of a cmd/hit node }
+        self._last_proc = None
 
     def close(self):
         """Removes log FIFOs; should always be called when one is done
@@ -574,37 +622,83 @@ class CommandTreeExecution(object):
                 raise TypeError("'%s' arguments must be a list, got %r" % (key, args))
             args = [self.substitute(x, node_env) for x in args]
 
-            if 'to_var' in node:
-                stdout = StringIO()
-                func(args, node_env, stdout_to=stdout)
-                # modifying env, not node_env, to export change
-                env[node['to_var']] = stdout.getvalue().strip()
-
-            elif 'append_to_file' in node:
-                stdout_filename = self.substitute(node['append_to_file'], node_env)
-                if not os.path.isabs(stdout_filename):
-                    stdout_filename = pjoin(env['PWD'], stdout_filename)
-                stdout_filename = os.path.realpath(stdout_filename)
-                if stdout_filename.startswith(self.temp_dir):
-                    raise NotImplementedError("Cannot currently use stream re-direction to write to "
-                                              "a log-pipe (doing the write from a "
-                                              "sub-process is OK)")
-                with file(stdout_filename, 'a') as stdout:
-                    func(args, node_env, stdout_to=stdout)
-
-            else:
-                # does not capture output, so we may decide to debug instead;
-                # debug is not possible when capturing output (until that mechanism
-                # is changed...)
-                if self.debug:
-                    debug_func(args, node_env)
-                else:
-                    func(args, node_env)
+            self._last_proc = None
+            start_time = time.time()
+            start_usage = _get_usage()
+            exit_code = 0
+            try:
+                self._run_command_node(node, env, node_env, args, func, debug_func)
+            except SystemExit, e:
+                exit_code = e.code if isinstance(e.code, int) else 1
+                raise
+            except:
+                exit_code = 1
+                raise
+            finally:
+                self.record_stats(node_pos, key, args, start_time, start_usage, exit_code)
         else:
             assert False
 
         self.last_env = dict(node_env)
 
+    def _run_command_node(self, node, env, node_env, args, func, debug_func):
+        if 'to_var' in node:
+            stdout = StringIO()
+            func(args, node_env, stdout_to=stdout)
+            # modifying env, not node_env, to export change
+            env[node['to_var']] = stdout.getvalue().strip()
+
+        elif 'append_to_file' in node:
+            stdout_filename = self.substitute(node['append_to_file'], node_env)
+            if not os.path.isabs(stdout_filename):
+                stdout_filename = pjoin(env['PWD'], stdout_filename)
+            stdout_filename = os.path.realpath(stdout_filename)
+            if stdout_filename.startswith(self.temp_dir):
+                raise NotImplementedError("Cannot currently use stream re-direction to write to "
+                                          "a log-pipe (doing the write from a "
+                                          "sub-process is OK)")
+            with file(stdout_filename, 'a') as stdout:
+                func(args, node_env, stdout_to=stdout)
+
+        else:
+            # does not capture output, so we may decide to debug instead;
+            # debug is not possible when capturing output (until that mechanism
+            # is changed...)
+            if self.debug:
+                debug_func(args, node_env)
+            else:
+                func(args, node_env)
+
+    def record_stats(self, node_pos, key, args, start_time, start_usage, exit_code):
+        """Records the resource usage of a cmd or hit node; see module docstring"""
+        wall_time = time.time() - start_time
+        ru = None
+        if key == 'cmd':
+            # the exit code of the process, or None if it could not be started
+            proc = self._last_proc
+            exit_code = proc.returncode if proc is not None else None
+            ru = proc.rusage if proc is not None else None
+        if ru is not None:
+            user_time, sys_time = ru.ru_utime, ru.ru_stime
+            max_rss_kb = _max_rss_kb(ru)
+            read_blocks, write_blocks = ru.ru_inblock, ru.ru_oublock
+        else:
+            end_usage = _get_usage()
+            user_time, sys_time, read_blocks, write_blocks = [
+                end - start for start, end in zip(start_usage[:4], end_usage[:4])]
+            max_rss_kb = end_usage[4]
+        self.job_stats['.'.join(str(i) for i in node_pos)] = {
+            'type': key,
+            'args': args,
+            'wall_time': round(wall_time, 3),
+            'user_time': round(user_time, 3),
+            'sys_time': round(sys_time, 3),
+            'max_rss_kb': max_rss_kb,
+            'read_bytes': read_blocks * 512,
+            'write_bytes': write_blocks * 512,
+            'exit_code': exit_code,
+            }
+
     def handle_commands(self, node, env, node_pos):
         sub_env = dict(env)
         self.run_command_list(node['commands'], sub_env, node_pos)
@@ -679,7 +773,8 @@ class CommandTreeExecution(object):
                 sys.stderr.write('  %s\n' % args)
                 sys.stderr.write('\n')
                 sys.stderr.write('When you are done, "exit 1" to abort build, or "exit 0" to continue.\n\n')
-                proc = subprocess.Popen(['env', '-i', self.debug_shell, '--noprofile', '--rcfile', rcfile])
+                proc = spawn.Popen(['env', '-i', self.debug_shell, '--noprofile', '--rcfile', rcfile])
+                self._last_proc = proc
                 retcode = proc.wait()
                 if retcode != 0:
                     self.logger.error("Debug build manually aborted")
@@ -695,13 +790,13 @@ class CommandTreeExecution(object):
         """
         logger = self.logger
         try:
-            proc = subprocess.Popen(args,
-                                    cwd=env['PWD'],
-                                    env=env,
-                                    stdin=subprocess.PIPE,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    close_fds=True)
+            proc = spawn.Popen(args,
+                               cwd=env['PWD'],
+                               env=env,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               close_fds=True)
         except OSError, e:
             if e.errno == errno.ENOENT:
                 # fix error message up a bit since the situation is so confusing
@@ -713,6 +808,7 @@ class CommandTreeExecution(object):
                 raise OSError(e.errno, msg)
             else:
                 raise
+        self._last_proc = proc
 
         if 'linux' in sys.platform and not _TEST_LOG_PROCESS_SIMPLE:
             retcode = self._log_process_with_logpipes(proc, stdout_to)
@@ -735,21 +831,38 @@ class CommandTreeExecution(object):
             fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
 
         buffers = {stdout_fd: '', stderr_fd: ''}
-        while True:
-            select.select(fds, [], [], 0.05)
-            for fd in fds:
+        with _child_exit_wakeup_fd() as wakeup_fd:
+            child_exited = proc.poll() is not None
+            while fds:
+                if child_exited:
+                    timeout = 0 # only read what is left
+                elif wakeup_fd is None:
+                    timeout = 0.05
+                else:
+                    timeout = None
                 try:
-                    s = os.read(fd, LOG_PIPE_BUFSIZE)
-                except IOError, e:
-                    if e.errno != errno.EAGAIN:
-                        raise
-                    s = ''
-                except OSError, e:
-                    if e.errno != errno.EAGAIN:
+                    readable, _, _ = select.select(fds + [wakeup_fd] if wakeup_fd is not None else fds,
+                                                   [], [], timeout)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
                         raise
-                    s = ''
-                if s != '':
-                    if stdout_to is not None and fd == stdout_fd:
+                    continue
+                if not readable and (child_exited or proc.poll() is not None):
+                    break
+                for fd in readable:
+                    if fd == wakeup_fd:
+                        _drain_pipe(wakeup_fd)
+                        child_exited = proc.poll() is not None
+                        continue
+                    try:
+                        s = os.read(fd, LOG_PIPE_BUFSIZE)
+                    except (IOError, OSError), e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                        continue
+                    if s == '':
+                        fds.remove(fd)
+                    elif stdout_to is not None and fd == stdout_fd:
                         # Just forward
                         stdout_to.write(s)
                     else:
@@ -760,15 +873,10 @@ class CommandTreeExecution(object):
                             del lines[-1]
                         else:
                             buffers[fd] = ''
-                        for line in lines:
-                            if line[-1] == '\n':
-                                line = line[:-1]
-                            if encoding:
-                                logger.info(line.decode(encoding))
-                            else:
-                                logger.info(line)
-            if proc.poll() is not None:
-                break
+                        lines = [line[:-1] if line[-1] == '\n' else line for line in lines]
+                        if encoding:
+                            lines = [line.decode(encoding) for line in lines]
+                        log_lines(logger, INFO, lines)
         for buf in buffers.values():
             if buf != '':
                 logger.info(buf)
@@ -812,8 +920,7 @@ class CommandTreeExecution(object):
             if buf:
                 # flush buffer in case last line not terminated by '\n'
                 header, level = loggers[fd]
-                with sublevel_added(logger, header):
-                    logger.log(level, buf)
+                log_lines(logger, level, [buf], header)
             del buffers[fd]
 
         def close_fifo(fd):
@@ -832,49 +939,64 @@ class CommandTreeExecution(object):
         for (header, level), fifo_filename in self.log_fifo_filenames.items():
             open_fifo(fifo_filename, header, level)
 
-        while True:
-            # Python poll() doesn't return when SIGCHLD is received;
-            # and there's the freak case where a process first
-            # terminates stdout/stderr, then trying to write to a log
-            # pipe, so we should track child termination the proper
-            # way. Being in Python, it's easiest to just poll every
-            # 50 ms; the majority of the time is spent in poll() so
-            # it doesn't really increase log message latency
-            events = poller.poll(50)
-            if len(events) == 0:
-                if proc.poll() is not None:
-                    break # child terminated
-            for fd, reason in events:
-                if reason & select.POLLHUP and not (reason & select.POLLIN):
-                    # we want to continue receiving PULLHUP|POLLIN until all
-                    # is read
-                    if fd in fd_to_logpipe:
-                        reopen_fifo(fd)
-                    elif fd in (stdout_fd, stderr_fd):
-                        poller.unregister(fd)
-                elif reason & select.POLLIN:
-                    if stdout_to is not None and fd == stdout_fd:
-                        # Just forward
-                        buf = os.read(fd, LOG_PIPE_BUFSIZE)
-                        stdout_to.write(buf)
-                    else:
-                        # append new bytes to what's already been read on this fd; and
-                        # emit any completed lines
-                        new_bytes = os.read(fd, LOG_PIPE_BUFSIZE)
-                        assert new_bytes != '' # after all, we did poll
-                        buffers[fd] += new_bytes
-                        lines = buffers[fd].splitlines(True) # keepends=True
-                        if lines[-1][-1] != '\n':
-                            buffers[fd] = lines[-1]
-                            del lines[-1]
+        # There's the freak case where a process first terminates
+        # stdout/stderr, then tries to write to a log pipe, and a
+        # background process may keep stdout/stderr open after the child
+        # exits, so we track child termination the proper way: SIGCHLD
+        # wakes up poll() through wakeup_fd, after which we read what is
+        # left without blocking. If signals can't be handled (not in the
+        # main thread) we fall back to polling every 50 ms.
+        with _child_exit_wakeup_fd() as wakeup_fd:
+            if wakeup_fd is not None:
+                poller.register(wakeup_fd, select.POLLIN)
+            child_exited = proc.poll() is not None
+            while True:
+                if child_exited:
+                    timeout = 0
+                elif wakeup_fd is None:
+                    timeout = 50
+                else:
+                    timeout = None
+                try:
+                    events = poller.poll(timeout)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if len(events) == 0:
+                    if child_exited or proc.poll() is not None:
+                        break # child terminated
+                for fd, reason in events:
+                    if fd == wakeup_fd:
+                        _drain_pipe(wakeup_fd)
+                        child_exited = proc.poll() is not None
+                    elif reason & select.POLLHUP and not (reason & select.POLLIN):
+                        # we want to continue receiving PULLHUP|POLLIN until all
+                        # is read
+                        if fd in fd_to_logpipe:
+                            reopen_fifo(fd)
+                        elif fd in (stdout_fd, stderr_fd):
+                            poller.unregister(fd)
+                    elif reason & select.POLLIN:
+                        if stdout_to is not None and fd == stdout_fd:
+                            # Just forward
+                            buf = os.read(fd, LOG_PIPE_BUFSIZE)
+                            stdout_to.write(buf)
                         else:
-                            buffers[fd] = ''
-                        # have list of lines, emit them to logger
-                        header, level = loggers[fd]
-                        for line in lines:
-                            line = line.rstrip('\n')
-                            with sublevel_added(logger, header):
-                                logger.log(level, line)
+                            # append new bytes to what's already been read on this fd; and
+                            # emit any completed lines
+                            new_bytes = os.read(fd, LOG_PIPE_BUFSIZE)
+                            assert new_bytes != '' # after all, we did poll
+                            buffers[fd] += new_bytes
+                            lines = buffers[fd].splitlines(True) # keepends=True
+                            if lines[-1][-1] != '\n':
+                                buffers[fd] = lines[-1]
+                                del lines[-1]
+                            else:
+                                buffers[fd] = ''
+                            # have list of lines, emit them to logger
+                            header, level = loggers[fd]
+                            log_lines(logger, level, [line.rstrip('\n') for line in lines], header)
 
         flush_buffer(stderr_fd)
         flush_buffer(stdout_fd)
@@ -893,5 +1015,62 @@ class CommandTreeExecution(object):
             self.log_fifo_filenames[sublogger_name, level] = fifo_filename
         sys.stdout.write(fifo_filename)
 
+def _max_rss_kb(ru):
+    # in bytes on OS X, kilobytes elsewhere
+    return ru.ru_maxrss // 1024 if sys.platform == 'darwin' else ru.ru_maxrss
+
+def _get_usage():
+    """
+    Returns (user time, system time, blocks read, blocks written, peak RSS
+    in kB) of this process together with its waited-for children.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + children.ru_utime, own.ru_stime + children.ru_stime,
+            own.ru_inblock + children.ru_inblock, own.ru_oublock + children.ru_oublock,
+            _max_rss_kb(own))
+
+def _ignore_signal(signum, frame):
+    pass
+
+@contextmanager
+def _child_exit_wakeup_fd():
+    """
+    Makes a byte be written to a pipe whenever a child process
+    terminates (on SIGCHLD), so that waiting for the child can be
+    combined with poll() or select(), and yields the non-blocking
+    read end of the pipe. Yields None if this is not possible (signals
+    are only handled in the main thread).
+    """
+    try:
+        old_handler = signal.signal(signal.SIGCHLD, _ignore_signal)
+    except ValueError:
+        yield None
+        return
+    r, w = os.pipe()
+    try:
+        for fd in (r, w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        # restart other system calls rather than failing them with EINTR
+        signal.siginterrupt(signal.SIGCHLD, False)
+        old_wakeup_fd = signal.set_wakeup_fd(w)
+        try:
+            yield r
+        finally:
+            signal.set_wakeup_fd(old_wakeup_fd)
+    finally:
+        signal.signal(signal.SIGCHLD, old_handler if old_handler is not None else signal.SIG_DFL)
+        os.close(r)
+        os.close(w)
+
+def _drain_pipe(fd):
+    try:
+        while os.read(fd, 4096):
+            pass
+    except OSError, e:
+        if e.errno != errno.EAGAIN:
+            raise
+
 # temporarily set by test_run_job; can also set manually to emulate OS X
 _TEST_LOG_PROCESS_SIMPLE = False
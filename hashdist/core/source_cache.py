@@ -79,6 +79,30 @@ Individual files or directories ("hit-pack"):
     This stream is then encoded like archives (SHA-256 in base-64),
     and prefixed with ``files:`` to get the key.
 
+Indexed hit-packs (version 2):
+    The ``files:`` format must be read in full to get at any file, and
+    can only be verified as a whole. Version 2 packs start with the
+    magic string "HDSTPCK2", followed by the contents of the files
+    (sorted by filename) back to back, then an index with an entry for
+    each file,
+
+    ==========================  ==============================
+    little-endian ``uint32_t``  length of filename
+    little-endian ``uint64_t``  offset of contents in the pack
+    little-endian ``uint64_t``  length of contents
+    32 bytes                    SHA-256 digest of contents
+    ---                         filename (no terminating null)
+    ==========================  ==============================
+
+    and finally a trailer with the offset of the index as a
+    little-endian ``uint64_t``, the number of files as a
+    little-endian ``uint32_t``, and the magic string again. The key is
+    the SHA-256 of the magic string followed by the index, encoded as
+    above and prefixed with ``files2:``. Since the index contains the
+    digest of each file, a single file can be read and verified
+    without reading the rest of the pack, and packs are unpacked by
+    memory-mapping them and streaming each file to disk.
+
 Module reference
 ----------------
 
@@ -96,6 +120,7 @@ import hashlib
 import struct
 import errno
 import stat
+import mmap
 from timeit import default_timer as clock
 import contextlib
 import urlparse
@@ -105,6 +130,7 @@ from .common import working_directory
 from .hasher import hash_document, format_digest, HashingReadStream, HashingWriteStream
 from .fileutils import silent_makedirs
 from .decorators import retry
+from . import spawn
 
 pjoin = os.path.join
 
@@ -285,7 +311,7 @@ class SourceCache(object):
         return ArchiveSourceCache(self).fetch_archive(url, type, None)
 
 
-    def put(self, files):
+    def put(self, files, pack_version=1):
         """Put in-memory contents into the source cache.
 
         Parameters
@@ -295,19 +321,43 @@ class SourceCache(object):
             slashes ``/`` as path separators. `contents` is a pure bytes
             objects which will be dumped directly to `stream`.
 
+        pack_version : int (optional)
+            1 to store a ``files:`` hit-pack, 2 for an indexed ``files2:``
+            hit-pack (see module documentation).
+
         Returns
         -------
 
         key : str
-            The resulting key, it has the ``files:`` prefix.
+            The resulting key, it has the ``files:`` or ``files2:`` prefix.
 
         """
-        return ArchiveSourceCache(self).put(files)
+        return ArchiveSourceCache(self).put(files, pack_version)
+
+    def read_files(self, key, filenames=None):
+        """Read the contents of a hit-pack in the source cache.
+
+        Parameters
+        ----------
+        key : str
+            Key with the ``files:`` or ``files2:`` prefix.
+
+        filenames : list of str (optional)
+            Only read these files. For ``files2:`` packs the other
+            files are not read at all.
+
+        Returns
+        -------
+
+        list of (filename, contents), sorted by filename
+        """
+        type, hash = key.split(':')
+        return ArchiveSourceCache(self).read_files(type, hash, filenames)
 
     def _get_handler(self, type):
         if type == 'git':
             handler = GitSourceCache(self)
-        elif type == 'files' or type in archive_types:
+        elif type in HIT_PACK_TYPES or type in archive_types:
             handler = ArchiveSourceCache(self)
         else:
             raise ValueError('does not recognize key prefix: %s' % type)
@@ -393,9 +443,9 @@ class GitSourceCache(object):
             env = self.get_repo_env(repo_name)
         cmd = ['git'] + list(args)
         self.logger.info('running: %s' % cmd)
-        p = subprocess.Popen(cmd, env=env,
-                             stdout=subprocess.PIPE, stdin=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        p = spawn.Popen(cmd, env=env,
+                        stdout=subprocess.PIPE, stdin=subprocess.PIPE,
+                        stderr=subprocess.PIPE)
         out, err = p.communicate()
         return p.returncode, out, err
 
@@ -652,7 +702,7 @@ class ArchiveSourceCache(object):
         self.logger = self.source_cache.logger
 
     def get_pack_filename(self, type, hash):
-        d = self.files_path if type == 'files' else self.packs_path
+        d = self.files_path if type in HIT_PACK_TYPES else self.packs_path
         type_dir = pjoin(d, type)
         mkdir_if_not_exists(type_dir)
         return pjoin(type_dir, hash)
@@ -781,15 +831,36 @@ class ArchiveSourceCache(object):
             silent_unlink(temp_file)
         return '%s:%s' % (type, hash)
 
-    def put(self, files):
+    def put(self, files, pack_version=1):
         if isinstance(files, dict):
             files = files.items()
-        key = hit_pack(files)
+        # Pack into a list of chunks, which mostly refer to the contents
+        # strings, so that the files are only sorted and hashed once
+        chunks = ChunkListStream()
+        if pack_version == 1:
+            key = hit_pack(files, chunks)
+        elif pack_version == 2:
+            key = hit_pack_v2(files, chunks)
+        else:
+            raise ValueError('unknown hit-pack version: %r' % pack_version)
+        if (self.files_path, key) in _stored_packs:
+            return key
         type, hash = key.split(':')
         pack_filename = self.get_pack_filename(type, hash)
         if not os.path.exists(pack_filename):
-            with file(pack_filename, 'w') as f:
-                hit_pack(files, f)
+            # Write to a temporary file and rename it to the target, so
+            # that concurrent readers never see a partial pack
+            temp_fd, temp_path = tempfile.mkstemp(prefix='putting-',
+                                                  dir=os.path.dirname(pack_filename))
+            try:
+                with os.fdopen(temp_fd, 'wb') as f:
+                    for chunk in chunks.chunks:
+                        f.write(chunk)
+                os.chmod(temp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(temp_path, pack_filename)
+            finally:
+                silent_unlink(temp_path)
+        _stored_packs.add((self.files_path, key))
         return key
 
     def unpack(self, type, hash, target_dir):
@@ -798,6 +869,9 @@ class ArchiveSourceCache(object):
             if type == 'files':
                 files = hit_unpack(infile, 'files:%s' % hash)
                 scatter_files(files, target_dir)
+            elif type == 'files2':
+                with closing(IndexedHitPack(infile, 'files2:%s' % hash)) as pack:
+                    pack.unpack(target_dir)
             else:
                 try:
                     create_archive_handler(type, self.logger).unpack(infile, target_dir, hash)
@@ -805,6 +879,22 @@ class ArchiveSourceCache(object):
                     self.logger.error(str(e))
                     raise
 
+    def read_files(self, type, hash, filenames=None):
+        with self.open_file(type, hash) as infile:
+            if type == 'files':
+                files = hit_unpack(infile, 'files:%s' % hash)
+                if filenames is not None:
+                    files = [(filename, contents) for filename, contents in files
+                             if filename in filenames]
+            elif type == 'files2':
+                with closing(IndexedHitPack(infile, 'files2:%s' % hash)) as pack:
+                    if filenames is None:
+                        filenames = pack.filenames()
+                    files = [(filename, pack.read(filename)) for filename in sorted(filenames)]
+            else:
+                raise ValueError('not a hit-pack: %s:%s' % (type, hash))
+        return files
+
     def open_file(self, type, hash):
         try:
             f = file(self.get_pack_filename(type, hash))
@@ -914,7 +1004,7 @@ class TarSubprocessHandler(TarballHandler):
     def unpack(self, infile, target_dir, hash):
         self.logger.debug('Calling tar to unpack %s -> %s', infile, target_dir)
         try:
-            subprocess.check_call(['tar', 'xf', infile.name, '-C', target_dir, '--strip-components=1'])
+            spawn.check_call(['tar', 'xf', infile.name, '-C', target_dir, '--strip-components=1'])
         except subprocess.CalledProcessError:
             raise CorruptSourceCacheError("Archive corrupt and/or cannot be unpacked: '%s'" % filename)
 
@@ -1003,6 +1093,19 @@ archive_types = sorted(archive_types)
 def create_archive_handler(type, logger):
     return archive_handler_classes[type](logger)
 
+HIT_PACK_TYPES = ('files', 'files2')
+
+# (files_path, key) of the hit-packs stored by ArchiveSourceCache.put in this process
+_stored_packs = set()
+
+class ChunkListStream(object):
+    """
+    Stream that collects the written strings in the `chunks` list.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+
 def hit_pack(files, stream=None):
     """
     Packs the given files in the "hit-pack" format documented above,
@@ -1078,6 +1181,127 @@ def hit_unpack(stream, key):
         raise CorruptSourceCacheError('hit-pack does not match key "%s"' % key)
     return files
 
+HIT_PACK_V2_MAGIC = 'HDSTPCK2'
+_hit_pack_v2_entry = struct.Struct('<IQQ32s')
+_hit_pack_v2_trailer = struct.Struct('<QI8s')
+
+def hit_pack_v2(files, stream=None):
+    """
+    Packs the given files in the indexed "hit-pack" format (version 2)
+    documented above, and returns the resulting key (with the
+    ``files2:`` prefix). Arguments are as for :func:`hit_pack`.
+    """
+    files = sorted(files)
+    index = []
+    offset = len(HIT_PACK_V2_MAGIC)
+    for filename, contents in files:
+        filename = str(filename)
+        contents = str(contents)
+        index.append(_hit_pack_v2_entry.pack(len(filename), offset, len(contents),
+                                             hashlib.sha256(contents).digest()))
+        index.append(filename)
+        offset += len(contents)
+    index = ''.join(index)
+    if stream is not None:
+        stream.write(HIT_PACK_V2_MAGIC)
+        for filename, contents in files:
+            stream.write(str(contents))
+        stream.write(index)
+        stream.write(_hit_pack_v2_trailer.pack(offset, len(files), HIT_PACK_V2_MAGIC))
+    return 'files2:%s' % format_digest(hashlib.sha256(HIT_PACK_V2_MAGIC + index))
+
+class IndexedHitPack(object):
+    """
+    Reads an indexed hit-pack (version 2) through a read-only memory
+    map of `f`, which must be a real file. The index is verified
+    against `key` on opening, and the contents of each file against its
+    digest in the index when it is read.
+    """
+    chunk_size = 1024 * 1024
+
+    def __init__(self, f, key):
+        if not key.startswith('files2:'):
+            raise ValueError('invalid key')
+        self.key = key
+        size = os.fstat(f.fileno()).st_size
+        trailer_size = _hit_pack_v2_trailer.size
+        if size < len(HIT_PACK_V2_MAGIC) + trailer_size:
+            raise CorruptSourceCacheError('Not an indexed hit-pack')
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._entries = self._read_index(size, trailer_size)
+        except:
+            self.close()
+            raise
+
+    def _read_index(self, size, trailer_size):
+        m = self._map
+        index_offset, count, magic = _hit_pack_v2_trailer.unpack(m[size - trailer_size:])
+        if m[:len(HIT_PACK_V2_MAGIC)] != HIT_PACK_V2_MAGIC or magic != HIT_PACK_V2_MAGIC:
+            raise CorruptSourceCacheError('Not an indexed hit-pack')
+        if not len(HIT_PACK_V2_MAGIC) <= index_offset <= size - trailer_size:
+            raise CorruptSourceCacheError('hit-pack does not match key "%s"' % self.key)
+        index = m[index_offset:size - trailer_size]
+        if 'files2:%s' % format_digest(hashlib.sha256(HIT_PACK_V2_MAGIC + index)) != self.key:
+            raise CorruptSourceCacheError('hit-pack does not match key "%s"' % self.key)
+        # the index is now known to be the one packed by hit_pack_v2, but the
+        # count in the trailer is not covered by the key
+        entries = {}
+        pos = 0
+        for i in range(count):
+            if pos + _hit_pack_v2_entry.size > len(index):
+                break
+            filename_len, offset, length, digest = _hit_pack_v2_entry.unpack_from(index, pos)
+            pos += _hit_pack_v2_entry.size
+            entries[index[pos:pos + filename_len]] = (offset, length, digest)
+            pos += filename_len
+        if pos != len(index) or len(entries) != count:
+            raise CorruptSourceCacheError('hit-pack "%s" has a corrupt trailer' % self.key)
+        return entries
+
+    def close(self):
+        self._map.close()
+
+    def filenames(self):
+        return sorted(self._entries.keys())
+
+    def _chunks(self, filename):
+        """
+        Yields buffers with the contents of `filename`, after verifying them.
+        """
+        try:
+            offset, length, digest = self._entries[filename]
+        except KeyError:
+            raise KeyNotFoundError('%s not in %s' % (filename, self.key))
+        chunks = [buffer(self._map, start, min(self.chunk_size, offset + length - start))
+                  for start in range(offset, offset + length, self.chunk_size)]
+        h = hashlib.sha256()
+        for chunk in chunks:
+            h.update(chunk)
+        if h.digest() != digest:
+            raise CorruptSourceCacheError('%s in hit-pack "%s" is corrupt' % (filename, self.key))
+        return chunks
+
+    def read(self, filename):
+        return ''.join(str(chunk) for chunk in self._chunks(filename))
+
+    def unpack(self, target_dir):
+        """
+        Writes the files to `target_dir`, like :func:`scatter_files`.
+        """
+        existing_dir_cache = set([target_dir])
+        for filename in self.filenames():
+            chunks = self._chunks(filename)
+            dirname, basename = os.path.split(filename)
+            dirname = pjoin(target_dir, dirname)
+            if dirname not in existing_dir_cache and not os.path.exists(dirname):
+                os.makedirs(dirname)
+                existing_dir_cache.add(dirname)
+            fd = os.open(pjoin(dirname, basename), os.O_EXCL | os.O_CREAT | os.O_WRONLY, 0600)
+            with os.fdopen(fd, 'w') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+
 def scatter_files(files, target_dir):
     """
     Given a list of filenames and their contents, write them to the file system.
@@ -0,0 +1,111 @@
+"""
+:mod:`hashdist.core.spawn` --- Starting subprocesses
+====================================================
+
+Drop-in replacements for :class:`subprocess.Popen`, :func:`subprocess.call`
+and :func:`subprocess.check_call`, to be used for every subprocess that
+hashdist starts.
+
+Unlike their counterparts in :mod:`subprocess`, they default to
+``close_fds=True``, so that commands do not inherit the file
+descriptors of hashdist (e.g., of log files or locks). And rather than
+calling ``close()`` on every possible file descriptor up to
+``SC_OPEN_MAX`` in the child, which costs a noticeable amount of time
+per spawn when ``ulimit -n`` is large, only the file descriptors that
+are actually open are closed; these are listed in ``/proc/self/fd``
+(Linux) or ``/dev/fd`` (OS X, BSD). If neither can be listed, all
+file descriptors are closed like :mod:`subprocess` does.
+
+The child is reaped with ``wait4()``, and its resource usage (including
+that of the descendants it waited for) is kept in :attr:`Popen.rusage`.
+"""
+
+import os
+import errno
+import subprocess
+from subprocess import PIPE, STDOUT, CalledProcessError
+
+_FD_DIRS = ['/proc/self/fd', '/dev/fd']
+
+def _list_open_fds():
+    """Returns the open file descriptors of this process, or None if unknown"""
+    for fd_dir in _FD_DIRS:
+        try:
+            return [int(x) for x in os.listdir(fd_dir)]
+        except (OSError, ValueError):
+            pass
+    return None
+
+
+class Popen(subprocess.Popen):
+    """
+    Like :class:`subprocess.Popen`, but `close_fds` defaults to True
+    and only the open file descriptors are closed in the child.
+
+    Once the child has been waited for by :meth:`poll` or :meth:`wait`,
+    its :func:`resource.getrusage`-style resource usage is available as
+    the `rusage` attribute (which is None until then, or if the child
+    could not be waited for).
+    """
+    rusage = None
+
+    def __init__(self, args, **kw):
+        kw.setdefault('close_fds', True)
+        subprocess.Popen.__init__(self, args, **kw)
+
+    def _wait4(self, options):
+        while True:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, options)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                # SIGCHLD is ignored, or somebody else waited for the child;
+                # like subprocess, assume it is dead
+                pid, sts, rusage = self.pid, 0, None
+            break
+        if pid == self.pid:
+            self.rusage = rusage
+            self._handle_exitstatus(sts)
+
+    def poll(self):
+        if self.returncode is None:
+            self._wait4(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            self._wait4(0)
+        return self.returncode
+
+    def _close_fds(self, but):
+        # Called in the child after fork(); `but` is the pipe that reports
+        # exec() errors to the parent. The list includes the (already
+        # closed) descriptor that was used to read the directory.
+        fds = _list_open_fds()
+        if fds is None:
+            subprocess.Popen._close_fds(self, but)
+            return
+        for fd in fds:
+            if fd > 2 and fd != but:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+
+
+def call(*popenargs, **kw):
+    """Like :func:`subprocess.call`, but using :class:`Popen`"""
+    return Popen(*popenargs, **kw).wait()
+
+def check_call(*popenargs, **kw):
+    """Like :func:`subprocess.check_call`, but using :class:`Popen`"""
+    retcode = call(*popenargs, **kw)
+    if retcode:
+        cmd = kw.get('args')
+        if cmd is None:
+            cmd = popenargs[0]
+        raise CalledProcessError(retcode, cmd)
+    return 0
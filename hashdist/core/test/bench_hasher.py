@@ -0,0 +1,270 @@
+"""
+Benchmarks and golden digests for :mod:`hashdist.core.hasher`
+=============================================================
+
+The digests computed by :mod:`hashdist.core.hasher` are the identity
+of every artifact, so any change to it must reproduce them exactly.
+This module generates synthetic but realistic inputs -- build specs
+with many imports, long command lists, large ``inputs`` text blobs
+and deeply nested command trees, and hit-packs of many small files -- together with their
+golden digests, which are checked by ``test_hasher.py``.
+
+Run the benchmarks with::
+
+    python -m hashdist.core.test.bench_hasher [--quick] [name ...]
+
+For each benchmark, the time per operation, the throughput (in bytes
+of canonical JSON, or of file contents for hit-packs) and the peak
+memory growth while running it (each benchmark runs in a forked
+process) are printed. The golden digests are verified first.
+"""
+
+import sys
+import os
+import time
+import json
+import resource
+
+from ..hasher import (Hasher, DocumentSerializer, hash_document, format_digest, hash_type,
+                      freeze_document)
+from ..source_cache import hit_pack
+from ..build_store import BuildSpec
+
+
+def make_build_spec(name, import_count, command_count, blob_lines):
+    """
+    A build spec with `import_count` imports, `command_count` commands
+    and an ``inputs`` text blob of `blob_lines` lines, with a ``nohash_``
+    key in every command. Deterministic.
+    """
+    imports = [{'ref': 'DEP%d' % i, 'id': 'dep%d/%032x' % (i, i * 7919)[:40],
+                'in_env': i % 2 == 0}
+               for i in range(import_count)]
+    commands = [{'cmd': ['gcc', '-c', '-O2', '-I${DEP%d_DIR}/include' % (i % max(import_count, 1)),
+                         'src/file%d.c' % i, '-o', 'obj/file%d.o' % i],
+                 'nohash_comment': 'step %d' % i}
+                for i in range(command_count)]
+    commands.append({'cmd': ['${BASH}', '_hashdist/build.sh'],
+                     'inputs': [{'text': ['echo "line %d: %s" >> log.txt' % (i, u'\xe6\xf8\xe5' * (i % 5))
+                                          for i in range(blob_lines)]}]})
+    return {
+        'name': name,
+        'version': 'n%d' % import_count,
+        'sources': [{'key': 'tar.gz:%032x' % (i * 104729), 'target': '.', 'strip': 1}
+                    for i in range(3)],
+        'build': {
+            'import': imports,
+            'commands': commands,
+            },
+        'nohash_description': 'synthetic build spec',
+        }
+
+def make_shared_fragments_spec(name, dependency_count, freeze):
+    """
+    A build spec with the ``when_build_dependency`` commands of
+    `dependency_count` dependencies, taken from a fixed set of
+    fragments, as for a package high up in a large stack. If `freeze`
+    is set, the fragments are frozen with :func:`freeze_document` and
+    shared with the previous calls.
+    """
+    fragments = _shared_fragments.get(freeze)
+    if fragments is None:
+        fragments = [[{'prepend_path': var, 'value': '${DEP%d_DIR}/%s' % (i, subdir)}
+                      for var, subdir in [('PATH', 'bin'), ('PKG_CONFIG_PATH', 'lib/pkgconfig'),
+                                          ('CPATH', 'include'), ('LIBRARY_PATH', 'lib')]]
+                     + [{'set': 'DEP%d_VERSION' % i, 'value': '1.%d' % i}]
+                     for i in range(200)]
+        if freeze:
+            fragments = _shared_fragments[freeze] = freeze_document(fragments)
+    commands = []
+    for i in range(dependency_count):
+        commands += fragments[i % len(fragments)]
+    commands.append({'cmd': ['${BASH}', '_hashdist/build.sh']})
+    return {'name': name, 'build': {'import': [], 'commands': commands}}
+
+_shared_fragments = {}
+
+def make_deep_spec(name, depth):
+    """
+    A build spec whose commands are nested `depth` levels deep, each
+    level being a ``commands`` node with an environment change, a
+    command with ``inputs`` holding a small nested document, and the
+    next level. Deterministic.
+    """
+    node = {'cmd': ['${BASH}', '_hashdist/build.sh']}
+    for i in reversed(range(depth)):
+        node = {'commands': [
+            {'prepend_path': 'PATH', 'value': '${DEP%d_DIR}/bin' % (i % 10)},
+            {'cmd': ['make', '-C', 'level%d' % i],
+             'inputs': [{'json': {'level': i, 'flags': ['-O%d' % (i % 3)],
+                                  'nested': {'depth': [i, [i + 1, {'odd': i % 2 == 1}]]}}}],
+             'nohash_comment': 'level %d' % i},
+            node]}
+    return {'name': name, 'build': {'import': [], 'commands': [node]}}
+
+def make_pack_files(file_count, size):
+    """
+    `file_count` files of `size` bytes for :func:`hit_pack`. Deterministic.
+    """
+    return [('dir%d/file%d.txt' % (i % 37, i), ('%08d' % i) * (size // 8) + 'x' * (size % 8))
+            for i in range(file_count)]
+
+
+DOCUMENTS = {
+    'small': lambda: make_build_spec('small', 10, 20, 10),
+    'imports_1k': lambda: make_build_spec('imports1k', 1000, 50, 50),
+    'imports_10k': lambda: make_build_spec('imports10k', 10000, 50, 50),
+    'commands_5k': lambda: make_build_spec('commands5k', 20, 5000, 50),
+    'blob_20k': lambda: make_build_spec('blob20k', 20, 50, 20000),
+    'shared_fragments': lambda: make_shared_fragments_spec('shared', 1000, False),
+    'shared_fragments_frozen': lambda: make_shared_fragments_spec('shared', 1000, True),
+    'deep_200': lambda: make_deep_spec('deep', 200),
+    }
+
+PACKS = {
+    'pack_10k_small': lambda: make_pack_files(10000, 100),
+    'pack_20_large': lambda: make_pack_files(20, 1000000),
+    }
+
+# name -> (hash_document('build-spec', doc),
+#          BuildSpec(doc).artifact_id,
+#          Hasher(doc).format_digest())
+# or, for packs, name -> hit_pack(files)
+GOLDEN_DIGESTS = {
+    'blob_20k': ('d5g7ivcn5s5kermxcxijx6e5ut56mx32', 'blob20k/vpftwgsrdx47ow4y2bt5vw7r2yry3x33', 'vvzchsgnggnvrja3fx6hlwe7ogl5jvdj'),
+    'commands_5k': ('4p6jgj6ujiz2gnz4ja4duohck42xagit', 'commands5k/www7epukmqt4bhjgxsay4wzjxtn52tl5', '7sswil5qvmly5ojmdttd6m33cg3yqejb'),
+    'imports_10k': ('wkylplzj6x7v6dhxhhdtlbvyz7ityubb', 'imports10k/zpe54frjyw4g5l2h44o56fwuzbw3moh3', 'fptttitad2e5cmes5afon6nqypxqzmek'),
+    'imports_1k': ('7nihurtcvxbxknsmhipaxkijnsjybemx', 'imports1k/pkby3hxgj2dh2zm7hhr27fmxfquuekkf', 'bqp2jz5xdspog3cka3idmj22zdtmi2cd'),
+    'small': ('nghvl6vmbjceaxmeepszalhfv3sktijw', 'small/qbf3o3asu7z7eq3di5r3wyyvcloui7im', 'lvw6hij742sx5bsmggoid4zzk5ik6y7p'),
+    'shared_fragments': ('aekcuew2sx4j6pzblavblcio3hxc3ubg', 'shared/aekcuew2sx4j6pzblavblcio3hxc3ubg', 'rw5iliogjncbdtj7igqese7jr5rksmlp'),
+    'shared_fragments_frozen': ('aekcuew2sx4j6pzblavblcio3hxc3ubg', 'shared/aekcuew2sx4j6pzblavblcio3hxc3ubg', 'rw5iliogjncbdtj7igqese7jr5rksmlp'),
+    'deep_200': ('grgi6jxstlnfzsrunbx6wvsjrqacjf5w', 'deep/aelg7ypt3crslsvm6flhnjsxsdfnnafg', '4pri6eg3wcj6mlaqcq7dxtamitdltixy'),
+    'pack_10k_small': 'files:a4zwctbquw4obnuilrm4ui6sxjus775s',
+    'pack_20_large': 'files:v3sfprgynku77finciawtkw6tldjh5gb',
+    }
+
+
+def compute_digests(name):
+    if name in PACKS:
+        return hit_pack(PACKS[name]())
+    doc = DOCUMENTS[name]()
+    return (hash_document('build-spec', doc),
+            BuildSpec(doc).artifact_id,
+            Hasher(doc).format_digest())
+
+def check_golden_digests():
+    for name in sorted(GOLDEN_DIGESTS):
+        digests = compute_digests(name)
+        if digests != GOLDEN_DIGESTS[name]:
+            raise AssertionError('%s: got %r, expected %r' % (name, digests, GOLDEN_DIGESTS[name]))
+
+
+class NullSink(object):
+    def update(self, x):
+        pass
+
+def _benchmarks():
+    """
+    Yields (name, setup) where ``setup()`` returns (func, nbytes).
+    """
+    def doc_setup(name, make_func):
+        def setup():
+            doc = DOCUMENTS[name]()
+            nbytes = len(json.dumps(doc, sort_keys=True, separators=(',', ':')))
+            return make_func(doc), nbytes
+        return setup
+
+    for name in sorted(DOCUMENTS):
+        yield ('hash_document/' + name,
+               doc_setup(name, lambda doc: lambda: hash_document('build-spec', doc)))
+        yield ('hash_document_skip_nohash/' + name,
+               doc_setup(name, lambda doc: lambda: hash_document('build-spec', doc, skip_nohash=True)))
+        yield ('BuildSpec/' + name,
+               doc_setup(name, lambda doc: lambda: BuildSpec(doc)))
+        yield ('Hasher/' + name,
+               doc_setup(name, lambda doc: lambda: Hasher(doc).format_digest()))
+        yield ('DocumentSerializer/' + name,
+               doc_setup(name, lambda doc: lambda: DocumentSerializer(NullSink()).update(doc)))
+
+    def pack_setup(name):
+        def setup():
+            files = PACKS[name]()
+            return (lambda: hit_pack(files)), sum(len(contents) for _, contents in files)
+        return setup
+
+    for name in sorted(PACKS):
+        yield 'hit_pack/' + name, pack_setup(name)
+
+    def format_digest_setup():
+        h = hash_type('x')
+        return (lambda: format_digest(h)), 0
+    yield 'format_digest', format_digest_setup
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(setup, min_time):
+    """
+    Returns (seconds per call, peak RSS growth in kB of the calls, bytes per call).
+    """
+    func, nbytes = setup()
+    rss_before = _peak_rss_kb()
+    func()
+    rss_growth = _peak_rss_kb() - rss_before
+    best = None
+    for repeat in range(3):
+        n = 0
+        t0 = time.time()
+        while True:
+            func()
+            n += 1
+            elapsed = time.time() - t0
+            if elapsed >= min_time:
+                break
+        per_call = elapsed / n
+        best = per_call if best is None else min(best, per_call)
+    return best, rss_growth, nbytes
+
+def _run_forked(setup, min_time):
+    # run in a child process, so that the peak memory use is that of this benchmark
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            result = json.dumps(run_benchmark(setup, min_time))
+        except BaseException as e:
+            result = json.dumps(repr(e))
+        os.write(w, result)
+        os._exit(0)
+    os.close(w)
+    chunks = []
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    os.close(r)
+    os.waitpid(pid, 0)
+    result = json.loads(''.join(chunks))
+    if not isinstance(result, list):
+        raise RuntimeError(result)
+    return result
+
+def main(args):
+    quick = '--quick' in args
+    selected = [arg for arg in args if not arg.startswith('-')]
+    check_golden_digests()
+    print 'golden digests OK'
+    print '%-45s %12s %10s %12s' % ('benchmark', 'time/call', 'MB/s', 'peak mem')
+    for name, setup in _benchmarks():
+        if selected and not any(name.startswith(s) for s in selected):
+            continue
+        per_call, rss_growth, nbytes = _run_forked(setup, 0.05 if quick else 0.5)
+        throughput = '%10.1f' % (nbytes / per_call / 1e6) if nbytes else '%10s' % '-'
+        print '%-45s %10.3fms %s %10dkB' % (name, per_call * 1e3, throughput, rss_growth)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
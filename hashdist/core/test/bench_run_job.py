@@ -0,0 +1,105 @@
+"""
+Benchmarks for the log multiplexing of :mod:`hashdist.core.run_job`
+===================================================================
+
+Chatty builds (floods of compiler warnings, ``make V=1``) push a lot
+of lines through the job runner, which has to split them, and format
+and write each as a log record; and while a quiet command runs, the
+job runner should not use any CPU at all. This module runs commands
+through :meth:`CommandTreeExecution.logged_check_call` with a logger
+that formats every record and writes it to ``/dev/null``, and reports
+the CPU time used by the job runner (not by the command itself).
+
+Run the benchmarks with::
+
+    python -m hashdist.core.test.bench_run_job [--quick] [name ...]
+
+By default, 1M lines are pushed through the logger; ``--quick`` uses
+100k lines. The ``/simple`` variants use the ``select()`` based loop
+used on platforms other than Linux.
+"""
+
+import sys
+import os
+import time
+import logging
+import resource
+
+from .. import run_job
+
+
+class DevNullHandler(logging.StreamHandler):
+    """Formats every record and writes it to /dev/null, counting them"""
+    def __init__(self):
+        logging.StreamHandler.__init__(self, open(os.devnull, 'w'))
+        self.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+        logging.StreamHandler.emit(self, record)
+
+
+def chatty_command(line_count):
+    """A command writing `line_count` compiler-warning-like lines to stdout and stderr"""
+    script = ('import sys\n'
+              'line = "src/file.c:%%d: warning: unused variable \'x\' [-Wunused-variable]\\n"\n'
+              'for i in xrange(0, %d, 2):\n'
+              '    sys.stdout.write(line %% i)\n'
+              '    sys.stderr.write(line %% (i + 1))\n' % line_count)
+    return [sys.executable, '-c', script]
+
+BENCHMARKS = {
+    # name -> (command, number of lines logged)
+    'chatty': lambda line_count: (chatty_command(line_count), line_count),
+    'idle': lambda line_count: (['sleep', '1'], 0),
+    }
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def run_benchmark(args, simple):
+    """
+    Returns (wall time, job runner CPU time, number of records logged).
+    """
+    logger = logging.getLogger('hashdist.bench_run_job')
+    logger.propagate = False
+    handler = DevNullHandler()
+    logger.handlers = [handler]
+    logger.setLevel(logging.INFO)
+    executor = run_job.CommandTreeExecution(logger)
+    env = dict(os.environ, PWD=os.getcwd())
+    old_simple = run_job._TEST_LOG_PROCESS_SIMPLE
+    run_job._TEST_LOG_PROCESS_SIMPLE = simple
+    try:
+        t0 = time.time()
+        cpu0 = _cpu_time()
+        executor.logged_check_call(args, env, None)
+        return time.time() - t0, _cpu_time() - cpu0, handler.count
+    finally:
+        run_job._TEST_LOG_PROCESS_SIMPLE = old_simple
+        executor.close()
+        handler.stream.close()
+
+def main(args):
+    quick = '--quick' in args
+    selected = [arg for arg in args if not arg.startswith('-')]
+    line_count = 100000 if quick else 1000000
+    print '%-20s %10s %10s %12s' % ('benchmark', 'wall', 'cpu', 'lines/cpu s')
+    for name in sorted(BENCHMARKS):
+        for simple in [False, True]:
+            full_name = name + ('/simple' if simple else '')
+            if selected and not any(full_name.startswith(s) for s in selected):
+                continue
+            command, expected = BENCHMARKS[name](line_count)
+            wall, cpu, count = run_benchmark(command, simple)
+            if count != expected:
+                raise AssertionError('%s: logged %d lines, expected %d' % (full_name, count, expected))
+            rate = '%12.0f' % (count / cpu) if count and cpu else '%12s' % '-'
+            print '%-20s %9.3fs %9.3fs %s' % (full_name, wall, cpu, rate)
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -118,7 +118,7 @@ def test_basic(tempdir, sc, bldr, config):
     assert not bldr.is_present(spec)
     name, path = bldr.ensure_present(spec, config, extra_env={'EXTRA': 'extra'})
     assert bldr.is_present(spec)
-    eq_(['artifact.json', 'bar', 'build.json', 'build.log.gz', 'hello', 'id'],
+    eq_(['artifact.json', 'bar', 'build.json', 'build.log.gz', 'hello', 'id', 'job_stats.json'],
         sorted(os.listdir(path)))
     with file(pjoin(path, 'hello')) as f:
         got = sorted(f.readlines())
@@ -137,6 +137,13 @@ def test_basic(tempdir, sc, bldr, config):
         assert 'hi stdout path=[] extra' in s
         assert 'hi stderr' in s
 
+    # resource usage of the commands, after the node setting $ARTIFACT
+    with file(pjoin(path, 'job_stats.json')) as f:
+        stats = json.load(f)['commands']
+    eq_(['2', '3'], sorted(stats.keys()))
+    eq_(['/bin/bash', 'build.sh'], stats['3']['args'])
+    eq_(0, stats['3']['exit_code'])
+
     # files section
     assert 'foo' in os.listdir(pjoin(path, 'bar'))
     with file(pjoin(path, 'bar', 'foo')) as f:
@@ -282,6 +289,20 @@ def test_dependency_substitution(tempdir, sc, bldr, config):
     numpy = MockPackage("numpy", [blas, libc])
     build_mock_packages(bldr, config, [libc, blas, numpy])
 
+@fixture()
+def test_dependency_closure(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas])
+    name_to_artifact = build_mock_packages(bldr, config, [libc, blas, numpy])
+    ids = dict((name, artifact_id) for name, (artifact_id, path) in name_to_artifact.items())
+    # only direct dependencies are stored...
+    with open(pjoin(name_to_artifact['numpy'][1], 'artifact.json')) as f:
+        eq_([ids['blas']], json.load(f)['dependencies'])
+    # ...and the closure is computed on demand
+    eq_(set([ids['blas'], ids['libc']]), bldr.get_dependency_closure(ids['numpy']))
+    eq_(set(), bldr.get_dependency_closure(ids['libc']))
+
 @fixture()
 def test_virtual_dependencies(tempdir, sc, bldr, config):
     blas = MockPackage("blas", [])
@@ -296,3 +317,230 @@ def test_virtual_dependencies(tempdir, sc, bldr, config):
     build_mock_packages(bldr, config, [numpy], virtuals={"virtual:blas/1.2.3": blas_id},
                         name_to_artifact={"blas": ("virtual:blas/1.2.3", blas_path)})
 
+
+@fixture()
+def test_export_import_bundle(tempdir, sc, bldr, config):
+    from StringIO import StringIO
+    from ..bundle import get_artifact_closure, export_bundle, import_bundle
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas, libc])
+    name_to_artifact = build_mock_packages(bldr, config, [libc, blas, numpy])
+    numpy_id, numpy_path = name_to_artifact['numpy']
+    os.symlink('deps', pjoin(numpy_path, 'deps-link'))
+    os.link(pjoin(numpy_path, 'deps'), pjoin(numpy_path, 'deps-hardlink'))
+    os.chmod(numpy_path, 0o555)
+
+    closure = get_artifact_closure(bldr, numpy_id)
+    eq_(sorted(closure), sorted(artifact for artifact, path in name_to_artifact.values()))
+    stream = StringIO()
+    export_bundle(logger, bldr, closure, stream)
+
+    os.makedirs(pjoin(tempdir, 'bld2'))
+    config2 = dict(config, build_stores=[{'dir': pjoin(tempdir, 'bld2')}])
+    bldr2 = build_store.BuildStore.create_from_config(config2, logger)
+    # pretend libc is already present in the target store
+    bldr2_libc_path = pjoin(bldr2.artifact_root, os.path.relpath(name_to_artifact['libc'][1],
+                                                                bldr.artifact_root))
+    shutil.copytree(name_to_artifact['libc'][1], bldr2_libc_path, symlinks=True)
+    # ...and that an interrupted import left part of blas behind
+    bldr2_blas_path = pjoin(bldr2.artifact_root, os.path.relpath(name_to_artifact['blas'][1],
+                                                                bldr.artifact_root))
+    os.makedirs(bldr2_blas_path)
+    utils.dump(pjoin(bldr2_blas_path, 'partial'), 'partial')
+    os.chmod(bldr2_blas_path, 0o555)
+
+    imported, skipped = import_bundle(logger, bldr2, StringIO(stream.getvalue()))
+    eq_(2, len(imported))
+    eq_(1, len(skipped))
+    assert not os.path.exists(pjoin(bldr2_blas_path, 'partial'))
+    assert os.path.exists(pjoin(bldr2_blas_path, 'id'))
+    for artifact_id in closure:
+        assert bldr2.resolve(artifact_id) is not None
+    numpy_path2 = bldr2.resolve(numpy_id)
+    eq_(utils.cat(pjoin(numpy_path, 'deps')), utils.cat(pjoin(numpy_path2, 'deps')))
+    eq_('deps', os.readlink(pjoin(numpy_path2, 'deps-link')))
+    eq_(os.stat(pjoin(numpy_path2, 'deps')).st_ino, os.stat(pjoin(numpy_path2, 'deps-hardlink')).st_ino)
+    eq_(0o555, os.stat(numpy_path2).st_mode & 0o777)
+
+    # importing again is a no-op
+    imported, skipped = import_bundle(logger, bldr2, StringIO(stream.getvalue()))
+    eq_(0, len(imported))
+    eq_(3, len(skipped))
+
+@fixture()
+def test_read_only_build_store(tempdir, sc, bldr, config):
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    name_to_artifact = build_mock_packages(bldr, config, [libc])
+    libc_id, libc_path = name_to_artifact['libc']
+
+    os.makedirs(pjoin(tempdir, 'local'))
+    config = dict(config, build_stores=[{'dir': pjoin(tempdir, 'local')}, {'dir': pjoin(tempdir, 'bld')}])
+    layered = build_store.BuildStore.create_from_config(config, logger)
+    eq_(libc_path, layered.resolve(libc_id))
+    assert layered.is_path_in_build_store(libc_path)
+
+    build_mock_packages(layered, config, [blas], name_to_artifact=name_to_artifact)
+    blas_id, blas_path = name_to_artifact['blas']
+    assert blas_path.startswith(layered.artifact_root)
+    assert bldr.resolve(blas_id) is None
+    eq_(blas_path, layered.resolve(blas_id))
+
+    # negative lookups in the read-only store are cached
+    assert layered.resolve('foo/abcdefghijklmnopqrstuvwxyz234567') is None
+    assert 'foo/abcdefghijklmnopqrstuvwxyz234567' in layered._read_only_misses
+
+    # gc only sweeps the local store
+    layered.gc()
+    assert layered.resolve(blas_id) is None
+    eq_(libc_path, layered.resolve(libc_id))
+
+@fixture()
+def test_async_cleanup(tempdir, sc, bldr, config):
+    trash_dir = pjoin(tempdir, 'tmp', 'trash')
+    # leftovers from a process that is no longer running are reclaimed
+    os.makedirs(pjoin(trash_dir, '%d-leftover' % (2 ** 30), 'foo-abc', 'subdir'))
+    bldr = build_store.BuildStore.create_from_config(config, logger, async_cleanup=True)
+    name, path = bldr.ensure_present({"name": "foo", "build": {"commands": []}}, config)
+    bldr.trash.wait()
+    eq_([], os.listdir(trash_dir))
+    eq_(['trash'], os.listdir(pjoin(tempdir, 'tmp')))
+
+@fixture()
+def test_dedup_store(tempdir, sc, bldr, config):
+    from ..cache import DiskCache
+    from ..dedup import dedup_store, TEMP_PREFIX
+    def make_artifact(name, files):
+        artifact_dir = pjoin(bldr.artifact_root, name, 'abc')
+        os.makedirs(pjoin(artifact_dir, 'sub'))
+        for filename, contents, mode in files + [('id', '%s/abcdef' % name, 0o444)]:
+            with open(pjoin(artifact_dir, filename), 'w') as f:
+                f.write(contents)
+            os.chmod(pjoin(artifact_dir, filename), mode)
+        for d in [pjoin(artifact_dir, 'sub'), artifact_dir]:
+            os.chmod(d, 0o555)
+        return artifact_dir
+
+    a = make_artifact('a', [('sub/x', 'x' * 100, 0o444), ('y', 'y', 0o444), ('w', 'w', 0o644)])
+    b = make_artifact('b', [('x', 'x' * 100, 0o444), ('y', 'y', 0o555), ('w', 'w', 0o644)])
+    c = make_artifact('c', [('sub/x', 'x' * 100, 0o444), ('z', 'x' * 99 + 'z', 0o444)])
+    ino = lambda path: os.stat(path).st_ino
+    cache = DiskCache(pjoin(tempdir, 'cache'))
+    eq_((2, 200), dedup_store(logger, bldr, cache))
+    assert ino(pjoin(a, 'sub/x')) == ino(pjoin(b, 'x')) == ino(pjoin(c, 'sub/x'))
+    # different mode, writable or different contents
+    assert ino(pjoin(a, 'y')) != ino(pjoin(b, 'y'))
+    assert ino(pjoin(a, 'w')) != ino(pjoin(b, 'w'))
+    assert ino(pjoin(c, 'z')) != ino(pjoin(c, 'sub/x'))
+    with open(pjoin(c, 'sub/x')) as f:
+        eq_('x' * 100, f.read())
+    eq_(0o555, os.stat(pjoin(c, 'sub')).st_mode & 0o777)
+
+    # a link left behind by an interrupted run is removed
+    d = make_artifact('d', [('x', 'x' * 100, 0o444)])
+    os.chmod(d, 0o755)
+    os.link(pjoin(d, 'x'), pjoin(d, TEMP_PREFIX + 'x'))
+    os.chmod(d, 0o555)
+    eq_((1, 100), dedup_store(logger, bldr, DiskCache(pjoin(tempdir, 'cache'))))
+    eq_(['id', 'sub', 'x'], sorted(os.listdir(d)))
+    assert ino(pjoin(d, 'x')) == ino(pjoin(a, 'sub/x'))
+    eq_((0, 0), dedup_store(logger, bldr, cache))
+
+@fixture()
+def test_dedup_then_gc(tempdir, sc, bldr, config):
+    from ..cache import DiskCache
+    from ..dedup import dedup_store
+    name_to_artifact = build_mock_packages(bldr, config, [MockPackage("a", []),
+                                                          MockPackage("b", [])])
+    (a_id, a), (b_id, b) = name_to_artifact['a'], name_to_artifact['b']
+    for artifact_dir in [a, b]:
+        os.chmod(artifact_dir, 0o755)
+        with open(pjoin(artifact_dir, 'x'), 'w') as f:
+            f.write('x' * 100)
+        os.chmod(pjoin(artifact_dir, 'x'), 0o444)
+        os.chmod(artifact_dir, 0o555)
+    dedup_store(logger, bldr, DiskCache(pjoin(tempdir, 'cache')))
+    eq_(os.stat(pjoin(a, 'x')).st_ino, os.stat(pjoin(b, 'x')).st_ino)
+
+    # removing one of the artifacts leaves the file of the other alone
+    bldr.create_symlink_to_artifact(a_id, pjoin(tempdir, 'a-link'))
+    bldr.gc()
+    assert bldr.resolve(b_id) is None
+    eq_(0o444, os.stat(pjoin(a, 'x')).st_mode & 0o777)
+    with open(pjoin(a, 'x')) as f:
+        eq_('x' * 100, f.read())
+
+@fixture()
+def test_archive_store(tempdir, sc, bldr, config):
+    from ..archive import archive_store, ARCHIVE_FILENAME
+    libc = MockPackage("libc", [])
+    blas = MockPackage("blas", [libc])
+    numpy = MockPackage("numpy", [blas])
+    extra = MockPackage("extra", [])
+    name_to_artifact = build_mock_packages(bldr, config, [libc, blas, numpy, extra])
+    extra_id, extra_dir = name_to_artifact['extra']
+    # give the artifact some structure
+    os.chmod(extra_dir, 0o755)
+    os.makedirs(pjoin(extra_dir, 'sub', 'dir'))
+    with open(pjoin(extra_dir, 'sub', 'dir', 'x'), 'w') as f:
+        f.write('x' * 1000)
+    os.link(pjoin(extra_dir, 'sub', 'dir', 'x'), pjoin(extra_dir, 'x'))
+    os.symlink('sub/dir/x', pjoin(extra_dir, 'link'))
+    for path in [pjoin(extra_dir, 'sub', 'dir', 'x'), pjoin(extra_dir, 'sub', 'dir'), extra_dir]:
+        os.chmod(path, 0o555)
+
+    def make_old(artifact_dir):
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            for path in [dirpath] + [pjoin(dirpath, x) for x in filenames]:
+                subprocess.check_call(['touch', '-h', '-d', '@1000', path])
+
+    def listing(artifact_dir):
+        result = []
+        for dirpath, dirnames, filenames in os.walk(artifact_dir):
+            for path in [dirpath] + [pjoin(dirpath, x) for x in filenames]:
+                st = os.lstat(path)
+                result.append((os.path.relpath(path, artifact_dir), st.st_mode, st.st_nlink))
+        return sorted(result)
+
+    for name in ['libc', 'blas', 'extra']:
+        make_old(name_to_artifact[name][1])
+    before = listing(extra_dir)
+    # libc and blas are still needed by numpy
+    eq_([extra_id], archive_store(logger, bldr, 24 * 3600))
+    eq_(sorted(['id', 'artifact.json', ARCHIVE_FILENAME]), sorted(os.listdir(extra_dir)))
+    eq_([extra_id], list(bldr.archive_index))
+    eq_([], archive_store(logger, bldr, 24 * 3600))
+    # the dependencies can still be looked up
+    eq_(set(), bldr.get_dependency_closure(extra_id))
+    assert not os.path.exists(pjoin(extra_dir, 'x'))
+
+    # another process sees the index and restores it
+    other = build_store.BuildStore.create_from_config(config, logger)
+    eq_(extra_dir, other.resolve(extra_id))
+    eq_(before, listing(extra_dir))
+    with open(pjoin(extra_dir, 'link')) as f:
+        eq_('x' * 1000, f.read())
+    eq_([], list(bldr.archive_index))
+    eq_(extra_dir, bldr.resolve(extra_id))
+
+    # restoring counts as a use
+    with open(pjoin(name_to_artifact['numpy'][1], 'build.json')) as f:
+        numpy_spec = json.load(f)
+    make_old(name_to_artifact['numpy'][1])
+    eq_(sorted([name_to_artifact[name][0] for name in ['libc', 'blas', 'numpy']]),
+        sorted(archive_store(logger, bldr, 24 * 3600)))
+    # an archived artifact is present, without restoring it
+    assert bldr.is_present(numpy_spec)
+    eq_(3, len(list(bldr.archive_index)))
+    # but linking to it restores it with its dependencies
+    bldr.create_symlink_to_artifact(name_to_artifact['numpy'][0], pjoin(tempdir, 'numpy'))
+    eq_([], list(bldr.archive_index))
+    assert os.path.exists(pjoin(name_to_artifact['libc'][1], 'build.json'))
+    bldr.remove_symlink_to_artifact(pjoin(tempdir, 'numpy'))
+    eq_(4, len(archive_store(logger, bldr, -1)))
+    # gc removes archived artifacts, and forgets about them
+    bldr.gc()
+    eq_([], list(bldr.archive_index))
+    for artifact_id, artifact_dir in name_to_artifact.values():
+        assert bldr.resolve(artifact_id) is None
@@ -24,6 +24,43 @@ def test_hash_document():
     h = hasher.hash_document('test', doc_a)
     assert h == 'geecc25mccuaba37cwsquibd2iisgo6f'
 
+def test_hash_document_skip_nohash():
+    doc = {'a': [[{'nohash_foo': [1,2,3]}, 1, True, False, None, 2, 'asdf']],
+           'nohash_foo': True,
+           u'\xe6': [u'\u1234\U0001f600', 'a"b\\\n\x01\x7f', '\xc3\xa6', (), {}],
+           'deep': reduce(lambda d, i: {'x': [d, i]}, range(100), {})}
+    expected = hasher.hash_document('test', hasher.prune_nohash(doc))
+    eq_(expected, hasher.hash_document('test', doc, skip_nohash=True))
+    assert expected != hasher.hash_document('test', doc)
+    with assert_raises(TypeError):
+        hasher.hash_document('test', {'a': [{'b': 3.4}]}, skip_nohash=True)
+
+def test_frozen_documents():
+    import pickle
+    fragment = {'set': 'PATH', 'value': [u'\xe6', 1, None, True, ['a', {}]], 'nohash_x': 1}
+    frozen = hasher.freeze_document(fragment)
+    assert frozen == fragment
+    for doc in [frozen, {'a': [frozen, frozen], 'b': frozen}]:
+        plain = copy.deepcopy(doc)
+        for i in range(2):
+            # the second time from the cached streams
+            eq_(hasher.hash_document('test', plain), hasher.hash_document('test', doc))
+            eq_(hasher.hash_document('test', plain, skip_nohash=True),
+                hasher.hash_document('test', doc, skip_nohash=True))
+            eq_(hasher.Hasher(plain).format_digest(), hasher.Hasher(doc).format_digest())
+    with assert_raises(TypeError):
+        frozen['set'] = 'x'
+    with assert_raises(TypeError):
+        frozen['value'].append(3)
+    eq_(frozen, pickle.loads(pickle.dumps(frozen)))
+    assert type(pickle.loads(pickle.dumps(frozen))['value']) is hasher.frozen_list
+
+def test_golden_digests():
+    from .bench_hasher import GOLDEN_DIGESTS, DOCUMENTS, PACKS, compute_digests
+    assert sorted(GOLDEN_DIGESTS) == sorted(DOCUMENTS.keys() + PACKS.keys())
+    for name in sorted(GOLDEN_DIGESTS):
+        yield eq_, GOLDEN_DIGESTS[name], compute_digests(name)
+
 #
 # Hasher
 #
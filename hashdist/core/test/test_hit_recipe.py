@@ -13,7 +13,7 @@ def test_hit_cli_artifact(tempdir, sc, bldr, config):
     hit_id, hit_path = ensure_hit_cli_artifact(bldr, config)
 
     eq_(sorted(os.listdir(hit_path)),
-        ['artifact.json', 'bin', 'build.json', 'build.log.gz', 'id', 'pypkg'])
+        ['artifact.json', 'bin', 'build.json', 'build.log.gz', 'id', 'job_stats.json', 'pypkg'])
     with file(pjoin(hit_path, 'bin', 'hit')) as f:
         hit_bin = f.read()
     assert hit_bin.startswith('#!' + os.path.realpath(sys.executable))
@@ -1,5 +1,7 @@
 import sys
 import os
+import time
+import json
 import logging
 from os.path import join as pjoin
 from nose.tools import eq_
@@ -178,6 +180,30 @@ def test_capture_stdout(tempdir, sc, build_store, cfg):
     finally:
         run_job._TEST_LOG_PROCESS_SIMPLE = o
 
+@build_store_fixture()
+def test_background_process_keeps_output_open(tempdir, sc, build_store, cfg):
+    # the job is done when the command exits, even if a process it left
+    # behind still has stdout/stderr open
+    job_spec = {
+        "commands": [
+            {"cmd": ["/bin/sh", "-c", "echo hello; sleep 10 & echo bye"]},
+        ]}
+    def doit():
+        t0 = time.time()
+        with log_capture() as logger:
+            run_job.run_job(logger, build_store, job_spec, {}, '<no-artifact>', {}, tempdir, cfg)
+        assert time.time() - t0 < 5
+        logger.assertLogged('^INFO:hello$')
+        logger.assertLogged('^INFO:bye$')
+
+    doit()
+    o = run_job._TEST_LOG_PROCESS_SIMPLE
+    try:
+        run_job._TEST_LOG_PROCESS_SIMPLE = True
+        doit()
+    finally:
+        run_job._TEST_LOG_PROCESS_SIMPLE = o
+
 @build_store_fixture()
 def test_script_redirect(tempdir, sc, build_store, cfg):
     job_spec = {
@@ -216,6 +242,38 @@ def test_error_exit(tempdir, sc, build_store, cfg):
     with assert_raises(CalledProcessError):
         run_job.run_job(test_logger, build_store, job_spec, {}, '<no-artifact>', {}, tempdir, cfg)
 
+@build_store_fixture()
+def test_job_stats(tempdir, sc, build_store, cfg):
+    with file(pjoin(tempdir, 'files.json'), 'w') as f:
+        json.dump([{"target": "hello", "text": ["hello"]}], f)
+    stats_filename = pjoin(tempdir, 'job_stats.json')
+    job_spec = {
+        "commands": [
+            {"hit": ["build-write-files", "files.json"]},
+            {"commands": [
+                {"cmd": ["/bin/cat", "hello"]},
+                {"cmd": [which("false")]},
+                {"cmd": ["/bin/echo", "not reached"]},
+            ]}
+        ]}
+    with assert_raises(CalledProcessError):
+        run_job.run_job(test_logger, build_store, job_spec, {}, '<no-artifact>', {}, tempdir, cfg,
+                        stats_filename=stats_filename)
+    with file(stats_filename) as f:
+        stats = json.load(f)['commands']
+    # position 0 is taken by the node setting $ARTIFACT
+    eq_(['1', '2.0', '2.1'], sorted(stats.keys()))
+    eq_('hit', stats['1']['type'])
+    eq_(["build-write-files", "files.json"], stats['1']['args'])
+    eq_('cmd', stats['2.0']['type'])
+    eq_(0, stats['1']['exit_code'])
+    eq_(0, stats['2.0']['exit_code'])
+    eq_(1, stats['2.1']['exit_code'])
+    for node_stats in stats.values():
+        for key in ['wall_time', 'user_time', 'sys_time', 'max_rss_kb', 'read_bytes', 'write_bytes']:
+            assert node_stats[key] >= 0
+        assert node_stats['max_rss_kb'] > 0
+
 @build_store_fixture()
 def test_log_pipe_stress(tempdir, sc, build_store, cfg):
     if 'linux' not in sys.platform:
@@ -6,6 +6,7 @@ import subprocess
 import hashlib
 from StringIO import StringIO
 import stat
+import struct
 import errno
 import logging
 from contextlib import closing
@@ -14,6 +15,7 @@ pjoin = os.path.join
 
 from ..source_cache import (ArchiveSourceCache, SourceCache,
         CorruptSourceCacheError, hit_pack, hit_unpack, scatter_files,
+        hit_pack_v2, IndexedHitPack,
         KeyNotFoundError, SourceNotFoundError, SecurityError, RemoteFetchError)
 from ..hasher import Hasher, format_digest
 
@@ -320,6 +322,14 @@ def test_put():
             sc.unpack(key, d)
             with file(pjoin(d, 'foofile')) as f:
                 assert f.read() == 'the contents'
+        files = [('b', 'in b'), ('a/c', u'in c')]
+        key = sc.put(files)
+        assert key == hit_pack(files)
+        assert sc.put(dict(files)) == key
+        files_dir = pjoin(sc.cache_path, 'files')
+        assert len(os.listdir(files_dir)) == 2  # no temporary files left behind
+        with file(pjoin(files_dir, key.split(':')[1])) as f:
+            assert hit_unpack(f, key) == sorted(files)
 
 def test_simple_file_url_re():
     from ..source_cache import SIMPLE_FILE_URL_RE
@@ -346,6 +356,57 @@ def test_hdist_pack():
     unpacked_files = hit_unpack(StringIO(pack), key)
     assert sorted(files) == sorted(unpacked_files)
 
+def test_hit_pack_v2():
+    files = [('foo', 'contains foo'),
+             ('bar', ''),
+             ('a/b', 'in a subdir'),
+             ('a/c', 'x' * 3000000)]
+    stream = StringIO()
+    key = hit_pack_v2(files, stream)
+    assert key == 'files2:t5rgzvoht3cqdbgxedecvcgurfg2rk4c'
+    assert hit_pack_v2(files[::-1]) == key
+    assert hit_pack_v2(files[1:]) != key
+    with temp_source_cache() as sc:
+        assert sc.put(files, pack_version=2) == key
+        assert sc.put(files) == hit_pack(files)
+        assert sc.read_files(key) == sorted(files)
+        assert sc.read_files(key, ['a/b']) == [('a/b', 'in a subdir')]
+        assert sc.read_files(hit_pack(files), ['a/b']) == [('a/b', 'in a subdir')]
+        with temp_dir() as d:
+            sc.unpack(key, d)
+            with file(pjoin(d, 'a', 'c')) as f:
+                assert f.read() == 'x' * 3000000
+            assert sorted(os.listdir(d)) == ['a', 'bar', 'foo']
+
+    pack = stream.getvalue()
+    with temp_dir() as d:
+        def open_pack(contents):
+            with file(pjoin(d, 'pack'), 'w') as f:
+                f.write(contents)
+            with file(pjoin(d, 'pack')) as f:
+                return IndexedHitPack(f, key)
+        p = open_pack(pack)
+        assert p.filenames() == ['a/b', 'a/c', 'bar', 'foo']
+        assert p.read('foo') == 'contains foo'
+        with assert_raises(KeyNotFoundError):
+            p.read('nonexisting')
+        p.close()
+        # corrupt contents are detected per file, the index is verified on opening
+        p = open_pack(pack.replace('in a subdir', 'in a subdiR'))
+        assert p.read('foo') == 'contains foo'
+        with assert_raises(CorruptSourceCacheError):
+            p.read('a/b')
+        p.close()
+        with assert_raises(CorruptSourceCacheError):
+            open_pack(pack.replace('foo', 'fOo'))
+        with assert_raises(CorruptSourceCacheError):
+            open_pack(pack[:20])
+        # the file count in the trailer is not covered by the key
+        index_offset, count, magic = struct.unpack('<QI8s', pack[-20:])
+        for bad_count in [count - 1, count + 1]:
+            with assert_raises(CorruptSourceCacheError):
+                open_pack(pack[:-20] + struct.pack('<QI8s', index_offset, bad_count, magic))
+
 def test_scatter_files():
     files = [('foo', 'contains foo'),
              ('bar', 'contains bar'),
@@ -0,0 +1,43 @@
+import os
+import sys
+import errno
+import subprocess
+from nose.tools import eq_
+
+from .utils import assert_raises
+from .. import spawn
+
+list_fds = [sys.executable, '-c',
+            'import os, sys; sys.stdout.write(" ".join(sorted(os.listdir("/proc/self/fd"))))']
+
+def test_close_fds():
+    if not os.path.isdir('/proc/self/fd'):
+        from nose import SkipTest
+        raise SkipTest('needs /proc/self/fd')
+    r, w = os.pipe()
+    try:
+        p = spawn.Popen(list_fds, stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        # the listing itself opens one fd
+        assert len(out.split()) == 4, out
+        # ...unless explicitly asked not to
+        p = spawn.Popen(list_fds, stdout=subprocess.PIPE, close_fds=False)
+        out, _ = p.communicate()
+        assert str(r) in out.split() and str(w) in out.split()
+    finally:
+        os.close(r)
+        os.close(w)
+
+def test_exec_errors():
+    # the pipe reporting exec() errors must survive the closing of fds
+    with assert_raises(OSError):
+        spawn.Popen(['/nonexisting/command'])
+    try:
+        spawn.check_call(['/nonexisting/command'])
+    except OSError as e:
+        eq_(errno.ENOENT, e.errno)
+    else:
+        assert False
+    eq_(0, spawn.call(['true']))
+    with assert_raises(subprocess.CalledProcessError):
+        spawn.check_call(['false'])
@@ -12,8 +12,29 @@ The loader is based on `SafeConstructor`, i.e., the behaviour of
  - Every string is always returned as unicode, no ASCII-ficiation is
    attempted.
 
+ - The marks are :class:`CompactMark` instances, which only store the
+   file name and the line and column. Together with the node classes
+   using ``__slots__`` this keeps memory use down when many files are
+   loaded.
+
+Parsing with the pure-Python loader is slow, so :func:`load_yaml_from_file`
+can be given a cache (e.g., a :class:`~hashdist.core.cache.DiskCache`)
+where the parsed documents, including their marks, are stored keyed by
+a hash of the file contents after parameter expansion.
+
+If PyYAML is installed together with its libyaml-based C extension,
+:class:`MarkedLoader` is :class:`CMarkedLoader`, which does the
+scanning, parsing and composing in C. Otherwise it is the pure-Python
+:class:`PyMarkedLoader` built on the vendored ``hashdist.deps.yaml``.
+Both produce the same documents, marks and error messages.
+
 """
 
+import re
+import hashlib
+import cPickle as pickle
+from StringIO import StringIO
+
 from hashdist.deps.yaml.error import Mark
 from hashdist.deps.yaml.composer import Composer
 from hashdist.deps.yaml.reader import Reader
@@ -21,11 +42,18 @@ from hashdist.deps.yaml.scanner import Scanner
 from hashdist.deps.yaml.composer import Composer
 from hashdist.deps.yaml.resolver import Resolver
 from hashdist.deps.yaml.parser import Parser
+from hashdist.deps.yaml.nodes import ScalarNode, SequenceNode, MappingNode
 from hashdist.deps.yaml.constructor import (Constructor, BaseConstructor, SafeConstructor,
                                             ConstructorError)
 from hashdist.deps.yaml import dump as _orig_yaml_dump
 from hashdist.deps import jsonschema
 
+try:
+    import yaml as _yaml_module
+    from yaml.cyaml import CParser as _CParser
+except ImportError:
+    _CParser = None
+
 from .templated_stream import TemplatedStream
 
 def _find_mark(doc):
@@ -45,9 +73,56 @@ def _find_mark(doc):
     else:
         return None
 
+_interned_names = {}
+
+class CompactMark(object):
+    """
+    A position in a YAML file, used in place of
+    :class:`hashdist.deps.yaml.error.Mark`. Only the (interned) file name
+    and the line and column, packed in one integer, are stored; the
+    snippet is created by re-reading the file when asked for.
+    """
+    __slots__ = ('name', '_position')
+
+    def __init__(self, name, line, column):
+        self.name = _interned_names.setdefault(name, name)
+        self._position = (line << 32) | column
+
+    @staticmethod
+    def from_mark(mark):
+        return CompactMark(mark.name, mark.line, mark.column)
+
+    @property
+    def line(self):
+        return self._position >> 32
+
+    @property
+    def column(self):
+        return self._position & 0xffffffff
+
+    def __reduce__(self):
+        return (CompactMark, (self.name, self.line, self.column))
+
+    def get_snippet(self, indent=4, max_length=75):
+        try:
+            with open(self.name) as f:
+                lines = f.read().decode('utf-8').splitlines()
+        except (IOError, UnicodeDecodeError):
+            return None
+        if self.line >= len(lines):
+            return None
+        line = lines[self.line]
+        mark = Mark(self.name, None, self.line, self.column, line + u'\0',
+                    min(self.column, len(line)))
+        return mark.get_snippet(indent, max_length)
+
+    def __str__(self):
+        # like Mark without a buffer; the snippet is only added on request
+        return '  in "%s", line %d, column %d' % (self.name, self.line + 1, self.column + 1)
+
 class ValidationError(Exception):
     def __init__(self, mark, message=None, wrapped=None):
-        if not isinstance(mark, Mark):
+        if not isinstance(mark, (Mark, CompactMark)):
             mark = _find_mark(mark)
         self.mark = mark
         self.message = message
@@ -67,6 +142,8 @@ class ExpectedKeyMissingError(KeyError, ValidationError):
 
 def create_node_class(cls, name=None):
     class node_class(cls):
+        __slots__ = ('start_mark', 'end_mark')
+
         def __init__(self, x, start_mark, end_mark):
             if cls is not object:
                 cls.__init__(self, x)
@@ -79,6 +156,11 @@ def create_node_class(cls, name=None):
             else:
                 return object.__new__(self)
 
+        def __reduce__(self):
+            # pickle through the constructor, as __new__ needs the marks
+            value = cls(self) if cls is not object else None
+            return (type(self), (value, self.start_mark, self.end_mark))
+
     node_class.__name__ = name if name else '%s_node' % cls.__name__
     return node_class
 
@@ -86,6 +168,8 @@ list_node = create_node_class(list)
 int_node = create_node_class(int)
 unicode_node_base = create_node_class(unicode)
 class unicode_node(unicode_node_base):
+    __slots__ = ()
+
     # override to drop the irritating u in reprs, as it will be in Python 3 anyway
     def __repr__(self):
         r = unicode_node_base.__repr__(self)
@@ -94,6 +178,8 @@ class unicode_node(unicode_node_base):
         return r
 
 class null_node(create_node_class(object, name='null_node')):
+    __slots__ = ()
+
     def __nonzero__(self):
         return False
 
@@ -104,6 +190,8 @@ def is_null(x):
     return type(x) is null_node or x is None
 
 class dict_node(create_node_class(dict)):
+    __slots__ = ()
+
     def __getitem__(self, key):
         try:
             return dict.__getitem__(self, key)
@@ -120,6 +208,16 @@ def copy_dict_node(d):
     else:
         return dict(d)
 
+def copy_list_node(lst):
+    """
+    Makes a copy of the list `lst`, preserving list_node status if it is a
+    list_node, otherwise returning a list.
+    """
+    if isinstance(lst, list_node):
+        return list_node(lst, lst.start_mark, lst.end_mark)
+    else:
+        return list(lst)
+
 def dict_like(d):
     """
     Make a new dict, preserving any start/end marks of `d`.
@@ -135,25 +233,28 @@ class NodeConstructor(SafeConstructor):
     # laziness we omit this behaviour (and will only do "deep
     # construction") by first exhausting iterators, then yielding
     # copies.
+    def node_marks(self, node):
+        return CompactMark.from_mark(node.start_mark), CompactMark.from_mark(node.end_mark)
+
     def construct_yaml_map(self, node):
         obj, = SafeConstructor.construct_yaml_map(self, node)
-        return dict_node(obj, node.start_mark, node.end_mark)
+        return dict_node(obj, *self.node_marks(node))
 
     def construct_yaml_seq(self, node):
         obj, = SafeConstructor.construct_yaml_seq(self, node)
-        return list_node(obj, node.start_mark, node.end_mark)
+        return list_node(obj, *self.node_marks(node))
 
     def construct_yaml_str(self, node):
         obj = SafeConstructor.construct_scalar(self, node)
         assert isinstance(obj, unicode)
-        return unicode_node(obj, node.start_mark, node.end_mark)
+        return unicode_node(obj, *self.node_marks(node))
 
     def construct_yaml_int(self, node):
         obj = SafeConstructor.construct_yaml_int(self, node)
-        return int_node(obj, node.start_mark, node.end_mark)
+        return int_node(obj, *self.node_marks(node))
 
     def construct_yaml_null(self, node):
-        return null_node(None, node.start_mark, node.end_mark)
+        return null_node(None, *self.node_marks(node))
 
 NodeConstructor.add_constructor(
         u'tag:yaml.org,2002:map',
@@ -176,7 +277,7 @@ NodeConstructor.add_constructor(
         NodeConstructor.construct_yaml_null)
 
 
-class MarkedLoader(Reader, Scanner, Parser, Composer, NodeConstructor, Resolver):
+class PyMarkedLoader(Reader, Scanner, Parser, Composer, NodeConstructor, Resolver):
     def __init__(self, stream, filecaption):
         Reader.__init__(self, stream, filecaption)
         Scanner.__init__(self)
@@ -185,18 +286,128 @@ class MarkedLoader(Reader, Scanner, Parser, Composer, NodeConstructor, Resolver)
         SafeConstructor.__init__(self)
         Resolver.__init__(self)
 
-def marked_yaml_load(stream, filecaption=None):
-    return MarkedLoader(stream, filecaption).get_single_data()
-
+if _CParser is None:
+    CMarkedLoader = None
+    MarkedLoader = PyMarkedLoader
+else:
+    _node_classes = {
+        _yaml_module.nodes.ScalarNode: ScalarNode,
+        _yaml_module.nodes.SequenceNode: SequenceNode,
+        _yaml_module.nodes.MappingNode: MappingNode,
+        }
+
+    _line_break_re = re.compile(u'\r\n|[\n\r\x85\u2028\u2029]')
+
+    class CMarkedLoader(_CParser, NodeConstructor, Resolver):
+        """
+        Uses the libyaml-based parser of PyYAML to compose the node
+        graph, which is then translated to ``hashdist.deps.yaml`` nodes
+        and marks and constructed like in :class:`PyMarkedLoader`.
+
+        libyaml reports errors differently, so if it fails the stream
+        is parsed again with :class:`PyMarkedLoader` to get the same
+        error (or document) as without libyaml.
+        """
+        def __init__(self, stream, filecaption):
+            if hasattr(stream, 'read'):
+                name = getattr(stream, 'name', '<file>')
+                stream = stream.read()
+                fallback_stream = StringIO(stream)
+                fallback_stream.name = name
+            else:
+                name = '<unicode string>' if isinstance(stream, unicode) else '<string>'
+                fallback_stream = stream
+            self.fallback_args = (fallback_stream, filecaption)
+            self.mark_name = name if filecaption is None else filecaption
+            # libyaml adds a line break at the end of the stream if it is
+            # missing, which shows up in the marks at the end of the stream
+            text = stream if isinstance(stream, unicode) else stream.decode('utf-8', 'replace')
+            self.eof_mark = None
+            if text and text[-1] not in u'\n\r\x85\u2028\u2029':
+                lines = _line_break_re.split(text)
+                self.eof_mark = (len(lines), len(lines) - 1, len(lines[-1]), len(text))
+            _CParser.__init__(self, stream)
+            SafeConstructor.__init__(self)
+            Resolver.__init__(self)
+
+        def resolve(self, kind, value, implicit):
+            return Resolver.resolve(self, _node_classes[kind], value, implicit)
+
+        def _convert_mark(self, mark):
+            if self.eof_mark is not None and (mark.line, mark.column) == (self.eof_mark[0], 0):
+                line, column, index = self.eof_mark[1:]
+            else:
+                line, column, index = mark.line, mark.column, mark.index
+            return Mark(self.mark_name, index, line, column, None, None)
+
+        def _convert_node(self, node, converted):
+            result = converted.get(id(node))
+            if result is not None:
+                return result
+            cls = _node_classes[type(node)]
+            start_mark = self._convert_mark(node.start_mark)
+            end_mark = self._convert_mark(node.end_mark)
+            if cls is ScalarNode:
+                result = ScalarNode(node.tag, node.value, start_mark, end_mark, node.style)
+            else:
+                result = cls(node.tag, [], start_mark, end_mark, node.flow_style)
+            converted[id(node)] = result
+            if cls is SequenceNode:
+                result.value.extend(self._convert_node(item, converted) for item in node.value)
+            elif cls is MappingNode:
+                result.value.extend((self._convert_node(key, converted),
+                                     self._convert_node(item, converted))
+                                    for key, item in node.value)
+            return result
+
+        def get_single_node(self):
+            try:
+                node = _CParser.get_single_node(self)
+            except _yaml_module.YAMLError:
+                return PyMarkedLoader(*self.fallback_args).get_single_node()
+            if node is None:
+                return None
+            return self._convert_node(node, {})
+
+    MarkedLoader = CMarkedLoader
+
+def marked_yaml_load(stream, filecaption=None, Loader=None):
+    if Loader is None:
+        Loader = MarkedLoader
+    return Loader(stream, filecaption).get_single_data()
+
+
+# Bump when the node classes change, to invalidate parse caches
+PARSE_CACHE_VERSION = 2
+
+def load_yaml_from_file(filename, parameters=None, filecaption=None, cache=None):
+    """
+    Loads a YAML file after expanding ``{{var}}`` from `parameters`.
 
-def load_yaml_from_file(filename, parameters=None, filecaption=None):
+    If `cache` is given, it is used to look up and store the parsed
+    document, keyed by the expanded file contents and the name used in
+    the marks. Each call returns a fresh copy of the document, so it is
+    safe to modify the result.
+    """
     if parameters == None: parameters = {}
 
     with open(filename) as file_stream:
         expanded_stream = TemplatedStream(file_stream, parameters)
-        expanded_stream.name = filename
+    expanded_stream.name = filename
+    if cache is None:
         return marked_yaml_load(expanded_stream, filecaption)
 
+    name = filename if filecaption is None else filecaption
+    key = ('marked_yaml', PARSE_CACHE_VERSION, name,
+           hashlib.sha256(expanded_stream.getvalue()).hexdigest())
+    pickled = cache.get(__name__, key, None)
+    if pickled is None:
+        doc = marked_yaml_load(expanded_stream, filecaption)
+        cache.put(__name__, key, pickle.dumps(doc, protocol=2))
+        return doc
+    else:
+        return pickle.loads(pickled)
+
 def validate_yaml(doc, schema):
     try:
         jsonschema.validate(doc, schema)
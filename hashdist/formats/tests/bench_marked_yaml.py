@@ -0,0 +1,82 @@
+"""
+Benchmarks for the loaders of :mod:`hashdist.formats.marked_yaml`
+=================================================================
+
+Loading a profile parses every package YAML file of the stack, so the
+speed of the marked YAML loader shows up directly in the time ``hit``
+takes to load a profile (when the parse cache is cold). This module
+times :class:`PyMarkedLoader` against :class:`CMarkedLoader` on the
+YAML files of the spec test corpus (``hashdist/spec/tests``) and the
+bundled configuration files. The files are read into memory first, so
+only parsing, composing and constructing the nodes is timed.
+
+Run the benchmarks with::
+
+    python -m hashdist.formats.tests.bench_marked_yaml [--quick] [name ...]
+
+By default every file is loaded 50 times per loader; ``--quick`` uses
+5 rounds. If PyYAML with libyaml is not installed, only the pure-Python
+loader is timed.
+"""
+
+import sys
+import os
+from os.path import join as pjoin
+import time
+
+from ..marked_yaml import marked_yaml_load, PyMarkedLoader, CMarkedLoader
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+CORPUS_DIRS = [pjoin(_ROOT, 'spec', 'tests'), pjoin(_ROOT, 'formats'), pjoin(_ROOT, 'util')]
+
+
+def load_corpus():
+    """Returns a sorted list of (filename, contents) of the YAML files of the corpus"""
+    corpus = []
+    for corpus_dir in CORPUS_DIRS:
+        for dirpath, dirnames, filenames in os.walk(corpus_dir):
+            for fname in filenames:
+                if fname.endswith('.yaml'):
+                    with open(pjoin(dirpath, fname)) as f:
+                        corpus.append((pjoin(dirpath, fname), f.read()))
+    return sorted(corpus)
+
+LOADERS = [('PyMarkedLoader', PyMarkedLoader), ('CMarkedLoader', CMarkedLoader)]
+
+
+def run_benchmark(Loader, corpus, rounds):
+    """
+    Returns the seconds it takes to load every file of `corpus` `rounds` times.
+    """
+    t0 = time.time()
+    for i in range(rounds):
+        for filename, contents in corpus:
+            marked_yaml_load(contents, filename, Loader=Loader)
+    return time.time() - t0
+
+def main(args):
+    quick = '--quick' in args
+    selected = [arg for arg in args if not arg.startswith('-')]
+    rounds = 5 if quick else 50
+    corpus = load_corpus()
+    nbytes = sum(len(contents) for filename, contents in corpus)
+    print '%d files, %d bytes, %d rounds' % (len(corpus), nbytes, rounds)
+    print '%-20s %10s %12s %10s %8s' % ('loader', 'total', 'time/file', 'MB/s', 'speedup')
+    baseline = None
+    for name, Loader in LOADERS:
+        if selected and not any(name.startswith(s) for s in selected):
+            continue
+        if Loader is None:
+            print '%-20s %10s   (PyYAML with libyaml not available)' % (name, '-')
+            continue
+        elapsed = run_benchmark(Loader, corpus, rounds)
+        if baseline is None:
+            baseline = elapsed
+        per_file = elapsed / (rounds * len(corpus))
+        throughput = nbytes * rounds / elapsed / 1e6
+        print '%-20s %9.3fs %10.3fms %10.2f %7.1fx' % (name, elapsed, per_file * 1e3,
+                                                       throughput, baseline / elapsed)
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,9 +1,14 @@
+import os
+import tempfile
+import shutil
+from os.path import join as pjoin
+
 from ..marked_yaml import marked_yaml_load
 
+def loc(obj):
+    return (obj.start_mark.line, obj.start_mark.column, obj.end_mark.line, obj.end_mark.column)
+
 def test_marked_yaml():
-    def loc(obj):
-        return (obj.start_mark.line, obj.start_mark.column, obj.end_mark.line, obj.end_mark.column)
-    
     d = marked_yaml_load( # note: test very sensitive to whitespace in string below
     '''\
     a:
@@ -21,3 +26,100 @@ def test_marked_yaml():
     assert isinstance(d['f'], dict)
     assert isinstance(d['a'], list)
 
+
+def test_load_yaml_from_file_cached():
+    from ...core.cache import DiskCache
+    from ..marked_yaml import load_yaml_from_file, raw_tree, ValidationError
+    d = tempfile.mkdtemp()
+    try:
+        filename = pjoin(d, 'test.yaml')
+        with open(filename, 'w') as f:
+            f.write('a: {{X}}\nb: [c, 3, null]\n')
+        cache = DiskCache(pjoin(d, 'cache'))
+        expected = load_yaml_from_file(filename, {'X': 'x'})
+        for i in range(2):
+            # first from parse, then from the cache on disk
+            doc = load_yaml_from_file(filename, {'X': 'x'}, cache=DiskCache(pjoin(d, 'cache')))
+            assert raw_tree(doc) == raw_tree(expected)
+            assert type(doc['b'][2]) is type(expected['b'][2])
+            assert loc(doc['b'][1]) == loc(expected['b'][1])
+            assert doc['a'].start_mark.name == filename
+            assert (str(ValidationError(doc['b'], 'msg')) ==
+                    str(ValidationError(expected['b'], 'msg')))
+        # results are copies, and the expanded contents are part of the key
+        doc['a'] = 'changed'
+        assert load_yaml_from_file(filename, {'X': 'x'}, cache=cache)['a'] == 'x'
+        assert load_yaml_from_file(filename, {'X': 'y'}, cache=cache)['a'] == 'y'
+    finally:
+        shutil.rmtree(d)
+
+
+def test_c_loader_conformance():
+    from nose import SkipTest
+    from ..marked_yaml import PyMarkedLoader, CMarkedLoader
+    if CMarkedLoader is None:
+        raise SkipTest('PyYAML with libyaml not available')
+
+    def mark(m):
+        return (m.name, m.line, m.column)
+
+    def compare(a, b):
+        assert type(a) is type(b), (a, b)
+        if hasattr(a, 'start_mark'):
+            assert mark(a.start_mark) == mark(b.start_mark), (a, b)
+            assert mark(a.end_mark) == mark(b.end_mark), (a, b)
+        if isinstance(a, dict):
+            assert sorted(a.keys()) == sorted(b.keys())
+            for key in a:
+                compare(key, [k for k in b if k == key][0])
+                compare(a[key], b[key])
+        elif isinstance(a, list):
+            assert len(a) == len(b)
+            for x, y in zip(a, b):
+                compare(x, y)
+        elif not isinstance(a, type(None)) and type(a).__name__ != 'null_node':
+            assert a == b
+
+    def load(Loader, s):
+        try:
+            return marked_yaml_load(s, 'caption', Loader=Loader)
+        except Exception as e:
+            return type(e), str(e)
+
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    n = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        for fname in filenames:
+            if fname.endswith('.yaml'):
+                filename = pjoin(dirpath, fname)
+                with open(filename) as f:
+                    py_doc = marked_yaml_load(f, None, Loader=PyMarkedLoader)
+                with open(filename) as f:
+                    compare(py_doc, marked_yaml_load(f, None, Loader=CMarkedLoader))
+                with open(filename) as f:
+                    s = f.read()
+                compare(marked_yaml_load(s, None, Loader=PyMarkedLoader),
+                        marked_yaml_load(s, None, Loader=CMarkedLoader))
+                n += 1
+    assert n > 0
+
+    for s in ['a: [1, 2', 'a: b: c', '- a\nb: c', "a: 'b", '&x a: *y', 'a: *x\n']:
+        assert load(PyMarkedLoader, s) == load(CMarkedLoader, s), s
+
+
+def test_compact_mark():
+    from ..marked_yaml import load_yaml_from_file
+    d = tempfile.mkdtemp()
+    try:
+        filename = pjoin(d, 'test.yaml')
+        with open(filename, 'w') as f:
+            f.write('a:\n  b: [c, d]\n')
+        doc = load_yaml_from_file(filename)
+        mark = doc['a']['b'][1].start_mark
+        assert (mark.name, mark.line, mark.column) == (filename, 1, 9)
+        assert mark.name is doc['a'].start_mark.name
+        assert str(mark) == '  in "%s", line 2, column 10' % filename
+        assert mark.get_snippet() == '      b: [c, d]\n             ^'
+        assert not hasattr(doc['a'], '__dict__')
+    finally:
+        shutil.rmtree(d)
@@ -1,3 +1,7 @@
+import sys
+import threading
+import Queue
+import multiprocessing
 from pprint import pprint
 from . import package
 from . import utils
@@ -9,28 +13,158 @@ from .utils import to_env_var
 from .exceptions import PackageError, ProfileError
 
 
-class ProfileBuilder(object):
+# The ProfileBuilder whose work is being done by a process pool; set before
+# the pool is created, so that the worker processes inherit it
+_pool_builder = None
+
+# Errors in the specs are left to the parent process, which redoes the
+# failed package serially and reports them; anything else is raised in
+# the parent by the pool
+
+def _load_package_spec_in_pool(pkgname):
+    try:
+        return package.PackageSpec.load(_pool_builder.profile, pkgname)
+    except (ProfileError, PackageError), e:
+        _pool_builder.logger.debug('Loading %s in the pool failed: %s' % (pkgname, e))
+        return None
+
+def _compute_build_spec_in_pool(args):
+    pkgname, dependency_ids = args
+    try:
+        return _pool_builder._compute_build_spec(pkgname, dependency_ids).doc
+    except (ProfileError, PackageError), e:
+        _pool_builder.logger.debug('Computing the build spec of %s in the pool failed: %s'
+                                   % (pkgname, e))
+        return None
+
+
+class ProfileBuilderBase(object):
+    """
+    Building the packages of a profile in dependency order, shared by
+    :class:`ProfileBuilder` and
+    :class:`~hashdist.spec.lock.LockedProfileBuilder`.
+
+    Subclasses set ``self._package_specs`` to ``{pkgname: package}``,
+    where each package has ``name``, ``build_deps`` and
+    ``fetch_sources(source_cache)`` like
+    :class:`~hashdist.spec.package.PackageSpec`, ``self._built`` to the
+    set of packages already built and ``self._prefetcher`` to None, and
+    provide ``get_build_spec(pkgname)``.
+    """
+    def get_ready_list(self):
+        ready = []
+        for name, pkg in self._package_specs.iteritems():
+            if name in self._built:
+                continue
+            if all(dep_name in self._built for dep_name in pkg.build_deps):
+                ready.append(name)
+        return ready
+
+    def prefetch_sources(self, fetch_jobs):
+        """
+        Start fetching the sources of every package that still needs
+        to be built, using `fetch_jobs` background threads.
+
+        Subsequent calls to :meth:`build` then only wait for the
+        sources of the package being built, so that downloads of
+        packages further up the dependency graph overlap with the
+        builds of the packages below them.
+        """
+        if self._prefetcher is not None or fetch_jobs < 1:
+            return
+        # Fetch in the order packages are likely to be built
+        get_build_deps = lambda pkgname: self._package_specs[pkgname].build_deps
+        pkgnames = [pkgname for pkgname in utils.topological_sort(self._package_specs.keys(),
+                                                                  get_build_deps)
+                    if pkgname not in self._built]
+        self._prefetcher = SourcePrefetcher(self.logger, self.source_cache, fetch_jobs)
+        self._prefetcher.start([self._package_specs[pkgname] for pkgname in pkgnames])
+
+    def build(self, pkgname, config, worker_count, keep_build='never', debug=False):
+        if self._prefetcher is not None and self._prefetcher.is_scheduled(pkgname):
+            self._prefetcher.wait(pkgname)
+        else:
+            self._package_specs[pkgname].fetch_sources(self.source_cache)
+        extra_env = {'HASHDIST_CPU_COUNT': str(worker_count)}
+        self.build_store.ensure_present(self.get_build_spec(pkgname), config, extra_env=extra_env,
+                                        keep_build=keep_build, debug=debug)
+        self._built.add(pkgname)
+
+
+class ProfileBuilder(ProfileBuilderBase):
     """
     What can be known of a profile when all referenced package specs are loaded.
     Used to maintain state during the building process.
+
+    If `jobs` is larger than 1, the package specs are loaded and the
+    build specs computed by a pool of that many processes, in waves of
+    packages whose dependencies are done. Anything that fails in the
+    pool is redone in this process, so errors are reported as usual.
+    The workers inherit the builder by forking; what they send back is
+    pickled (see :meth:`_load_packages_in_pool` and
+    :meth:`_compute_specs_in_pool`).
     """
-    def __init__(self, logger, source_cache, build_store, profile):
+    def __init__(self, logger, source_cache, build_store, profile, jobs=1):
         self.logger = logger
         self.source_cache = source_cache
         self.build_store = build_store
         self.profile = profile
+        self.jobs = jobs
 
         self._built = set()  # cache for build_store
         self._in_progress = set()
         self._build_specs = {} # { pkgname : BuildSpec }
+        self._prefetcher = None
 
         self._load_packages()
         self._compute_specs()
 
 
+    def _create_pool(self, size):
+        global _pool_builder
+        _pool_builder = self
+        try:
+            return multiprocessing.Pool(min(self.jobs, size))
+        finally:
+            _pool_builder = None
+
+    def _map_in_pool(self, pool, func, items):
+        # map_async with a timeout, so that KeyboardInterrupt is not blocked
+        return pool.map_async(func, items).get(1e9)
+
+    def _load_packages_in_pool(self):
+        """
+        Returns ``{pkgname: PackageSpec}`` for the packages that could be
+        loaded by the process pool.
+
+        The workers send back whole :class:`~hashdist.spec.package.PackageSpec`
+        objects, pickled: the package document with its marked YAML nodes
+        (including their marks), the hook file names and the parameters.
+        For a large profile this is the bulk of what crosses the process
+        boundary; the parent then owns these objects as if it had loaded
+        them itself.
+        """
+        loaded = {}
+        pool = self._create_pool(len(self.profile.packages))
+        try:
+            wave = sorted(self.profile.packages.keys())
+            while wave:
+                specs = self._map_in_pool(pool, _load_package_spec_in_pool, wave)
+                for pkgname, spec in zip(wave, specs):
+                    if spec is not None:
+                        loaded[pkgname] = spec
+                wave = sorted(set(dep for spec in specs if spec is not None
+                                  for dep in spec.build_deps + spec.run_deps
+                                  if dep not in loaded and dep not in wave))
+        finally:
+            pool.terminate()
+            pool.join()
+        return loaded
+
     def _load_packages(self):
         self._package_specs = {}
         visiting = set()
+        loaded = self._load_packages_in_pool() if self.jobs > 1 else {}
 
         def visit(pkgname):
             if pkgname not in self._package_specs:
@@ -38,7 +172,9 @@ class ProfileBuilder(object):
                     raise ProfileError(pkgname, 'dependency cycle between packages, '
                                        'including package "%s"' % pkgname)
                 visiting.add(pkgname)
-                spec = package.PackageSpec.load(self.profile, pkgname)
+                spec = loaded.get(pkgname, None)
+                if spec is None:
+                    spec = package.PackageSpec.load(self.profile, pkgname)
                 self._package_specs[pkgname] = spec
                 for dep in spec.build_deps + spec.run_deps:
                     visit(dep)
@@ -56,20 +192,12 @@ class ProfileBuilder(object):
 
         We know at this point that there's no cycles.
         """
-        python_path = self.profile.hook_import_dirs
+        if self.jobs > 1:
+            self._compute_specs_in_pool()
 
         def process(pkgname, pkgspec):
-            with hook.python_path_and_modules_sandbox(python_path):
-                ctx = self._load_package_build_context(pkgname, pkgspec)
-                self._build_specs[pkgname] = pkgspec.assemble_build_spec(
-                    self.source_cache,
-                    ctx,
-                    lambda dep_name: self._build_specs[dep_name].artifact_id,
-                    self._package_specs,
-                    self.profile)
-            # check whether package is already built, and update self._built
-            if self.build_store.is_present(self._build_specs[pkgname]):
-                self._built.add(pkgname)
+            self._build_specs[pkgname] = self._compute_build_spec(
+                pkgname, lambda dep_name: self._build_specs[dep_name].artifact_id)
 
         def traverse_depth_first(pkgname):
             if pkgname not in self._build_specs:
@@ -84,18 +212,67 @@ class ProfileBuilder(object):
         for pkgname in self._package_specs:
             traverse_depth_first(pkgname)
 
-    def get_ready_list(self):
-        ready = []
-        for name, pkg in self._package_specs.iteritems():
-            if name in self._built:
-                continue
-            if all(dep_name in self._built for dep_name in pkg.build_deps):
-                ready.append(name)
-        return ready
+        # check whether packages are already built, and update self._built
+        for pkgname, build_spec in self._build_specs.iteritems():
+            if self.build_store.is_present(build_spec):
+                self._built.add(pkgname)
+
+    def _compute_build_spec(self, pkgname, dependency_id_map):
+        pkgspec = self._package_specs[pkgname]
+        with hook.python_path_and_modules_sandbox(self.profile.hook_import_dirs):
+            ctx = self._load_package_build_context(pkgname, pkgspec)
+            return pkgspec.assemble_build_spec(self.source_cache, ctx, dependency_id_map,
+                                               self._package_specs, self.profile)
+
+    def _compute_specs_in_pool(self):
+        """
+        Computes the build specs in waves of packages whose build
+        dependencies are done. Stops at the first wave where something
+        fails; the rest is left to :meth:`_compute_specs`.
+
+        The workers send back the build spec documents (plain JSON-like
+        data), from which :class:`BuildSpec` objects are created here.
+        Files the workers store in the source cache (build scripts and
+        bundled files) are written to disk by the workers themselves.
+        """
+        remaining = set(self._package_specs.keys())
+        pool = self._create_pool(len(remaining))
+        try:
+            while remaining:
+                wave = sorted(pkgname for pkgname in remaining
+                              if all(dep in self._build_specs
+                                     for dep in self._package_specs[pkgname].build_deps))
+                if not wave:
+                    break
+                tasks = [(pkgname, dict((dep, self._build_specs[dep].artifact_id)
+                                        for dep in self._package_specs[pkgname].build_deps))
+                         for pkgname in wave]
+                docs = self._map_in_pool(pool, _compute_build_spec_in_pool, tasks)
+                for pkgname, doc in zip(wave, docs):
+                    if doc is not None:
+                        self._build_specs[pkgname] = BuildSpec(doc)
+                        remaining.remove(pkgname)
+                if None in docs:
+                    break
+        finally:
+            pool.terminate()
+            pool.join()
 
     def get_build_spec(self, pkgname):
         return self._build_specs[pkgname]
 
+    def get_package_specs(self):
+        """
+        Return ``{pkgname: package_spec}`` for all packages in the profile.
+        """
+        return dict(self._package_specs)
+
+    def get_build_specs(self):
+        """
+        Return ``{pkgname: build_spec}`` for all packages in the profile.
+        """
+        return dict(self._build_specs)
+
     def get_build_script(self, pkgname):
         python_path = self.profile.hook_import_dirs
         with hook.python_path_and_modules_sandbox(python_path):
@@ -143,13 +320,6 @@ class ProfileBuilder(object):
                 }
             })
 
-    def build(self, pkgname, config, worker_count, keep_build='never', debug=False):
-        self._package_specs[pkgname].fetch_sources(self.source_cache)
-        extra_env = {'HASHDIST_CPU_COUNT': str(worker_count)}
-        self.build_store.ensure_present(self._build_specs[pkgname], config, extra_env=extra_env,
-                                        keep_build=keep_build, debug=debug)
-        self._built.add(pkgname)
-
     def build_profile(self, config):
         profile_build_spec = self.get_profile_build_spec()
         return self.build_store.ensure_present(profile_build_spec, config)
@@ -168,5 +338,87 @@ class ProfileBuilder(object):
         hook_files = [self.profile.resolve(fname) for fname in pkgspec.hook_files]
         dep_vars = [to_env_var(x) for x in self._package_specs[pkgname].build_deps]
         ctx = hook_api.PackageBuildContext(pkgname, dep_vars, pkgspec.parameters)
-        hook.load_hooks(ctx, hook_files)
+        hook.load_hooks(ctx, hook_files, self.profile.parse_cache)
         return ctx
+
+
+class _SerializedFetches(object):
+    """
+    Wraps a source cache so that concurrent fetches of git sources with
+    the same `repo_name` (which share a bare repository, where git
+    takes locks) or of the same key take turns. Everything else is
+    passed through to the source cache.
+    """
+    def __init__(self, source_cache):
+        self._source_cache = source_cache
+        self._locks = {} # { ('git', repo_name) or ('key', key) : threading.Lock }
+        self._locks_lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self._source_cache, name)
+
+    def fetch(self, url, key, repo_name=None):
+        if key is not None and key.startswith('git:'):
+            lock_key = ('git', repo_name)
+        else:
+            lock_key = ('key', key if key is not None else url)
+        with self._locks_lock:
+            lock = self._locks.setdefault(lock_key, threading.Lock())
+        with lock:
+            return self._source_cache.fetch(url, key, repo_name)
+
+
+class SourcePrefetcher(object):
+    """
+    Fetches the sources of a set of packages concurrently in background
+    threads.
+
+    The fetches are queued in the order given to :meth:`start`;
+    :meth:`wait` blocks until the sources of a single package are
+    present in the source cache, re-raising any exception that occurred
+    while fetching them. Fetches into the same git mirror, or of the
+    same key, are serialized (see :class:`_SerializedFetches`).
+    """
+    def __init__(self, logger, source_cache, fetch_jobs):
+        self.logger = logger
+        self.source_cache = _SerializedFetches(source_cache)
+        self.fetch_jobs = fetch_jobs
+        self._queue = Queue.Queue()
+        self._done = {} # { pkgname : threading.Event }
+        self._errors = {} # { pkgname : exc_info }
+
+    def start(self, package_specs):
+        for spec in package_specs:
+            self._done[spec.name] = threading.Event()
+            self._queue.put(spec)
+        for i in range(min(self.fetch_jobs, len(package_specs))):
+            thread = threading.Thread(target=self._worker, name='hit-fetch-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                spec = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                spec.fetch_sources(self.source_cache)
+            except:
+                self._errors[spec.name] = sys.exc_info()
+            finally:
+                self._done[spec.name].set()
+
+    def is_scheduled(self, pkgname):
+        return pkgname in self._done
+
+    def wait(self, pkgname):
+        done = self._done[pkgname]
+        if not done.is_set():
+            self.logger.info('Waiting for sources of %s' % pkgname)
+        # wait with a timeout so that KeyboardInterrupt is delivered
+        while not done.is_set():
+            done.wait(1)
+        if pkgname in self._errors:
+            exc_type, exc_value, exc_tb = self._errors[pkgname]
+            raise exc_type, exc_value, exc_tb
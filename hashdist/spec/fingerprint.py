@@ -0,0 +1,149 @@
+"""
+:mod:`hashdist.spec.fingerprint` --- Caching of profile build specs
+===================================================================
+
+Loading a profile and assembling the build specs of all its packages
+involves parsing every package YAML file, running the hook files and
+uploading build scripts to the source cache; for large stacks this
+takes far longer than checking whether the resulting artifacts are
+already built.
+
+The :class:`ProfileSpecCache` therefore stores the assembled build
+specs of a profile together with a fingerprint of every input that
+went into them: the profile files, the contents of the
+``package_dirs`` and ``hook_import_dirs`` (which includes bundled
+files), the override parameters and the HashDist sources themselves.
+The fingerprint only looks at file names, sizes and modification
+times, so computing it is cheap. Directories in temporary checkouts
+(``<repo_name>/some/path``) are not looked at; those are identified by
+their key in the profile files.
+
+The cached build specs can only be used to check whether things are up
+to date; anything that needs to build falls back to the full pipeline
+in :class:`~hashdist.spec.builder.ProfileBuilder`.
+"""
+
+import os
+from os.path import join as pjoin
+import hashlib
+import json
+
+from ..core import BuildSpec
+from ..core.cache import DiskCache
+
+import hashdist
+
+IGNORED_DIRS = ('.git', '.hg', '.svn')
+IGNORED_SUFFIXES = ('.pyc', '.pyo')
+
+
+def _is_checkout_path(path):
+    return path.startswith('<')
+
+def _unmarked(s):
+    # strip marked YAML string nodes down to plain, pickleable strings
+    return unicode(s) if isinstance(s, unicode) else s
+
+def fingerprint_inputs(files, dirs):
+    """
+    Returns a fingerprint of the given files and of all files found
+    (recursively) in the given directories.
+
+    Files that do not exist are fingerprinted as such; symlinks to
+    directories (such as profile symlinks) are not followed.
+    """
+    h = hashlib.sha256()
+    for filename in files:
+        if _is_checkout_path(filename):
+            continue
+        try:
+            st = os.stat(filename)
+        except OSError:
+            h.update('missing:%s\0' % filename)
+        else:
+            h.update('file:%s:%d:%r\0' % (filename, st.st_size, st.st_mtime))
+    for d in dirs:
+        if _is_checkout_path(d):
+            continue
+        h.update('dir:%s\0' % d)
+        for dirpath, dirnames, filenames in os.walk(d):
+            dirnames[:] = sorted(x for x in dirnames if x not in IGNORED_DIRS)
+            for fname in sorted(filenames):
+                if fname.endswith(IGNORED_SUFFIXES):
+                    continue
+                path = pjoin(dirpath, fname)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    # dangling symlink
+                    continue
+                h.update('%s:%d:%r\0' % (path[len(d):], st.st_size, st.st_mtime))
+    return h.hexdigest()
+
+
+class ProfileSpecCache(object):
+    """
+    Caches the build specs of a profile, keyed by the profile filename
+    and the override parameters.
+
+    Parameters
+    ----------
+
+    cache : :class:`~hashdist.core.cache.DiskCache`
+
+    profile_file : str
+        Filename of the profile YAML file.
+
+    parameters : dict or ``None``
+        Override parameters given on the command line.
+    """
+    domain = 'hashdist.spec.fingerprint'
+
+    def __init__(self, cache, profile_file, parameters):
+        self.cache = cache
+        self.key = {'profile': os.path.abspath(profile_file),
+                    'parameters': sorted((parameters or {}).items())}
+
+    @staticmethod
+    def create_from_config(config, profile_file, parameters):
+        return ProfileSpecCache(DiskCache(config['cache']), profile_file, parameters)
+
+    def _get_dirs(self, profile):
+        dirs = list(profile.doc.get('package_dirs', [])) + list(profile.hook_import_dirs)
+        dirs.append(os.path.dirname(os.path.realpath(hashdist.__file__)))
+        return sorted(set(_unmarked(d) for d in dirs))
+
+    def get(self):
+        """
+        Returns ``(build_specs, profile_build_spec)``, where `build_specs`
+        is a dict ``{pkgname: BuildSpec}``, if the cache is up to date with
+        the inputs; otherwise ``(None, None)``.
+        """
+        entry = self.cache.get(self.domain, self.key, None)
+        if entry is None:
+            return None, None
+        if fingerprint_inputs(entry['files'], entry['dirs']) != entry['fingerprint']:
+            return None, None
+        build_specs = dict((pkgname, BuildSpec(json.loads(doc)))
+                           for pkgname, doc in entry['build_specs'].iteritems())
+        return build_specs, BuildSpec(json.loads(entry['profile_build_spec']))
+
+    def put(self, profile, profile_builder):
+        """
+        Stores the build specs computed by `profile_builder`. The
+        fingerprint should be computed from the same state of the
+        files that `profile` was loaded from, so this should be called
+        right after the builder is created.
+        """
+        # the documents may contain marked YAML nodes, so store them as JSON
+        files = [_unmarked(f) for f in profile.profile_files]
+        dirs = self._get_dirs(profile)
+        entry = {
+            'files': files,
+            'dirs': dirs,
+            'fingerprint': fingerprint_inputs(files, dirs),
+            'build_specs': dict((_unmarked(pkgname), json.dumps(build_spec.doc)) for pkgname, build_spec
+                                in profile_builder.get_build_specs().iteritems()),
+            'profile_build_spec': json.dumps(profile_builder.get_profile_build_spec().doc),
+            }
+        self.cache.put(self.domain, self.key, entry)
@@ -1,13 +1,23 @@
 """
 Internal side of the Python hook file machinery.
 
-The current strategy is to always reload the .py files for every new
-package build. This makes the @stage_handler decorators execute again
-and register with the global `current_package_context`.
+The hook files are re-executed for every new package build. This makes
+the @stage_handler decorators execute again and register with the
+global `current_package_context`. Each hook file is only compiled once
+though; the code objects are kept in memory, and optionally in a
+:class:`~hashdist.core.cache.DiskCache` keyed by the hash of the
+source.
+
+Modules imported by the hook files stay in ``sys.modules`` between
+packages, except for those found in the hook import directories, which
+are removed by :func:`python_path_and_modules_sandbox`.
 """
 
+import os
 import imp
 import sys
+import marshal
+import hashlib
 import contextlib
 from . import hook_api
 
@@ -15,10 +25,36 @@ HOOK_MOD_NAME = '__hashdist_build_hook__'
 
 current_package_context = None
 
-def load_hooks(ctx, hook_files):
+_compiled_hooks = {} # { (filename, source hash) : code }
+
+def compile_hook(filename, cache=None):
+    """
+    Returns the code object of the hook file `filename`, compiling it
+    only if it is not found in memory or in `cache`.
+    """
+    with open(filename) as f:
+        source = f.read()
+    key = (os.path.abspath(filename), hashlib.sha256(source).hexdigest())
+    code = _compiled_hooks.get(key, None)
+    if code is not None:
+        return code
+    # marshalled code objects are specific to the Python version
+    cache_key = key + (imp.get_magic(),)
+    marshalled = None if cache is None else cache.get(__name__, cache_key, None)
+    if marshalled is not None:
+        code = marshal.loads(marshalled)
+    else:
+        code = compile(source, filename, 'exec')
+        if cache is not None:
+            cache.put(__name__, cache_key, marshal.dumps(code))
+    _compiled_hooks[key] = code
+    return code
+
+def load_hooks(ctx, hook_files, cache=None):
     """
     Takes a newly constructed PackageBuildContext `ctx` and runs hook files given in `hook_files`; these
-    will register callbacks in `ctx` when ran.
+    will register callbacks in `ctx` when ran. `cache` is used to cache the
+    compiled hook files, see :func:`compile_hook`.
     """
     global current_package_context
     assert current_package_context is None
@@ -26,31 +62,51 @@ def load_hooks(ctx, hook_files):
     imp.acquire_lock()
     try:
         current_package_context = ctx  # assign to global var
-        # call imports, which uses decorators that register with current_package_context
+        # run modules, which use decorators that register with current_package_context
         for filename in hook_files:
-            mod = imp.load_source(HOOK_MOD_NAME, filename)
+            code = compile_hook(filename, cache)
+            mod = imp.new_module(HOOK_MOD_NAME)
+            mod.__file__ = filename
+            sys.modules[HOOK_MOD_NAME] = mod
+            try:
+                exec code in mod.__dict__
+            finally:
+                del sys.modules[HOOK_MOD_NAME]
             current_package_context.register_module(mod)
-            del sys.modules[HOOK_MOD_NAME]
     finally:
         imp.release_lock()
         current_package_context = None
 
+def _is_in_dirs(mod, dirs):
+    filename = getattr(mod, '__file__', None)
+    if filename is None:
+        return False
+    filename = os.path.abspath(filename)
+    return any(filename.startswith(d) for d in dirs)
+
 @contextlib.contextmanager
 def python_path_and_modules_sandbox(python_path_entries=()):
     """
     Context manager that temporarily inserts additional entries in sys.path.
-    After exiting the context manager, sys.path and sys.modules are reverted
-    to the contents they had on entry.
+    After exiting the context manager, sys.path is reverted to the contents
+    it had on entry, and modules imported from the additional entries are
+    removed from sys.modules (other modules imported in the meantime are
+    kept, so that they are only imported once).
     """
     old_sys_path = sys.path[:]
     old_modules = dict(sys.modules)
+    dirs = [os.path.join(os.path.abspath(d), '') for d in python_path_entries]
     try:
         sys.path[0:0] = python_path_entries
         yield
     finally:
         sys.path[:] = old_sys_path
-        sys.modules.clear()
-        sys.modules.update(old_modules)
+        for name, mod in sys.modules.items():
+            if name in old_modules:
+                if old_modules[name] is not mod:
+                    sys.modules[name] = old_modules[name]
+            elif mod is None or _is_in_dirs(mod, dirs):
+                del sys.modules[name]
 
 def bash_handler(ctx, stage):
     if 'files' in stage:
@@ -3,7 +3,7 @@ The API exported to Python hook files that are part of stack descriptions.
 A significant portion of the package building logic should eventually find
 its way into here.
 
-Hook files are re-loaded for every package build, and so decorators etc.
+Hook files are re-run for every package build, and so decorators etc.
 are run again. The machinery used to HashDist to load hook files is
 found in .hook.
 """
@@ -0,0 +1,149 @@
+"""
+:mod:`hashdist.spec.lock` --- Compiled profile lock files
+=========================================================
+
+A lock file is a JSON document containing everything needed to build
+a profile once its package specs have been resolved: the build spec of
+every package and of the profile itself, the build and run
+dependencies between packages, the source keys and URLs, and the
+contents of the ``files:`` and ``files2:`` source objects (build scripts and bundled
+files) that are normally created while assembling the build specs.
+
+Build workers can then build from the lock file with
+:class:`LockedProfileBuilder`, without needing the profile and package
+repositories, temporary checkouts or hook files.
+
+The document has the form::
+
+    {
+      "lock_format": 1,
+      "packages": {
+        "zlib": {
+          "build_spec": {...},
+          "build_deps": [],
+          "run_deps": [],
+          "sources": [{"key": "tar.gz:...", "url": "http://..."}]
+        },
+        ...
+      },
+      "profile_build_spec": {...},
+      "files": {"files:...": {"_hashdist/build.sh": "<base64>", ...}}
+    }
+"""
+
+import json
+import base64
+
+from ..core import BuildSpec
+from ..core.source_cache import HIT_PACK_TYPES
+from ..core.common import json_formatting_options
+from .builder import ProfileBuilderBase
+from .exceptions import ProfileError
+
+LOCK_FORMAT = 1
+
+
+def _is_hit_pack_key(key):
+    return key.split(':')[0] in HIT_PACK_TYPES
+
+
+def make_lock_document(profile_builder, source_cache):
+    """
+    Returns the lock document for the profile loaded by `profile_builder`.
+    """
+    packages = {}
+    files = {}
+    for pkgname, package_spec in profile_builder.get_package_specs().iteritems():
+        build_spec = profile_builder.get_build_spec(pkgname)
+        packages[pkgname] = {
+            'build_spec': build_spec.doc,
+            'build_deps': list(package_spec.build_deps),
+            'run_deps': list(package_spec.run_deps),
+            'sources': [{'key': source['key'], 'url': source['url']}
+                        for source in package_spec.doc.get('sources', [])],
+            }
+        for source in build_spec.doc.get('sources', []):
+            if _is_hit_pack_key(source['key']):
+                files[source['key']] = dict(
+                    (filename, base64.b64encode(contents))
+                    for filename, contents in source_cache.read_files(source['key']))
+    return {
+        'lock_format': LOCK_FORMAT,
+        'packages': packages,
+        'profile_build_spec': profile_builder.get_profile_build_spec().doc,
+        'files': files,
+        }
+
+
+def write_lock_document(doc, stream):
+    json.dump(doc, stream, **json_formatting_options)
+    stream.write('\n')
+
+
+class LockedPackage(object):
+    """
+    Stands in for a :class:`~hashdist.spec.package.PackageSpec` when
+    building from a lock file.
+    """
+    def __init__(self, name, doc, files):
+        self.name = name
+        self.build_spec = BuildSpec(doc['build_spec'])
+        self.build_deps = doc['build_deps']
+        self.run_deps = doc['run_deps']
+        self.sources = doc['sources']
+        self.files = files
+
+    def fetch_sources(self, source_cache):
+        for source in self.build_spec.doc.get('sources', []):
+            key = source['key']
+            if _is_hit_pack_key(key):
+                files = [(filename.encode('utf-8'), base64.b64decode(contents))
+                         for filename, contents in self.files[key].iteritems()]
+                pack_version = 2 if key.startswith('files2:') else 1
+                if source_cache.put(files, pack_version) != key:
+                    raise ProfileError(self.name, 'files in lock file do not match key %s' % key)
+        for source in self.sources:
+            source_cache.fetch(source['url'], source['key'], self.name)
+
+
+class LockedProfileBuilder(ProfileBuilderBase):
+    """
+    Builds a profile from a lock file. Provides the subset of the
+    :class:`~hashdist.spec.builder.ProfileBuilder` interface that is
+    needed to build a profile.
+    """
+    def __init__(self, logger, source_cache, build_store, doc):
+        if doc.get('lock_format') != LOCK_FORMAT:
+            raise ProfileError(None, 'unsupported lock file format: %r' % doc.get('lock_format'))
+        self.logger = logger
+        self.source_cache = source_cache
+        self.build_store = build_store
+        files = doc['files']
+        self._package_specs = dict((pkgname, LockedPackage(pkgname, pkg_doc, files))
+                                   for pkgname, pkg_doc in doc['packages'].iteritems())
+        self._profile_build_spec = BuildSpec(doc['profile_build_spec'])
+        self._built = set(pkgname for pkgname, pkg in self._package_specs.iteritems()
+                          if self.build_store.is_present(pkg.build_spec))
+        self._prefetcher = None
+
+    @staticmethod
+    def load(logger, source_cache, build_store, filename):
+        with open(filename) as f:
+            doc = json.load(f)
+        return LockedProfileBuilder(logger, source_cache, build_store, doc)
+
+    def get_build_spec(self, pkgname):
+        return self._package_specs[pkgname].build_spec
+
+    def get_build_specs(self):
+        return dict((pkgname, pkg.build_spec) for pkgname, pkg in self._package_specs.iteritems())
+
+    def get_profile_build_spec(self):
+        return self._profile_build_spec
+
+    def get_status_report(self):
+        return dict((pkgname, (pkg.build_spec, pkgname in self._built))
+                    for pkgname, pkg in self._package_specs.iteritems())
+
+    def build_profile(self, config):
+        return self.build_store.ensure_present(self._profile_build_spec, config)
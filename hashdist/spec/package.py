@@ -25,6 +25,7 @@ class PackageSpec(object):
         self.parameters = parameters
         if not isinstance(self.build_deps, list) or not isinstance(self.run_deps, list):
             raise TypeError('dependencies must be a list')
+        self._build_import_commands = None
 
     @staticmethod
     def load(profile, name):
@@ -52,7 +53,8 @@ class PackageSpec(object):
         package_parameters['package'] = name
         from package_loader import PackageLoader
         loader = PackageLoader(name, package_parameters,
-                               load_yaml=profile.load_package_yaml)
+                               load_yaml=profile.load_package_yaml,
+                               parent_cache=profile.parent_loader_cache)
         return PackageSpec(name, loader.stages_topo_ordered(),
                            loader.get_hook_files(), loader.parameters)
 
@@ -198,10 +200,16 @@ class PackageSpec(object):
     def assemble_build_import_commands(self):
         """
         Return the ``when_build_dependency`` commands from dependencies.
+
+        The commands are frozen (see :func:`hashdist.core.hasher.freeze_document`)
+        and shared by the build specs of all dependents, so that they are
+        only serialized once when hashing.
         """
-        cmds = [self._process_when_build_dependency(env_action)
-                for env_action in self.doc.get('when_build_dependency', [])]
-        return cmds
+        if self._build_import_commands is None:
+            self._build_import_commands = core.freeze_document([
+                self._process_when_build_dependency(env_action)
+                for env_action in self.doc.get('when_build_dependency', [])])
+        return self._build_import_commands
 
     def _process_when_build_dependency(self, action):
         action = dict(action)
@@ -256,4 +264,4 @@ class PackageSpec(object):
                 hit_args.append('--' + arg)
         if len(hit_args) == 0:
             return []
-        return [{'hit': ['build-postprocess'] + hit_args}]
+        return [core.freeze_document({'hit': ['build-postprocess'] + hit_args})]
@@ -11,12 +11,36 @@ import os
 import collections
 from os.path import join as pjoin
 from .profile import eval_condition
-from ..formats.marked_yaml import yaml_dump, copy_dict_node, dict_like, list_node
+from ..formats.marked_yaml import (yaml_dump, copy_dict_node, copy_list_node, dict_like,
+                                   list_node)
 from .utils import topological_sort
 from .. import core
 from .exceptions import ProfileError, PackageError
 
 
+_MISSING = object()
+
+class _RecordingParameters(collections.defaultdict):
+    """
+    Parameters that record the names that are looked up in them, to find
+    out which parameters the loading of a package depends on.
+    """
+    def __init__(self, parameters, accessed):
+        collections.defaultdict.__init__(self, str, parameters)
+        self.accessed = accessed
+
+    def __getitem__(self, key):
+        self.accessed.add(key)
+        return collections.defaultdict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        self.accessed.add(key)
+        return collections.defaultdict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        self.accessed.add(key)
+        return collections.defaultdict.get(self, key, default)
+
 
 class PackageLoaderBase(object):
     """
@@ -34,10 +58,11 @@ class PackageLoaderBase(object):
     The sections to merge, see :meth:`merge_stages` and meth:`topo_order`
     """
 
-    def __init__(self, name, parameters, load_yaml):
+    def __init__(self, name, parameters, load_yaml, parent_cache=None):
         self.name = name
         self.parameters = parameters
         self.load_yaml = load_yaml
+        self.parent_cache = parent_cache
         self.load_documents()
         self.apply_defaults()
         self.process_conditionals()
@@ -71,6 +96,8 @@ class PackageLoaderBase(object):
         defaults = self.doc.pop('defaults', {})
         all_parameters = collections.defaultdict(str, defaults)
         all_parameters.update(self.parameters)
+        if isinstance(self.parameters, _RecordingParameters):
+            all_parameters = _RecordingParameters(all_parameters, self.parameters.accessed)
         self.parameters = all_parameters
 
     def process_conditionals(self):
@@ -107,7 +134,7 @@ class PackageLoaderBase(object):
 
     def _load_parent(self, parent_name):
         """Helper for :meth:`load_parents` """
-        parent = PackageLoaderBase(parent_name, self.parameters, self.load_yaml)
+        parent = self._get_parent_loader(parent_name)
         all_names = set(p.name for p in self.all_parents)
         new_names = set(p.name for p in parent.all_parents)
         if all_names.intersection(new_names):
@@ -118,6 +145,31 @@ class PackageLoaderBase(object):
         self.direct_parents[0:0] = [parent]
         return parent
 
+    def _get_parent_loader(self, parent_name):
+        """
+        Helper for :meth:`_load_parent`.
+
+        Parent loaders are shared between all packages that load them
+        with the same values for the parameters that the parent (and its
+        ancestors) looked up while loading; these are found by loading
+        the parent with :class:`_RecordingParameters`. The memo is
+        `parent_cache`, a dict ``{parent_name: [(names, values, loader)]}``.
+        The documents of the loaders in it must not be modified.
+        """
+        if self.parent_cache is None:
+            return PackageLoaderBase(parent_name, self.parameters, self.load_yaml)
+        entries = self.parent_cache.setdefault(parent_name, [])
+        for names, values, parent in entries:
+            if tuple(self.parameters.get(name, _MISSING) for name in names) == values:
+                return parent
+        accessed = set()
+        parent = PackageLoaderBase(parent_name, _RecordingParameters(self.parameters, accessed),
+                                   self.load_yaml, self.parent_cache)
+        names = sorted(accessed)
+        values = tuple(self.parameters.get(name, _MISSING) for name in names)
+        entries.append((names, values, parent))
+        return parent
+
     def merge_stages(self):
         """
         Recursively merge in stages from the parents
@@ -210,7 +262,7 @@ class PackageLoader(PackageLoaderBase):
         All parents, direct and indirect
     """
 
-    def __init__(self, name, parameters, load_yaml):
+    def __init__(self, name, parameters, load_yaml, parent_cache=None):
         """
         Load package yaml and postprocess it.
 
@@ -227,8 +279,12 @@ class PackageLoader(PackageLoaderBase):
         load_yaml : function
             Callable to load the yaml, see
             :meth:`hashdist.spec.profile.load_package_yaml`.
+
+        parent_cache : dict or ``None``
+            If given, loaded parents are memoized in it and shared
+            between packages; see :meth:`_get_parent_loader`.
         """
-        super(PackageLoader, self).__init__(name, parameters, load_yaml)
+        super(PackageLoader, self).__init__(name, parameters, load_yaml, parent_cache)
         self.override_requested_sources()
         self.expand_globs_in_build_stages_files()
 
@@ -271,16 +327,19 @@ class PackageLoader(PackageLoaderBase):
             if not self.package_file.in_directory:
                 raise PackageError(files, 'Can only contain "files:" in a package directory')
             pkg_root = self.package_file.dirname
+            resolver = self.package_file.file_resolver
+            exists = os.path.exists if resolver is None else resolver.exists
+            glob_files = glob.glob if resolver is None else resolver.glob
             def strip_pkg_root(path):
                 assert path.startswith(pkg_root)
                 return path[len(pkg_root) + 1:]
             expanded = []
             for f in files:
                 fqn = f if os.path.isabs(f) else pjoin(pkg_root, f)
-                if os.path.exists(fqn):
+                if exists(fqn):
                     expanded.append(f)
                 else:
-                    matches = glob.glob(fqn)
+                    matches = glob_files(fqn)
                     expanded.extend(sorted(map(strip_pkg_root, matches)))
             stage['files'] = expanded
 
@@ -423,11 +482,15 @@ def inherit_stages(descendant_stages, ancestors):
                 raise PackageError(name, 'cannot use mode: update on an empty stage')
             x = stages[name]
             for node_name, node_value in stage.iteritems():
+                # copy rather than modify values, which may belong to
+                # an ancestor that is shared with other packages
                 if node_name not in x:
                     x[node_name] = node_value
                 elif isinstance(node_value, dict):
+                    x[node_name] = copy_dict_node(x[node_name])
                     x[node_name].update(node_value)
                 elif isinstance(node_value, list):
+                    x[node_name] = copy_list_node(x[node_name])
                     x[node_name].extend(node_value)
         elif mode == 'replace':
             stages[name] = stage
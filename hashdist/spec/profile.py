@@ -15,6 +15,7 @@ import shutil
 from os.path import join as pjoin
 import re
 import glob
+import fnmatch
 from urlparse import urlsplit
 from urllib import urlretrieve
 import posixpath
@@ -28,11 +29,52 @@ from .exceptions import ProfileError, PackageError
 GLOBALS_LST = [len]
 GLOBALS = dict((entry.__name__, entry) for entry in GLOBALS_LST)
 
+_compiled_conditions = {} # { expr: (code, names) }
+_condition_results = {} # { (expr, values of names): result }
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, type(code)):
+            names.update(_code_names(const))
+    return names
+
+def _compile_condition(expr):
+    """
+    Returns the code object for `expr` and the names it may look up,
+    found by inspecting the code object (which includes attribute names,
+    so this is a superset of the parameters used).
+    """
+    try:
+        return _compiled_conditions[expr]
+    except KeyError:
+        code = compile(expr, '<when>', 'eval')
+        result = _compiled_conditions[expr] = (code, tuple(sorted(_code_names(code))))
+        return result
+
 def eval_condition(expr, parameters):
+    code, names = _compile_condition(expr)
+    # A name that is not in `parameters` may resolve to a global, to the
+    # default of a defaultdict (which is then inserted), or raise NameError,
+    # so only memoize when all names are present
+    key = None
+    if all(name in parameters for name in names):
+        key = (expr, tuple((name, type(parameters[name]), parameters[name])
+                           for name in names))
+        try:
+            return _condition_results[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable parameter values; don't memoize
+            key = None
     try:
-        return bool(eval(expr, GLOBALS, parameters))
+        result = bool(eval(code, GLOBALS, parameters))
     except NameError as e:
         raise ProfileError(expr, "parameter not defined: %s" % e)
+    if key is not None:
+        _condition_results[key] = result
+    return result
 
 
 class PackageYAML(object):
@@ -60,9 +102,15 @@ class PackageYAML(object):
     hook_filename : str or ``None``
         Full qualified name of the package ``.py`` hook file, if it
         exists.
+
+    file_resolver : :class:`FileResolver` or ``None``
+        The resolver of the profile, used to look up files.
     """
+    file_resolver = None
+
 
-    def __init__(self, used_name, filename, parameters, in_directory):
+    def __init__(self, used_name, filename, parameters, in_directory, parse_cache=None,
+                 file_resolver=None):
         """
         Constructor
 
@@ -84,23 +132,31 @@ class PackageYAML(object):
 
         in_directory : boolean
             Whether the package yaml file is in its own directory.
+
+        parse_cache : :class:`~hashdist.core.cache.DiskCache` or ``None``
+            Cache for the parsed yaml documents.
+
+        file_resolver : :class:`FileResolver` or ``None``
+            Used to look up files in the package directory.
         """
         self.filename = filename
-        self._init_load(filename, parameters)
+        self.file_resolver = file_resolver
+        self._init_load(filename, parameters, parse_cache)
         self.in_directory = in_directory
         hook = os.path.abspath(pjoin(os.path.dirname(filename), used_name + '.py'))
-        self.hook_filename = hook if os.path.exists(hook) else None
+        exists = os.path.exists if file_resolver is None else file_resolver.exists
+        self.hook_filename = hook if exists(hook) else None
 
-    def _init_load(self, filename, parameters):
+    def _init_load(self, filename, parameters, parse_cache):
         # To support the defaults section we first load the file, read defaults,
         # then load file again (since parameter expansion is currently done on
         # stream level not AST level).
-        doc = load_yaml_from_file(filename, collections.defaultdict(str))
+        doc = load_yaml_from_file(filename, collections.defaultdict(str), cache=parse_cache)
         defaults = doc.get('defaults', {})
         all_parameters = collections.defaultdict(str, defaults)
         all_parameters.update(parameters)
         self.parameters = all_parameters
-        self.doc = load_yaml_from_file(filename, all_parameters)
+        self.doc = load_yaml_from_file(filename, all_parameters, cache=parse_cache)
 
     def __repr__(self):
         return self.filename
@@ -133,7 +189,7 @@ class Profile(object):
     Profiles acts as nodes in a tree, with `extends` containing the
     parent profiles (which are child nodes in a DAG).
     """
-    def __init__(self, logger, doc, checkouts_manager):
+    def __init__(self, logger, doc, checkouts_manager, parse_cache=None):
         self.logger = logger
         self.doc = doc
         self.parameters = dict(doc.get('parameters', {}))
@@ -142,6 +198,9 @@ class Profile(object):
         self.hook_import_dirs = doc.get('hook_import_dirs', [])
         self.packages = doc['packages']
         self._yaml_cache = {} # (filename: [list of documents, possibly with when-clauses])
+        self.parent_loader_cache = {} # see PackageLoaderBase._get_parent_loader
+        self.profile_files = [] # set by load_profile
+        self.parse_cache = parse_cache
 
     def resolve(self, path):
         """Turn <repo>/path into /tmp/foo-342/path"""
@@ -223,7 +282,8 @@ class Profile(object):
                                                      pjoin(use, use + '-*.yaml')],
                                                     match_basename=True)
             self._yaml_cache['package', use] = yaml_files = [
-                PackageYAML(use, filename, parameters, pattern != yaml_filename)
+                PackageYAML(use, filename, parameters, pattern != yaml_filename,
+                            self.parse_cache, self.file_resolver)
                 for match, (pattern, filename) in matches.items()]
             self.logger.info('Resolved package %s to %s', pkgname,
                              [filename for match, (pattern, filename) in matches.items()])
@@ -340,15 +400,114 @@ class TemporarySourceCheckouts(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+class DirectoryIndex(object):
+    """
+    In-memory listing of a directory tree, used to answer existence
+    checks and glob patterns without touching the filesystem (which is
+    slow on network filesystems). Symlinks are followed; version
+    control directories (``.git``, ``.hg``, ``.svn``) are left out.
+
+    The index is made when the object is constructed and is not
+    updated afterwards.
+    """
+    IGNORED_DIRS = ('.git', '.hg', '.svn')
+
+    def __init__(self, root):
+        self.root = root
+        self.entries = {} # { relative dir path ('' for root): set of names }
+        real_paths = {} # { relative dir path: real path }
+        for dirpath, dirnames, filenames in os.walk(root, followlinks=True):
+            reldir = os.path.relpath(dirpath, root)
+            reldir = '' if reldir == '.' else reldir
+            real = real_paths[reldir] = os.path.realpath(dirpath)
+            dirnames[:] = [x for x in dirnames if x not in self.IGNORED_DIRS]
+            self.entries[reldir] = set(dirnames + filenames)
+            ancestor = reldir
+            while ancestor:
+                ancestor = os.path.dirname(ancestor)
+                if real_paths[ancestor] == real:
+                    # symlink loop; list the directory, but do not descend
+                    dirnames[:] = []
+                    break
+
+    def exists(self, relpath):
+        dirname, basename = os.path.split(os.path.normpath(relpath))
+        return basename in self.entries.get(dirname, ())
+
+    def glob(self, pattern):
+        """
+        Returns the relative paths matching the relative glob `pattern`,
+        with the semantics of ``glob.glob``.
+        """
+        matches = ['']
+        for part in os.path.normpath(pattern).split(os.sep):
+            new_matches = []
+            for reldir in matches:
+                names = self.entries.get(reldir, ())
+                if glob.has_magic(part):
+                    if not part.startswith('.'):
+                        names = [x for x in names if not x.startswith('.')]
+                    found = fnmatch.filter(names, part)
+                else:
+                    found = [part] if part in names else []
+                new_matches.extend(pjoin(reldir, name) for name in found)
+            matches = new_matches
+        return matches
+
+
 class FileResolver(object):
     """
     Find spec files in an overlay-based filesystem, consulting many
     search paths in order.  Supports the
     ``<repo_name>/some/path``-convention.
+
+    Each overlay is listed once into a :class:`DirectoryIndex` the first
+    time it is searched, and all lookups are answered from it.
     """
     def __init__(self, checkouts_manager, search_dirs):
         self.checkouts_manager = checkouts_manager
         self.search_dirs = search_dirs
+        self._indices = {} # { resolved overlay dir: DirectoryIndex }
+
+    def _get_index(self, basedir):
+        index = self._indices.get(basedir, None)
+        if index is None:
+            index = self._indices[basedir] = DirectoryIndex(basedir)
+        return index
+
+    def _split_path(self, path):
+        """
+        Returns ``(index, prefix, relpath)`` if the resolved `path` is
+        ``prefix + relpath`` where `prefix` is one of the overlays,
+        otherwise ``(None, None, None)``.
+        """
+        for overlay in self.search_dirs:
+            basedir = self.checkouts_manager.resolve(overlay)
+            prefix = basedir.rstrip(os.sep) + os.sep
+            if path.startswith(prefix):
+                return self._get_index(basedir), prefix, path[len(prefix):]
+        return None, None, None
+
+    def exists(self, path):
+        """
+        Like ``os.path.exists``, for a resolved path; looks in the index if
+        the path is within an overlay. Only paths found in the index are
+        checked on the filesystem, in case they have been removed since.
+        """
+        index, prefix, relpath = self._split_path(path)
+        if index is None or os.path.isabs(relpath):
+            return os.path.exists(path)
+        return index.exists(relpath) and os.path.exists(path)
+
+    def glob(self, pattern):
+        """
+        Like ``glob.glob``, for a resolved path; looks in the index if
+        the pattern is within an overlay.
+        """
+        index, prefix, relpattern = self._split_path(pattern)
+        if index is None or os.path.isabs(relpattern):
+            return glob.glob(pattern)
+        return [prefix + match for match in index.glob(relpattern)]
 
     def find_file(self, filenames):
         """
@@ -376,7 +535,7 @@ class FileResolver(object):
         for overlay in self.search_dirs:
             for p in filenames:
                 filename = pjoin(overlay, p)
-                if os.path.exists(self.checkouts_manager.resolve(filename)):
+                if self.exists(self.checkouts_manager.resolve(filename)):
                     return filename
         return None
 
@@ -385,7 +544,7 @@ class FileResolver(object):
         Match file globs.
 
         Like ``find_file``, but uses a set of patterns and tries to match each
-        pattern against the filesystem using ``glob.glob``.
+        pattern against the filesystem using ``glob.glob`` semantics.
 
         Parameters
         ----------
@@ -421,7 +580,7 @@ class FileResolver(object):
         for overlay in self.search_dirs[::-1]:
             basedir = self.checkouts_manager.resolve(overlay)
             for p in patterns:
-                for match in glob.glob(pjoin(basedir, p)):
+                for match in [pjoin(basedir, x) for x in self._get_index(basedir).glob(p)]:
                     assert match.startswith(basedir)
                     if match_basename:
                         match_relname = os.path.basename(match)
@@ -431,7 +590,8 @@ class FileResolver(object):
         return result
 
 
-def load_and_inherit_profile(checkouts, include_doc, cwd=None, override_parameters=None):
+def load_and_inherit_profile(checkouts, include_doc, cwd=None, override_parameters=None,
+                             loaded_files=None, parse_cache=None):
     """
     Loads a Profile given an include document fragment, e.g.::
 
@@ -449,6 +609,12 @@ def load_and_inherit_profile(checkouts, include_doc, cwd=None, override_paramete
     `cwd` is where to interpret `file` in `include_doc` relative to
     (if it is not in a temporary checked out source).  It can use the
     format of TemporarySourceCheckouts, ``<repo_name>/some/path``.
+
+    If `loaded_files` is given, it should be a list, and the name of
+    each profile file loaded is appended to it.
+
+    If `parse_cache` is given, parsed profile files are cached in it
+    (see :func:`~hashdist.formats.marked_yaml.load_yaml_from_file`).
     """
     if cwd is None:
         cwd = os.getcwd()
@@ -481,12 +647,15 @@ def load_and_inherit_profile(checkouts, include_doc, cwd=None, override_paramete
     profile_file = resolve_profile(cwd, include_doc['file'])
     new_cwd = resolve_path(profile_file)
 
-    doc = load_yaml_from_file(checkouts.resolve(profile_file))
+    doc = load_yaml_from_file(checkouts.resolve(profile_file), cache=parse_cache)
     if doc is None:
         doc = {}
+    if loaded_files is not None:
+        loaded_files.append(profile_file)
 
     if 'extends' in doc:
-        parents = [load_and_inherit_profile(checkouts, parent_include_doc, cwd=new_cwd)
+        parents = [load_and_inherit_profile(checkouts, parent_include_doc, cwd=new_cwd,
+                                            loaded_files=loaded_files, parse_cache=parse_cache)
                    for parent_include_doc in doc['extends']]
         del doc['extends']
     else:
@@ -535,6 +704,11 @@ def load_and_inherit_profile(checkouts, include_doc, cwd=None, override_paramete
     doc['packages'] = packages
     return doc
 
-def load_profile(logger, checkout_manager, profile_file, override_parameters=None):
-    doc = load_and_inherit_profile(checkout_manager, profile_file, None, override_parameters)
-    return Profile(logger, doc, checkout_manager)
+def load_profile(logger, checkout_manager, profile_file, override_parameters=None,
+                 parse_cache=None):
+    profile_files = []
+    doc = load_and_inherit_profile(checkout_manager, profile_file, None, override_parameters,
+                                   profile_files, parse_cache)
+    profile = Profile(logger, doc, checkout_manager, parse_cache)
+    profile.profile_files = profile_files
+    return profile
@@ -97,5 +97,147 @@ def test_basic_build(tmpdir, sc, bldr, config):
     p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None),
                              pjoin(d, "profile.yaml"))
     pb = builder.ProfileBuilder(logger, sc, bldr, p)
+    pb.prefetch_sources(2)
     pb.build('the_dependency', config, 1, "never", False)
     pb.build('copy_readme', config, 1, "never", False)
+
+
+@build_store_fixture()
+def test_build_profile_with_links(tmpdir, sc, bldr, config):
+    # the usual profile_links rule; the profile must only get the package files
+    d = pjoin(tmpdir, 'tmp', 'profile')
+    dump(pjoin(d, 'profile.yaml'), """\
+        package_dirs: [pkgs]
+        packages: {a:, b:}
+        parameters:
+          BASH: /bin/bash
+    """)
+    for name in ['a', 'b']:
+        dump(pjoin(d, 'pkgs', '%s.yaml' % name), """\
+            build_stages:
+              - name: install
+                handler: bash
+                bash: |
+                  /bin/mkdir ${ARTIFACT}/bin
+                  echo %s > ${ARTIFACT}/bin/%s
+            profile_links:
+              - link: '*/**/*'
+        """ % (name, name))
+    null_logger = logging.getLogger('null_logger')
+    p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None),
+                             pjoin(d, "profile.yaml"))
+    pb = builder.ProfileBuilder(logger, sc, bldr, p)
+    for pkgname in ['a', 'b']:
+        pb.build(pkgname, config, 1, "never", False)
+        assert os.path.exists(pjoin(bldr.resolve(pb.get_build_spec(pkgname).artifact_id),
+                                    'job_stats.json'))
+    artifact_id, profile_path = pb.build_profile(config)
+    eq_(['a', 'b'], sorted(os.listdir(pjoin(profile_path, 'bin'))))
+    eq_(['artifact.json', 'bin', 'build.json', 'build.log.gz', 'id', 'job_stats.json'],
+        sorted(os.listdir(profile_path)))
+
+
+@build_store_fixture()
+def test_load_jobs(tmpdir, sc, bldr, config):
+    d = pjoin(tmpdir, 'tmp', 'profile')
+    dump(pjoin(d, 'profile.yaml'), """\
+        package_dirs: [pkgs]
+        packages: {a:, b:, c:}
+        parameters:
+          BASH: /bin/bash
+    """)
+    dump(pjoin(d, 'pkgs', 'a.yaml'), "dependencies: {build: [b, c]}\nbuild_stages: [{name: x, handler: bash, bash: a}]")
+    dump(pjoin(d, 'pkgs', 'b.yaml'), "dependencies: {build: [d], run: [c]}\nbuild_stages: [{name: x, handler: bash, bash: b}]")
+    dump(pjoin(d, 'pkgs', 'c.yaml'), "dependencies: {build: [d]}\nbuild_stages: [{name: x, handler: bash, bash: c}]")
+    dump(pjoin(d, 'pkgs', 'd.yaml'), "build_stages: [{name: x, handler: bash, bash: d}]")
+
+    null_logger = logging.getLogger('null_logger')
+    def get_artifact_ids(jobs):
+        p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None),
+                                 pjoin(d, "profile.yaml"))
+        pb = builder.ProfileBuilder(null_logger, sc, bldr, p, jobs=jobs)
+        return dict((pkgname, spec.artifact_id)
+                    for pkgname, spec in pb.get_build_specs().iteritems())
+
+    artifact_ids = get_artifact_ids(1)
+    eq_(['a', 'b', 'c', 'd'], sorted(artifact_ids.keys()))
+    eq_(artifact_ids, get_artifact_ids(3))
+
+    # errors are reported as in the serial case
+    dump(pjoin(d, 'pkgs', 'c.yaml'), "dependencies: {build: [e]}")
+    def get_error(jobs):
+        try:
+            get_artifact_ids(jobs)
+        except Exception as e:
+            return type(e), str(e)
+    eq_(get_error(1), get_error(3))
+    assert get_error(1) is not None
+
+
+def test_source_prefetcher():
+    class MockPackageSpec(object):
+        def __init__(self, name, fail=False):
+            self.name = name
+            self.fail = fail
+
+        def fetch_sources(self, source_cache):
+            if self.fail:
+                raise RuntimeError('fetch of %s failed' % self.name)
+            source_cache.fetched.append(self.name)
+
+    class FetchRecordingSourceCache(object):
+        def __init__(self):
+            self.fetched = []
+
+    sc = FetchRecordingSourceCache()
+    null_logger = logging.getLogger('null_logger')
+    prefetcher = builder.SourcePrefetcher(null_logger, sc, 3)
+    specs = [MockPackageSpec(name) for name in ['a', 'b', 'c', 'd']] + [MockPackageSpec('e', fail=True)]
+    prefetcher.start(specs)
+    for name in ['a', 'b', 'c', 'd']:
+        prefetcher.wait(name)
+    assert sorted(sc.fetched) == ['a', 'b', 'c', 'd']
+    assert prefetcher.is_scheduled('a')
+    assert not prefetcher.is_scheduled('f')
+    with assert_raises(RuntimeError):
+        prefetcher.wait('e')
+
+def test_source_prefetcher_shared_repo():
+    # two packages fetching from the same git mirror do not run git concurrently
+    import threading
+    import time
+    class MockPackageSpec(object):
+        def __init__(self, name, key, repo_name):
+            self.name = name
+            self.key = key
+            self.repo_name = repo_name
+
+        def fetch_sources(self, source_cache):
+            source_cache.fetch('git://example.com/repo.git', self.key, self.repo_name)
+
+    class OverlapRecordingSourceCache(object):
+        def __init__(self):
+            self.lock = threading.Lock()
+            self.active = {} # { repo_name : number of fetches running }
+            self.overlaps = []
+
+        def fetch(self, url, key, repo_name=None):
+            with self.lock:
+                self.active[repo_name] = self.active.get(repo_name, 0) + 1
+                if self.active[repo_name] > 1:
+                    self.overlaps.append(repo_name)
+            time.sleep(0.05)
+            with self.lock:
+                self.active[repo_name] -= 1
+
+    sc = OverlapRecordingSourceCache()
+    null_logger = logging.getLogger('null_logger')
+    prefetcher = builder.SourcePrefetcher(null_logger, sc, 4)
+    specs = [MockPackageSpec('a', 'git:' + 'a' * 40, 'shared'),
+             MockPackageSpec('b', 'git:' + 'b' * 40, 'shared'),
+             MockPackageSpec('c', 'git:' + 'c' * 40, 'other'),
+             MockPackageSpec('d', 'git:' + 'a' * 40, 'other')]
+    prefetcher.start(specs)
+    for spec in specs:
+        prefetcher.wait(spec.name)
+    eq_([], sc.overlaps)
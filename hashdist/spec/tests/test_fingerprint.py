@@ -0,0 +1,71 @@
+import os
+import logging
+from os.path import join as pjoin
+from nose.tools import eq_
+
+from ...core.cache import DiskCache
+from ...core.test.utils import *
+from ...core.test.test_build_store import fixture as build_store_fixture
+from .. import profile
+from .. import builder
+from ..fingerprint import ProfileSpecCache, fingerprint_inputs
+
+
+@temp_working_dir_fixture
+def test_fingerprint_inputs(d):
+    dump(pjoin(d, 'profile.yaml'), "{}")
+    dump(pjoin(d, 'pkgs', 'a.yaml'), "{}")
+    dump(pjoin(d, 'pkgs', 'a', 'a.py'), "")
+    files, dirs = [pjoin(d, 'profile.yaml')], [pjoin(d, 'pkgs')]
+    fp = fingerprint_inputs(files, dirs)
+    eq_(fp, fingerprint_inputs(files, dirs))
+
+    # compiled hooks and profile symlinks are ignored
+    dump(pjoin(d, 'pkgs', 'a', 'a.pyc'), "")
+    os.symlink(d, pjoin(d, 'pkgs', 'profile'))
+    eq_(fp, fingerprint_inputs(files, dirs))
+
+    dump(pjoin(d, 'pkgs', 'b.yaml'), "{}")
+    fp_new = fingerprint_inputs(files, dirs)
+    assert fp != fp_new
+    dump(pjoin(d, 'pkgs', 'a.yaml'), "{build_stages: []}")
+    assert fp_new != fingerprint_inputs(files, dirs)
+
+
+@build_store_fixture()
+def test_profile_spec_cache(tmpdir, sc, bldr, config):
+    d = pjoin(tmpdir, 'tmp', 'profile')
+    dump(pjoin(d, 'profile.yaml'), """\
+        package_dirs: [pkgs]
+        packages: {a:, b:}
+        parameters:
+          BASH: /bin/bash
+    """)
+    dump(pjoin(d, 'pkgs', 'a.yaml'), "dependencies: {build: [b]}")
+    dump(pjoin(d, 'pkgs', 'b.yaml'), "{}")
+
+    null_logger = logging.getLogger('null_logger')
+    cache = DiskCache(pjoin(tmpdir, 'cache'))
+    spec_cache = ProfileSpecCache(cache, pjoin(d, 'profile.yaml'), {'x': 'y'})
+    eq_((None, None), spec_cache.get())
+
+    p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None),
+                             pjoin(d, 'profile.yaml'), {'x': 'y'})
+    eq_([pjoin(d, 'profile.yaml')], p.profile_files)
+    pb = builder.ProfileBuilder(null_logger, sc, bldr, p)
+    spec_cache.put(p, pb)
+
+    build_specs, profile_build_spec = ProfileSpecCache(DiskCache(cache.cache_path),
+                                                       pjoin(d, 'profile.yaml'), {'x': 'y'}).get()
+    eq_(sorted(['a', 'b']), sorted(build_specs.keys()))
+    for pkgname, build_spec in build_specs.items():
+        eq_(pb.get_build_spec(pkgname).artifact_id, build_spec.artifact_id)
+    eq_(pb.get_profile_build_spec().artifact_id, profile_build_spec.artifact_id)
+
+    # other parameters are cached separately
+    eq_((None, None), ProfileSpecCache(cache, pjoin(d, 'profile.yaml'), {}).get())
+
+    # changing an input invalidates the cache
+    dump(pjoin(d, 'pkgs', 'b.yaml'), "dependencies: {build: []}")
+    eq_((None, None), ProfileSpecCache(DiskCache(cache.cache_path),
+                                       pjoin(d, 'profile.yaml'), {'x': 'y'}).get())
@@ -1,4 +1,6 @@
 import sys
+import marshal
+from os.path import join as pjoin
 from pprint import pprint
 from textwrap import dedent
 from ...core.test.utils import *
@@ -48,3 +50,35 @@ def test_hook_loading(d):
 
     assert 'myutils' not in sys.modules
     assert 'base' not in sys.path
+
+
+@temp_working_dir_fixture
+def test_hook_compile_cache(d):
+    from ...core.cache import DiskCache
+    dump('hook.py', """\
+    from hashdist import build_stage
+    import json  # outside the hook import dirs, so kept between packages
+    import myutils
+
+    @build_stage()
+    def handler(ctx, stage):
+        return myutils.get_one()
+    """)
+    dump('base/myutils.py', """\
+    def get_one(): return 1
+    """)
+    cache = DiskCache(pjoin(d, 'cache'))
+    code = hook.compile_hook('hook.py', cache)
+    assert code is hook.compile_hook('hook.py')
+    hook._compiled_hooks.clear()
+    assert marshal.dumps(hook.compile_hook('hook.py', DiskCache(pjoin(d, 'cache')))) == marshal.dumps(code)
+
+    json_mod = sys.modules.get('json')
+    with hook.python_path_and_modules_sandbox(['base']):
+        ctx = hook_api.PackageBuildContext(None, {}, {})
+        hook.load_hooks(ctx, ['hook.py'], cache)
+        assert 1 == ctx._build_stage_handlers['handler'](None, None)
+    assert 'myutils' not in sys.modules
+    assert sys.modules['json'] is not None
+    if json_mod is not None:
+        assert sys.modules['json'] is json_mod
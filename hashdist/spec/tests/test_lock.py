@@ -0,0 +1,91 @@
+import os
+import shutil
+import logging
+from StringIO import StringIO
+from os.path import join as pjoin
+from nose.tools import eq_
+
+from ...core import SourceCache
+from ...core.test.utils import *
+from ...core.test.test_build_store import fixture as build_store_fixture
+from .. import profile
+from .. import builder
+from ..lock import make_lock_document, write_lock_document, LockedProfileBuilder
+
+def setup():
+    global mock_tarball_tmpdir, mock_tarball,  mock_tarball_hash
+    mock_tarball_tmpdir, mock_tarball,  mock_tarball_hash = make_temporary_tarball(
+        [('README', 'file contents')])
+
+def teardown():
+    shutil.rmtree(mock_tarball_tmpdir)
+
+
+@build_store_fixture()
+def test_build_from_lock(tmpdir, sc, bldr, config):
+    d = pjoin(tmpdir, 'tmp', 'profile')
+    dump(pjoin(d, 'profile.yaml'), """\
+        package_dirs: [pkgs]
+        packages: {copy_readme:, the_dependency:}
+        parameters:
+          BASH: /bin/bash
+    """)
+    dump(pjoin(d, 'pkgs/copy_readme/copy_readme.yaml'), """\
+        dependencies:
+          build: [the_dependency]
+        build_stages:
+          - name: the_copy_readme_file_stage
+            handler: bash
+            bash: |
+              /bin/cp ${THE_DEPENDENCY_DIR}/README_IN_DEPENDENCY ${ARTIFACT}/README
+          - name: copy_bundled
+            handler: copy_bundled
+        profile_links:
+          - link: README
+    """)
+    dump(pjoin(d, 'pkgs/copy_readme/bundled.txt'), "bundled")
+    dump(pjoin(d, 'pkgs/copy_readme/copy_readme.py'), """\
+        from hashdist import build_stage
+        @build_stage()
+        def copy_bundled(ctx, stage):
+            ctx.bundle_file('bundled.txt')
+            return ['/bin/cp _hashdist/bundled.txt ${ARTIFACT}']
+    """)
+    dump(pjoin(d, 'pkgs/the_dependency.yaml'), """\
+        sources:
+          - url: file:%(tar_file)s
+            key: %(tar_hash)s
+        build_stages:
+          - name: the_copy_readme_file_stage
+            handler: bash
+            bash: |
+              /bin/cp README ${ARTIFACT}/README_IN_DEPENDENCY
+    """ % dict(tar_file=mock_tarball, tar_hash=mock_tarball_hash))
+
+    null_logger = logging.getLogger('null_logger')
+    p = profile.load_profile(null_logger, profile.TemporarySourceCheckouts(None),
+                             pjoin(d, "profile.yaml"))
+    pb = builder.ProfileBuilder(null_logger, sc, bldr, p)
+    stream = StringIO()
+    write_lock_document(make_lock_document(pb, sc), stream)
+
+    # build from the lock file with an empty source cache, and without the profile
+    shutil.rmtree(d)
+    os.makedirs(pjoin(tmpdir, 'src2'))
+    config = dict(config, source_caches=[{'dir': pjoin(tmpdir, 'src2')}])
+    sc2 = SourceCache.create_from_config(config, logger)
+    with open(pjoin(tmpdir, 'profile.lock.json'), 'w') as f:
+        f.write(stream.getvalue())
+    lpb = LockedProfileBuilder.load(null_logger, sc2, bldr, pjoin(tmpdir, 'profile.lock.json'))
+    eq_(['the_dependency'], lpb.get_ready_list())
+    lpb.prefetch_sources(2)
+    while lpb.get_ready_list():
+        lpb.build(lpb.get_ready_list()[0], config, 1)
+    for pkgname in ['copy_readme', 'the_dependency']:
+        eq_(pb.get_build_spec(pkgname).artifact_id, lpb.get_build_spec(pkgname).artifact_id)
+    path = bldr.resolve(lpb.get_build_spec('copy_readme').artifact_id)
+    eq_('file contents', cat(pjoin(path, 'README')))
+    eq_('bundled', cat(pjoin(path, 'bundled.txt')))
+    artifact_id, profile_path = lpb.build_profile(config)
+    eq_(pb.get_profile_build_spec().artifact_id, artifact_id)
+    assert os.path.exists(pjoin(profile_path, 'README'))
@@ -98,6 +98,7 @@ class MockProfile(object):
     def __init__(self, files):
         self.parameters = {}
         self.packages = {}
+        self.parent_loader_cache = {}
         self.files = dict((name, marked_yaml_load(body)) for name, body in files.items())
 
     def load_package_yaml(self, name, parameters):
@@ -270,6 +271,36 @@ def test_update_mode():
                  'extra': ['--without-ensurepip', '--enable-shared', '--enable-framework=${ARTIFACT}']}]
     eq_(expected, loader.doc['build_stages'])
 
+def test_shared_parent_loaders():
+    files = {
+        'a.yaml': """
+            extends: [base]
+            build_stages: [{name: configure, mode: update, extra: [--a]}]
+            """,
+        'b.yaml': 'extends: [base]',
+        'c.yaml': 'extends: [base]',
+        'base.yaml': """
+            build_stages:
+            - name: configure
+              extra: [--base]
+            - when: shared
+              name: shared
+            """}
+    prof = MockProfile(files)
+    loaded = []
+    def load_yaml(name, parameters):
+        loaded.append(name)
+        return prof.load_package_yaml(name, parameters)
+    def load(name, parameters):
+        loader = package_loader.PackageLoader(name, parameters, load_yaml=load_yaml,
+                                              parent_cache=prof.parent_loader_cache)
+        return sorted((stage['name'], stage.get('extra')) for stage in loader.doc['build_stages'])
+    eq_([('configure', ['--base', '--a'])], load('a', {'package': 'a', 'shared': False}))
+    eq_([('configure', ['--base'])], load('b', {'package': 'b', 'shared': False}))
+    eq_([('configure', ['--base']), ('shared', None)],
+        load('c', {'package': 'c', 'shared': True}))
+    eq_(['a', 'base', 'b', 'c', 'base'], loaded)
+
 def test_order_stages():
     loader = package_loader.PackageLoader.__new__(package_loader.PackageLoader)
     loader.doc = marked_yaml_load("""\
@@ -191,6 +191,23 @@ def test_file_resolver_glob(d):
         'foo/foo-3.yaml': ('foo/foo-*.yaml', '%s/level1/foo/foo-3.yaml' % d)})
 
 
+@temp_working_dir_fixture
+def test_directory_index(d):
+    import glob
+    for name in ['a.yaml', '.hidden.yaml', 'foo/foo.yaml', 'foo/foo-1.yaml', 'foo/bar/x.txt',
+                 '.git/config']:
+        dump(pjoin(d, 'root', name), '{}')
+    os.symlink(pjoin(d, 'root'), pjoin(d, 'root', 'foo', 'loop'))
+    index = profile.DirectoryIndex(pjoin(d, 'root'))
+    for pattern in ['*.yaml', '.*.yaml', 'foo/foo-*.yaml', '*/*', 'foo/*/x.txt', 'foo/bar',
+                    'foo/loop/a.yaml', 'nonexisting/*']:
+        eq_(sorted(glob.glob(pjoin(d, 'root', pattern))),
+            sorted(pjoin(d, 'root', x) for x in index.glob(pattern)))
+    assert index.exists('foo/foo.yaml')
+    assert index.exists('foo/bar')
+    assert not index.exists('foo/nonexisting.yaml')
+    assert not index.exists('.git/config')
+
 @temp_working_dir_fixture
 def test_resource_resolution(d):
     # test packages_dir, base_dir, and sys.path
@@ -330,3 +347,25 @@ def test_defaults_section_in_package(d):
         {'handler': 'bash'}, {'handler': 'bash', 'bash': 'exit 0\n'}]
     assert get_build_stages_of_mypkg('with_global.yaml') == [{'handler': 'bash', 'bash': 'exit 1\n'}]
     assert get_build_stages_of_mypkg('with_package.yaml') == [{'handler': 'bash', 'bash': 'exit 1\n'}]
+
+
+def test_eval_condition():
+    from collections import defaultdict
+    eq_(True, profile.eval_condition('x == 1 and y', {'x': 1, 'y': True}))
+    eq_(False, profile.eval_condition('x == 1 and y', {'x': 1, 'y': False}))
+    eq_(False, profile.eval_condition('x == 1 and y', {'x': 2, 'y': True}))
+    eq_(True, profile.eval_condition('len(x) == 2', {'x': ['a', 'b']}))  # unhashable
+    eq_(True, profile.eval_condition('not z', defaultdict(str)))
+    code, names = profile._compile_condition('x.startswith(y) or [a for a in b]')
+    ok_(set(['x', 'y', 'a', 'b']) <= set(names))
+    with assert_raises(ProfileError):
+        profile.eval_condition('x == 1 and y', {'x': 1})
+    # a missing name is not answered from the memo of a defaultdict
+    params = defaultdict(str)
+    eq_(True, profile.eval_condition('not q', params))
+    eq_({'q': ''}, dict(params))
+    with assert_raises(ProfileError):
+        profile.eval_condition('not q', {})
+    params = defaultdict(str)
+    eq_(True, profile.eval_condition('not q', params))
+    eq_({'q': ''}, dict(params))
@@ -85,6 +85,7 @@ For doctesting only, revert back to the nose logging handlers::
     >>> backup_config.restore()
 """
 
+import sys
 import logging
 import os
 from ansi_color import want_color, color, monochrome
@@ -140,7 +141,7 @@ class HashDistFormatter(logging.Formatter):
             return logging.Formatter.format(self, record)
 
 
-def configure_logging(config):
+def configure_logging(config, stream=None):
     """
     Configure the root logger
 
@@ -158,6 +159,10 @@ def configure_logging(config):
        * the name of a logging configuration YAML file. See
          ``logging_config.yaml`` for which loggers are required.
        * ``None``. In this case, a suitable default is set up.
+
+    stream : file or ``None``
+       If given, log there instead of to standard output (see
+       :func:`set_log_stream`).
     """
     default = os.path.join(os.path.dirname(__file__), 'logging_config.yaml')
     if config is None:
@@ -167,6 +172,8 @@ def configure_logging(config):
         set_log_level(config)
     else:
         _configure_logging_from_yaml(config)
+    if stream is not None:
+        set_log_stream(stream)
     # Logging works now
     root = logging.getLogger()
     root.info('configured logging: %s', config)
@@ -230,6 +237,40 @@ def set_log_level(level):
     pkg_handler.setLevel(level)
 
 
+def set_log_stream(stream):
+    """
+    Set where the log messages to standard output are displayed.
+
+    This is used by commands that write their result to standard
+    output, so that it is not mixed with log messages.
+
+    EXAMPLES::
+
+        >>> from StringIO import StringIO
+        >>> from hashdist.util.logger_setup import *
+        >>> backup_config = LogConfigurationStore()
+        >>> configure_logging('INFO')
+        [INFO] configured logging: INFO
+        >>> log = StringIO()
+        >>> set_log_stream(log)
+        >>> getLogger().info('not on standard output')
+        >>> log.getvalue()
+        '[INFO] not on standard output\\n'
+        >>> backup_config.restore()
+
+    Arguments:
+    ----------
+
+    stream : file
+        The stream to write the log messages to
+    """
+    for logger in [logging.getLogger(), logging.getLogger('package')]:
+        for handler in logger.handlers:
+            if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                handler.flush()
+                handler.stream = stream
+
+
 def getLogger(name=None, pkg=None):
     """
     Get Logger
@@ -428,3 +469,153 @@ class sublevel_added(object):
     def __exit__(self, exc_type, exc_value, traceback):
         if self.filter:
             self.logger.removeFilter(self.filter)
+
+
+def log_lines(logger, level, lines, sublevel=None):
+    """
+    Log each of the given lines as a separate record
+
+    This is equivalent to calling ``logger.log(level, line)`` for each
+    line (within :class:`sublevel_added` if ``sublevel`` is given), but
+    the enabled levels, the caller and the adapter context are only
+    looked up once for the whole batch (so all records get the same
+    creation time), and stream handlers write and flush the formatted
+    records of the batch at once. It is meant for forwarding the
+    output of subprocesses.
+
+    EXAMPLES::
+
+        >>> from hashdist.util.logger_setup import *
+        >>> backup_config = LogConfigurationStore()
+        >>> configure_logging('INFO')
+        [INFO] configured logging: INFO
+
+        >>> import logging
+        >>> logger = logging.getLogger()
+        >>> log_lines(logger, logging.INFO, ['first', 'second'])
+        [INFO] first
+        [INFO] second
+        >>> log_lines(logger, logging.WARNING, ['third'], 'foo')
+        [WARNING:foo] third
+        >>> log_lines(logger, logging.DEBUG, ['not shown'])
+
+    Non-ASCII lines are written to streams without an encoding (such as
+    log files) in UTF-8, as :class:`logging.StreamHandler` does::
+
+        >>> import tempfile
+        >>> file_logger = logging.getLogger('hashdist.log_lines_example')
+        >>> file_logger.propagate = False
+        >>> with tempfile.TemporaryFile() as f:
+        ...     file_logger.addHandler(logging.StreamHandler(f))
+        ...     log_lines(file_logger, logging.WARNING, [u'caf\\xe9', 'bar'])
+        ...     file_logger.handlers = []
+        ...     f.seek(0)
+        ...     f.read()
+        'caf\\xc3\\xa9\\nbar\\n'
+
+        >>> backup_config.restore()
+
+    Arguments:
+    ----------
+
+    logger : logging.Logger or logging.LoggerAdapter
+        The logger to log to.
+
+    level : int
+        The log level of all lines.
+
+    lines : list of str
+        The messages; they are not %-formatted.
+
+    sublevel : string or ``None``
+        The sublevel name to append to the level name, if any.
+    """
+    extra = None
+    if isinstance(logger, logging.LoggerAdapter):
+        extra = logger.extra
+        logger = logger.logger
+    if logger.disabled or not logger.isEnabledFor(level):
+        return
+    caller = sys._getframe(1)
+    filename, lineno, func = caller.f_code.co_filename, caller.f_lineno, caller.f_code.co_name
+    levelname = logging.getLevelName(level)
+    if sublevel is not None:
+        levelname += ':' + sublevel
+    template = logger.makeRecord(logger.name, level, filename, lineno, None, None, None,
+                                 func, extra)
+    template.levelname = levelname
+    fields = template.__dict__
+    record_class = type(template)
+    records = []
+    for line in lines:
+        record = record_class.__new__(record_class)
+        record.__dict__.update(fields)
+        record.msg = line
+        if logger.filter(record):
+            records.append(record)
+    if not records:
+        return
+    # like logger.callHandlers(record) for each record
+    while logger is not None:
+        for handler in logger.handlers:
+            if level < handler.level:
+                continue
+            if isinstance(handler, logging.StreamHandler) and handler.stream is not None:
+                _emit_batch(handler, records)
+            else:
+                for record in records:
+                    handler.handle(record)
+        logger = logger.parent if logger.propagate else None
+
+
+class _StreamBatch(object):
+    """
+    Collects what a :class:`logging.StreamHandler` writes, so that it
+    can be written to the real stream at once
+    """
+    def __init__(self, stream):
+        self.encoding = getattr(stream, 'encoding', None)
+        self.chunks = []
+
+    def write(self, s):
+        self.chunks.append(s)
+
+    def flush(self):
+        pass
+
+    def write_to(self, stream):
+        # join runs of str and of unicode separately, as the stream may
+        # treat them differently
+        run = []
+        for chunk in self.chunks + [None]:
+            if run and (chunk is None or type(chunk) is not type(run[0])):
+                data = ''.join(run) if isinstance(run[0], str) else u''.join(run)
+                try:
+                    stream.write(data)
+                except UnicodeEncodeError:
+                    stream.write(data.encode(self.encoding or 'utf-8'))
+                run = []
+            run.append(chunk)
+
+
+def _emit_batch(handler, records):
+    handler.acquire()
+    try:
+        stream = handler.stream
+        batch = _StreamBatch(stream)
+        handler.stream = batch
+        try:
+            for record in records:
+                if handler.filter(record):
+                    handler.emit(record)
+        finally:
+            handler.stream = stream
+        try:
+            batch.write_to(stream)
+            handler.flush()
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            handler.handleError(records[-1])
+    finally:
+        handler.release()